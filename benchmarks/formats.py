@@ -0,0 +1,49 @@
+#!/usr/bin/python
+# vim: et sw=4 ts=4:
+# -*- coding: utf-8 -*-
+#
+# Compare the speed of matching log lines with the format regexes only and
+# with the strict regexes of StrictRegexFormat first.
+#
+# Usage: ./benchmarks/formats.py [number of lines]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import import_logs
+
+
+LOGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'logs')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    for name in ('common', 'ncsa_extended', 'icecast2'):
+        format = import_logs.FORMATS[name]
+        sample = [
+            line.decode('utf8') for line in open(os.path.join(LOGS, name + '.log'))
+            if format.regex.match(line)
+        ]
+        lines = (sample * (count / len(sample) + 1))[:count]
+
+        def regex():
+            for line in lines:
+                import_logs.RegexFormat.match(format, line)
+
+        def strict():
+            for line in lines:
+                format.match(line)
+
+        regex_time = min(timeit.repeat(regex, number=1, repeat=3))
+        strict_time = min(timeit.repeat(strict, number=1, repeat=3))
+        print '%-14s regex: %8d lines/s   strict regex: %8d lines/s   speedup: %.2fx' % (
+            name, count / regex_time, count / strict_time, regex_time / strict_time,
+        )
+
+
+if __name__ == '__main__':
+    main()
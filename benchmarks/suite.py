@@ -0,0 +1,309 @@
+#!/usr/bin/python
+# vim: et sw=4 ts=4:
+# -*- coding: utf-8 -*-
+#
+# Benchmark the import of synthetic logs of each format in FORMATS: format
+# detection, parsing, filtering, and whole imports with the null and SQLite
+# sinks. The lines/s and seconds of each stage, and the peak RSS of each
+# format, are printed as JSON to compare versions, e.g.:
+#
+#   ./benchmarks/suite.py --lines 200000 --output before.json
+#
+# Usage: ./benchmarks/suite.py --help
+
+import datetime
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import import_logs
+
+
+BOT_USER_AGENTS = (
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)',
+    'Mozilla/5.0 (compatible; YandexBot/3.0; +http://yandex.com/bots)',
+)
+ERROR_STATUSES = ('404', '500', '503')
+START_DATE = datetime.datetime(2015, 4, 11, 10, 0, 0)
+
+
+class LogGenerator(object):
+    """
+    Generate the same log lines for the same options: requests from `ips`
+    distinct IPs and `user_agents` distinct players to `paths` distinct
+    mounts, one per second, with `bot_ratio` of bots and `error_ratio` of
+    HTTP errors.
+    """
+
+    def __init__(self, seed, ips, user_agents, paths, bot_ratio, error_ratio):
+        self.random = random.Random(seed)
+        self.ips = ['10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255) for i in xrange(ips)]
+        self.user_agents = [
+            'Mozilla/5.0 (Linux; Android 4.4.2) stagefright/1.2 Player/%d.%d' % (i / 100, i % 100)
+            for i in xrange(user_agents)
+        ]
+        self.paths = ['/stream%d' % i for i in xrange(paths)]
+        self.bot_ratio = bot_ratio
+        self.error_ratio = error_ratio
+
+    def requests(self, count):
+        random = self.random
+        for i in xrange(count):
+            if random.random() < self.bot_ratio:
+                user_agent = random.choice(BOT_USER_AGENTS)
+            else:
+                user_agent = random.choice(self.user_agents)
+            yield {
+                'host': 'radio.example.com',
+                'ip': random.choice(self.ips),
+                'date': START_DATE + datetime.timedelta(seconds=i),
+                'path': random.choice(self.paths),
+                'status': random.choice(ERROR_STATUSES) if random.random() < self.error_ratio else '200',
+                'length': random.randint(1000, 10000000),
+                'referrer': '-',
+                'user_agent': user_agent,
+                'session_time': random.randint(1, 3600),
+            }
+
+
+def _common(r):
+    return '%s - - [%s +0000] "GET %s HTTP/1.1" %s %d' % (
+        r['ip'], r['date'].strftime('%d/%b/%Y:%H:%M:%S'), r['path'], r['status'], r['length'])
+
+def _ncsa_extended(r):
+    return '%s "%s" "%s"' % (_common(r), r['referrer'], r['user_agent'])
+
+def _w3c_date(r):
+    return r['date'].strftime('%Y-%m-%d %H:%M:%S')
+
+# Format name: (header lines, function formatting a request as a line).
+FORMATTERS = {
+    'common': ((), _common),
+    'common_vhost': ((), lambda r: '%s %s' % (r['host'], _common(r))),
+    'ncsa_extended': ((), _ncsa_extended),
+    'common_complete': ((), lambda r: '%s %s' % (r['host'], _ncsa_extended(r))),
+    'icecast2': ((), lambda r: '%s %d' % (_ncsa_extended(r), r['session_time'])),
+    's3': ((), lambda r: (
+        'b659b576cff1e15e4c0313ff8930fba9f53e6794567f5c60dab3abf2f8dfb6cc %s [%s +0000] %s - '
+        'EB3502676500C6BE WEBSITE.GET.OBJECT index "GET %s HTTP/1.1" %s - %d %d 10 9 "%s" "%s"' % (
+            r['host'], r['date'].strftime('%d/%b/%Y:%H:%M:%S'), r['ip'], r['path'], r['status'],
+            r['length'], r['length'], r['referrer'], r['user_agent']))),
+    'w3c_extended': ((
+        '#Software: Example Streaming Server 1.0',
+        '#Fields: date time c-ip cs-method cs-uri-stem cs-uri-query sc-status sc-bytes cs(Referer) '
+        'cs(User-Agent) time-taken',
+    ), lambda r: '%s %s GET %s - %s %d %s %s 0.010' % (
+        _w3c_date(r), r['ip'], r['path'], r['status'], r['length'], r['referrer'],
+        r['user_agent'].replace(' ', '+'))),
+    'iis': ((
+        '#Software: Microsoft Internet Information Services 7.5',
+        '#Fields: date time s-ip cs-method cs-uri-stem cs-uri-query s-port cs-username c-ip '
+        'cs(User-Agent) sc-status sc-substatus sc-win32-status time-taken',
+    ), lambda r: '%s 192.0.2.1 GET %s - 80 - %s %s %s 0 0 10' % (
+        _w3c_date(r), r['path'], r['ip'], r['user_agent'].replace(' ', '+'), r['status'])),
+    'amazon_cloudfront': ((
+        '#Version: 1.0',
+        '#Fields: date time x-edge-location sc-bytes c-ip cs-method cs(Host) cs-uri-stem sc-status '
+        'cs(Referer) cs(User-Agent) cs-uri-query cs(Cookie) x-edge-result-type x-edge-request-id '
+        'x-host-header cs-protocol cs-bytes time-taken',
+    ), lambda r: '%s FRA2 %d %s GET d111111abcdef8.cloudfront.net %s %s %s %s - - Hit '
+                 'MRVMF7KydIvxMWfJIglgwHQwZsbG2IhRJ07sn9AkKUFSHS9EXAMPLE== %s http - 0.001' % (
+        _w3c_date(r), r['length'], r['ip'], r['path'], r['status'], r['referrer'],
+        urllib.quote(r['user_agent']), r['host'])),
+    'nginx_json': ((), lambda r: json.dumps({
+        'ip': r['ip'], 'host': r['host'], 'path': r['path'], 'status': r['status'],
+        'referrer': r['referrer'], 'user_agent': r['user_agent'], 'length': r['length'],
+        'generation_time_milli': 0.01, 'date': r['date'].strftime('%Y-%m-%dT%H:%M:%S+00:00'),
+    })),
+}
+
+
+def write_log(filename, format_name, options):
+    header, format_line = FORMATTERS[format_name]
+    generator = LogGenerator(
+        options.seed, options.ips, options.user_agents, options.paths, options.bot_ratio, options.error_ratio,
+    )
+    with open(filename, 'wb') as file:
+        for line in header:
+            file.write(line + '\n')
+        for request in generator.requests(options.lines):
+            file.write(format_line(request) + '\n')
+
+
+def configure(argv):
+    """
+    Set up the globals of import_logs, as its main does, from command line
+    arguments.
+    """
+    sys.argv = ['import_logs.py'] + argv
+    import_logs.config = import_logs.Configuration()
+    import_logs.stats = import_logs.Statistics()
+    import_logs.parser = import_logs.Parser()
+    import_logs.Recorder.recorders = []
+    import_logs.Recorder.next_recorder = 0
+    return import_logs.parser
+
+
+class Stages(object):
+    """
+    Time the stages of a benchmark.
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.results = {}
+
+    def run(self, name, function, *args):
+        time_start = time.time()
+        result = function(*args)
+        seconds = time.time() - time_start
+        self.results[name] = {
+            'seconds': round(seconds, 4),
+            'lines_per_second': int(self.lines / seconds) if seconds else None,
+        }
+        return result
+
+
+def benchmark_format(format_name, options, directory):
+    """
+    Run the benchmark of a format, in a process of its own so that its peak
+    RSS is not the one of the other formats.
+    """
+    filename = os.path.join(directory, format_name + '.log')
+    write_log(filename, format_name, options)
+    stages = Stages(options.lines)
+    result = {'lines': options.lines, 'stages': stages.results}
+
+    parser = configure(['--sink=null', filename])
+    with open(filename) as file:
+        format = stages.run('detect', import_logs.Parser.detect_format, file)
+    result['detected_format'] = format.name
+    # only the first lines are read
+    del stages.results['detect']['lines_per_second']
+
+    def parse():
+        hits = []
+        with open(filename) as file:
+            if isinstance(format, import_logs.W3cExtendedFormat):
+                format.create_regex(file)
+                file.seek(0)
+            offset = 0
+            for lineno, line in enumerate(file, 1):
+                offset += len(line)
+                hit = parser.parse_line(format, filename, None, lineno, offset, line)
+                if hit is not None:
+                    hits.append(hit)
+        return hits
+
+    # filtering is timed on its own
+    check_methods = parser.check_methods
+    parser.check_methods = []
+    hits = stages.run('parse', parse)
+    parser.check_methods = check_methods
+
+    def filter_hits(hits):
+        return [hit for hit in hits if all(method(hit) for method in check_methods)]
+
+    hits = stages.run('filter', filter_hits, hits)
+    result['hits_imported'] = len(hits)
+    del hits
+
+    for sink in options.sinks:
+        sink_options = ['--sink=%s' % sink, '--log-format-name=%s' % format_name,
+                        '--recorders=%d' % options.recorders]
+        if sink == 'sqlite':
+            sink_options.append('--sqlite-path=%s' % os.path.join(directory, format_name + '.sqlite'))
+        parser = configure(sink_options + [filename])
+
+        def run_import():
+            import_logs.Recorder.launch(import_logs.config.options.recorders)
+            parser.parse(filename)
+            import_logs.Recorder.wait_empty()
+            import_logs.Recorder.close()
+
+        stages.run('import_' + sink, run_import)
+        # hits without a session time are counted, though no row is written
+        stages.results['import_' + sink]['hits_recorded'] = import_logs.stats.count_lines_recorded.value
+
+    # the peak of all the stages, as the process only ever grows it;
+    # kilobytes on Linux
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def _benchmark_format(args):
+    return benchmark_format(*args)
+
+
+def main():
+    option_parser = optparse.OptionParser(usage='Usage: %prog [options]')
+    option_parser.add_option('--lines', type='int', default=100000,
+                             help='Number of lines of each log (default: %default)')
+    option_parser.add_option('--formats', default=','.join(sorted(FORMATTERS)),
+                             help='Comma separated formats to benchmark (default: all)')
+    option_parser.add_option('--sinks', default='null,sqlite',
+                             help='Comma separated sinks to import with (default: %default)')
+    option_parser.add_option('--recorders', type='int', default=1,
+                             help='Number of recorders of the imports (default: %default)')
+    option_parser.add_option('--ips', type='int', default=10000,
+                             help='Number of distinct IPs (default: %default)')
+    option_parser.add_option('--user-agents', dest='user_agents', type='int', default=500,
+                             help='Number of distinct user agents, besides bots (default: %default)')
+    option_parser.add_option('--paths', type='int', default=20,
+                             help='Number of distinct paths (default: %default)')
+    option_parser.add_option('--bot-ratio', dest='bot_ratio', type='float', default=0.05,
+                             help='Ratio of requests made by bots (default: %default)')
+    option_parser.add_option('--error-ratio', dest='error_ratio', type='float', default=0.05,
+                             help='Ratio of requests with an HTTP error (default: %default)')
+    option_parser.add_option('--seed', type='int', default=0,
+                             help='Seed of the generated logs (default: %default)')
+    option_parser.add_option('--output', default=None,
+                             help='Write the JSON results to this file instead of stdout')
+    options, args = option_parser.parse_args()
+
+    format_names = options.formats.split(',')
+    for format_name in format_names:
+        if format_name not in FORMATTERS:
+            option_parser.error('no generator for format %s' % format_name)
+    options.sinks = [sink for sink in options.sinks.split(',') if sink]
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': dict((name, getattr(options, name)) for name in (
+            'lines', 'recorders', 'ips', 'user_agents', 'paths', 'bot_ratio', 'error_ratio', 'seed', 'sinks',
+        )),
+        'formats': {},
+    }
+    directory = tempfile.mkdtemp(prefix='import_logs_benchmark')
+    try:
+        for format_name in format_names:
+            pool = multiprocessing.Pool(1)
+            try:
+                results['formats'][format_name] = pool.apply(
+                    _benchmark_format, ((format_name, options, directory),))
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        shutil.rmtree(directory)
+
+    output = open(options.output, 'w') if options.output else sys.stdout
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
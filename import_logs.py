@@ -13,9 +13,15 @@
 # Requires Python 2.6 or greater.
 #
 
+import abc
+import array
 import base64
+import bisect
 import bz2
+import collections
 import ConfigParser
+import copy
+import csv
 import datetime
 import fnmatch
 import gzip
@@ -24,19 +30,25 @@ import httplib
 import inspect
 import itertools
 import logging
+import math
+import multiprocessing
 import optparse
 import os
 import os.path
 import Queue
 import re
+import signal
+import socket
+import struct
 import sys
+import tempfile
 import threading
 import time
+import urllib
 import urllib2
 import urlparse
 import functools
 import traceback
-import MySQLdb as mdb
 from datetime import timedelta
 
 try:
@@ -49,6 +61,16 @@ except ImportError:
             print >> sys.stderr, 'simplejson (http://pypi.python.org/pypi/simplejson/) is required.'
             sys.exit(1)
 
+# Database modules, imported by the sink using them (--sink) so that the
+# other sinks work without them.
+mdb = None
+sqlite3 = None
+# pyarrow and pyarrow.parquet, imported by ExportSink when available.
+pa = None
+pq = None
+# Imported by MmdbGeoIpDatabase for a --geoip-database in the MaxMind format.
+maxminddb = None
+
 
 
 ##
@@ -100,6 +122,56 @@ EXCLUDED_USER_AGENTS = (
 PIWIK_DEFAULT_MAX_ATTEMPTS = 3
 PIWIK_DEFAULT_DELAY_AFTER_FAILURE = 10
 DEFAULT_SOCKET_TIMEOUT = 300
+DEFAULT_DB_IDLE_TIMEOUT = 600
+# Pooled connections idle for longer than this are pinged before being reused.
+DB_HEALTH_CHECK_INTERVAL = 5
+# Stay below the 1MB max_allowed_packet default of older MySQL servers.
+DEFAULT_DB_MAX_STATEMENT_SIZE = 1000000
+DEFAULT_BULK_LOAD_ROWS = 50000
+DEFAULT_FOLLOW_INTERVAL = 1
+DEFAULT_FOLLOW_FLUSH_INTERVAL = 5
+DEFAULT_PARSE_CHUNK_SIZE = 4 * 1024 * 1024
+USER_AGENT_CACHE_SIZE = 10000
+GEOIP_CACHE_SIZE = 100000
+GLOB_CACHE_SIZE = 10000
+HEAVY_HITTERS_SIZE = 100
+HEAVY_HITTERS_MIN_HITS = 1000
+DEFAULT_RECORDER_QUEUE_HIGH_WATERMARK = 2000
+DEFAULT_RECORDER_MIN_BATCH_SIZE = 10
+DEFAULT_RECORDER_MAX_BATCH_SIZE = 10000
+DEFAULT_RECORDERS_SCALE_INTERVAL = 10
+DEFAULT_EXPORT_SHARD_SIZE = 64 * 1024 * 1024
+DEAD_LETTER_REPLAY_BATCH_SIZE = 1000
+# Stages timed with --timings, in the order of the summary.
+TIMING_STAGES = ('read', 'decode', 'match', 'filter', 'date', 'queue_wait', 'execute', 'commit')
+# Resolution of the --timings histograms: buckets grow by 2 ** (1 / 8), ~9%.
+HISTOGRAM_BUCKETS_PER_DOUBLING = 8
+# Shards kept open by each recorder with --sink=export, and rows of a
+# Parquet row group, which bound the memory used by the export.
+EXPORT_MAX_OPEN_SHARDS = 32
+EXPORT_PARQUET_ROW_GROUP_SIZE = 10000
+# A recorder is considered overloaded when recording a hit takes this many
+# times longer than the fastest rate seen.
+RECORDER_LATENCY_OVERLOAD_FACTOR = 2
+# Hits of a visitor further apart than this belong to different visits.
+VISIT_TIMEOUT = timedelta(minutes=30)
+# Escape sequences of the files written for LOAD DATA INFILE.
+BULK_LOAD_UNESCAPES = {'\\': '\\', 't': '\t', 'n': '\n', 'r': '\r', '0': '\0'}
+BULK_LOAD_UNESCAPE_REGEX = re.compile(r'\\(.)')
+# At most this many bytes of headers and comments are read to identify a log
+# file by its first entry.
+FILE_FINGERPRINT_MAX_SIZE = 64 * 1024
+# MySQL client errors meaning the connection was lost or could not be made
+# (CR_CONN_HOST_ERROR, CR_SERVER_GONE_ERROR, CR_SERVER_LOST).
+DB_CONNECTION_ERRORS = (2003, 2006, 2013)
+# MySQL server errors after which InnoDB rolled back the whole transaction,
+# which can be retried as is (ER_LOCK_WAIT_TIMEOUT, ER_LOCK_DEADLOCK).
+DB_TRANSACTION_ERRORS = (1205, 1213)
+# MySQL server errors caused by the values of a row, which only fail its
+# statement (ER_WRONG_VALUE_COUNT_ON_ROW, ER_BAD_NULL_ERROR, ER_DUP_ENTRY,
+# ER_WARN_DATA_OUT_OF_RANGE, WARN_DATA_TRUNCATED, ER_TRUNCATED_WRONG_VALUE,
+# ER_TRUNCATED_WRONG_VALUE_FOR_FIELD, ER_DATA_TOO_LONG, ER_NO_REFERENCED_ROW_2).
+DB_ROW_ERRORS = (1136, 1048, 1062, 1264, 1265, 1292, 1366, 1406, 1452)
 
 PIWIK_EXPECTED_IMAGE = base64.b64decode(
     'R0lGODlhAQABAIAAAAAAAAAAACH5BAEAAAAALAAAAAABAAEAAAICRAEAOw=='
@@ -204,6 +276,33 @@ class RegexFormat(BaseFormat):
         for group in groups:
             del self.matched[group]
 
+class StrictRegexFormat(RegexFormat):
+    """
+    A RegexFormat which first matches lines with a stricter regex, which
+    cannot backtrack, and only uses the format regex for the lines the
+    strict regex does not match.
+
+    The strict regex must give the same groups as the format regex on every
+    line it matches: it replaces each \s+ by a single space and each lazy
+    .*? by a character class stopping at the first delimiter, which is the
+    shortest match tried first by the format regex. Groups which would start
+    or end with whitespace are not matched, as \s+ would take it.
+    """
+
+    def __init__(self, name, regex, strict_regex):
+        super(StrictRegexFormat, self).__init__(name, regex)
+        self.strict_regex = re.compile(strict_regex)
+
+    def check_format_line(self, line):
+        return RegexFormat.match(self, line)
+
+    def match(self, line):
+        match_result = self.strict_regex.match(line)
+        if match_result:
+            self.matched = match_result.groupdict()
+            return match_result
+        return RegexFormat.match(self, line)
+
 class W3cExtendedFormat(RegexFormat):
 
     FIELDS_LINE_PREFIX = '#Fields: '
@@ -375,16 +474,39 @@ _ICECAST2_LOG_FORMAT = ( _NCSA_EXTENDED_LOG_FORMAT +
     '\s+(?P<session_time>\S+)'
 )
 
+# Geo fields which Icecast setups with a geo lookup prefix to the user agent,
+# separated by ':', by number of fields including the user agent itself.
+USER_AGENT_GEO_FIELDS = {
+    6: ('country_code', 'country', 'city', 'latitude', 'longitude'),
+    7: ('country_code', 'country', 'city', 'latitude', 'longitude', 'organization'),
+    9: ('country_code', 'country', 'city', 'latitude', 'longitude', 'region', 'region_name', 'organization'),
+}
+USER_AGENT_GEO_ATTRIBUTES = (
+    'country_code', 'country', 'city', 'latitude', 'longitude', 'region', 'region_name', 'organization',
+)
+
+# Strict versions of the above formats, see StrictRegexFormat.
+_COMMON_LOG_FORMAT_STRICT = (
+    '(?P<ip>\S+) \S+ \S+ \[(?P<date>\S*) (?P<timezone>[^\s\]]*)\] '
+    '"\S+ (?P<path>[^\s"](?:[^"\n]*[^\s"])?) [^\s"]+" (?P<status>\S+) (?P<length>\S+)'
+)
+_NCSA_EXTENDED_LOG_FORMAT_STRICT = (_COMMON_LOG_FORMAT_STRICT +
+    ' "(?P<referrer>[^"\n]*)" "(?P<user_agent>[^"\n]*)"'
+)
+_ICECAST2_LOG_FORMAT_STRICT = (_NCSA_EXTENDED_LOG_FORMAT_STRICT +
+    ' (?P<session_time>\S+)'
+)
+
 FORMATS = {
-    'common': RegexFormat('common', _COMMON_LOG_FORMAT),
+    'common': StrictRegexFormat('common', _COMMON_LOG_FORMAT, _COMMON_LOG_FORMAT_STRICT),
     'common_vhost': RegexFormat('common_vhost', _HOST_PREFIX + _COMMON_LOG_FORMAT),
-    'ncsa_extended': RegexFormat('ncsa_extended', _NCSA_EXTENDED_LOG_FORMAT),
+    'ncsa_extended': StrictRegexFormat('ncsa_extended', _NCSA_EXTENDED_LOG_FORMAT, _NCSA_EXTENDED_LOG_FORMAT_STRICT),
     'common_complete': RegexFormat('common_complete', _HOST_PREFIX + _NCSA_EXTENDED_LOG_FORMAT),
     'w3c_extended': W3cExtendedFormat(),
     'amazon_cloudfront': AmazonCloudFrontFormat(),
     'iis': IisFormat(),
     's3': RegexFormat('s3', _S3_LOG_FORMAT),
-    'icecast2': RegexFormat('icecast2', _ICECAST2_LOG_FORMAT),
+    'icecast2': StrictRegexFormat('icecast2', _ICECAST2_LOG_FORMAT, _ICECAST2_LOG_FORMAT_STRICT),
     'nginx_json': JsonFormat('nginx_json'),
 }
 
@@ -435,6 +557,13 @@ class Configuration(object):
             action='store_true', default=os.isatty(sys.stdout.fileno()),
             help="Print a progress report X seconds (default: 1, use --show-progress-delay to override)"
         )
+        option_parser.add_option(
+            '--timings', dest='timings',
+            action='store_true', default=False,
+            help="Time each stage of the import (reading, decoding, regex matching, filtering and date "
+            "parsing of log lines, waiting for room in the recorder queues, executing and committing SQL) "
+            "and print their 50th, 95th and 99th percentiles in the summary"
+        )
         option_parser.add_option(
             '--show-progress-delay', dest='show_progress_delay',
             type='int', default=1,
@@ -511,6 +640,10 @@ class Configuration(object):
             help="User agents to exclude (in addition to the standard excluded "
             "user agents). Can be specified multiple times",
         )
+        option_parser.add_option(
+            '--useragent-exclude-from', dest='exclude_useragent_from',
+            help="Each line from this file is a user agent to exclude"
+        )
         option_parser.add_option(
             '--enable-static', dest='enable_static',
             action='store_true', default=False,
@@ -521,6 +654,14 @@ class Configuration(object):
             action='store_true', default=False,
             help="Track bots. All bot visits will have a Custom Variable set with name='Bot' and value='$Bot_user_agent_here$'"
         )
+        option_parser.add_option(
+            '--geoip-database', dest='geoip_database', default=None,
+            help="Fill the country, city, location, region and organization of hits from a local IP "
+            "database: a MaxMind .mmdb file (requires the maxminddb module), or a CSV file with a header, "
+            "the IP ranges in a network (CIDR) or start_ip and end_ip columns, and any of the columns "
+            "country_code, country, city, latitude, longitude, region, region_name and organization. "
+            "Hits whose user agent is prefixed with geo fields keep them"
+        )
         option_parser.add_option(
             '--enable-http-errors', dest='enable_http_errors',
             action='store_true', default=False,
@@ -570,16 +711,199 @@ class Configuration(object):
             '--skip', dest='skip', default=0, type='int',
             help="Skip the n first lines to start parsing/importing data at a given line for the specified log file",
         )
+        option_parser.add_option(
+            '--resume', dest='resume', default=False, action='store_true',
+            help="Store the position of the last recorded line of each log file in the import_checkpoint "
+            "table (see my.sql), in the same transaction as the recorded hits, and start parsing each file "
+            "from its last checkpoint. Uncompressed files are resumed instantly, compressed files are "
+            "decompressed up to the checkpoint but not parsed. Implies --on-duplicate=ignore, as hits "
+            "recorded after the last checkpoint may be recorded again"
+        )
+        option_parser.add_option(
+            '--follow', dest='follow', default=False, action='store_true',
+            help="Keep running and import lines as they are appended to the log files, like tail -F. "
+            "Log rotation (renaming or truncation) is detected and the new file is followed. "
+            "Uncompressed log files only, and --log-format-name or --log-format-regex is required. "
+            "Stop with Ctrl-C or SIGTERM"
+        )
+        option_parser.add_option(
+            '--follow-interval', dest='follow_interval', default=DEFAULT_FOLLOW_INTERVAL, type='float',
+            help="With --follow, number of seconds to wait for new lines at the end of a log file (default: %default)"
+        )
+        option_parser.add_option(
+            '--follow-flush-interval', dest='follow_flush_interval', default=DEFAULT_FOLLOW_FLUSH_INTERVAL, type='float',
+            help="With --follow, maximum number of seconds parsed hits wait before being sent to the recorders, "
+            "even if there are less than --recorder-max-payload-size of them (default: %default)"
+        )
+        option_parser.add_option(
+            '--follow-state-file', dest='follow_state_file', default=None,
+            help="With --follow, file where the position in each followed log file is saved, so that "
+            "following resumes where it stopped when the script is restarted"
+        )
+        option_parser.add_option(
+            '--import-processes', dest='import_processes', default=1, type='int',
+            help="Number of log files imported at once, each by a separate process with its own "
+            "--recorders (default: %default). Larger files are imported first. --skip then applies "
+            "to each file"
+        )
+        option_parser.add_option(
+            '--parse-workers', dest='parse_workers', default=1, type='int',
+            help="Number of processes parsing each uncompressed log file (default: %default). The file is "
+            "split in chunks of --parse-chunk-size bytes which are parsed in parallel and recorded in order, "
+            "so hits of a visitor are still recorded in the order they were logged"
+        )
+        option_parser.add_option(
+            '--parse-chunk-size', dest='parse_chunk_size', default=DEFAULT_PARSE_CHUNK_SIZE, type='int',
+            help="With --parse-workers, size in bytes of the chunks parsed by each process (default: %default)"
+        )
         option_parser.add_option(
             '--recorders', dest='recorders', default=1, type='int',
             help="Number of simultaneous recorders (default: %default). "
             "It should be set to the number of CPU cores in your server. "
             "You can also experiment with higher values which may increase performance until a certain point",
         )
+        option_parser.add_option(
+            '--recorder-target-latency', dest='recorder_target_latency', default=None, type='float',
+            help="Adapt the number of hits each recorder inserts in one transaction so that committing "
+            "it takes about this number of seconds. The size grows while transactions are faster and "
+            "is halved when one is slower, between --recorder-min-batch-size and --recorder-max-batch-size, "
+            "starting from --recorder-max-payload-size. Not used with --bulk-load"
+        )
+        option_parser.add_option(
+            '--recorder-min-batch-size', dest='recorder_min_batch_size',
+            default=DEFAULT_RECORDER_MIN_BATCH_SIZE, type='int',
+            help="With --recorder-target-latency, minimum number of hits per transaction (default: %default)"
+        )
+        option_parser.add_option(
+            '--recorder-max-batch-size', dest='recorder_max_batch_size',
+            default=DEFAULT_RECORDER_MAX_BATCH_SIZE, type='int',
+            help="With --recorder-target-latency, maximum number of hits per transaction (default: %default)"
+        )
+        option_parser.add_option(
+            '--recorder-queue-high-watermark', dest='recorder_queue_high_watermark',
+            default=DEFAULT_RECORDER_QUEUE_HIGH_WATERMARK, type='int',
+            help="Number of hits waiting in the queue of a recorder at which parsing pauses (default: %default)"
+        )
+        option_parser.add_option(
+            '--recorder-queue-low-watermark', dest='recorder_queue_low_watermark', default=None, type='int',
+            help="Number of hits waiting in the queue of a recorder at which parsing resumes "
+            "(default: half of --recorder-queue-high-watermark)"
+        )
+        option_parser.add_option(
+            '--recorder-shard-key', dest='recorder_shard_key', default='visitor', type='choice',
+            choices=['visitor', 'ip-ua-path', 'round-robin'],
+            help="How hits are spread between the recorders: 'visitor' sends all hits of a visitor IP (or "
+            "replayed visitor ID) to the same recorder, 'ip-ua-path' all hits of a visitor with the same user "
+            "agent and path, e.g. an Icecast listener of a mount, and 'round-robin' spreads hits evenly, "
+            "when the order in which hits are recorded does not matter (default: %default). A warning is "
+            "logged when a single key gets more hits than a recorder should"
+        )
+        option_parser.add_option(
+            '--recorders-max', dest='recorders_max', default=None, type='int',
+            help="Add and remove recorders while importing, between --recorders and this number. A recorder "
+            "is added while the recorder queues fill up, and one is removed when they are empty or when "
+            "recording a hit becomes %d times slower than the fastest rate seen, which means the database "
+            "is overloaded. A visitor keeps its recorder until its visit ends, so its hits are still "
+            "recorded in order" % RECORDER_LATENCY_OVERLOAD_FACTOR
+        )
+        option_parser.add_option(
+            '--recorders-scale-interval', dest='recorders_scale_interval',
+            default=DEFAULT_RECORDERS_SCALE_INTERVAL, type='float',
+            help="With --recorders-max, number of seconds between two changes of the number of "
+            "recorders (default: %default)"
+        )
         option_parser.add_option(
             '--recorder-max-payload-size', dest='recorder_max_payload_size', default=200, type='int',
             help="Maximum number of log entries to record in one tracking request (default: %default). "
         )
+        option_parser.add_option(
+            '--dead-letter-file', dest='dead_letter_file', default=None,
+            help="Append the rows which cannot be recorded to this file, one JSON object per line with "
+            "the error, instead of logging them and losing them. A whole batch, or bulk load file, "
+            "is written to it if its transaction fails. --resume and --follow-state-file move past "
+            "these rows: record them with --replay-dead-letters"
+        )
+        option_parser.add_option(
+            '--replay-dead-letters', dest='replay_dead_letters', default=False, action='store_true',
+            help="Record the rows of --dead-letter-file again instead of importing log files, e.g. once "
+            "the database is fixed. Rows failing again are written to a new --dead-letter-file"
+        )
+        option_parser.add_option(
+            '--sink', dest='sink', default='mysql', type='choice', choices=sorted(SINKS),
+            help="Where hits are recorded: 'mysql' inserts them into a MySQL database, 'sqlite' into a "
+            "local SQLite database (--sqlite-path), 'export' writes them to compressed columnar files "
+            "(--export-dir) and 'null' discards them, to measure parsing alone "
+            "(default: %default, 'null' with --dry-run)"
+        )
+        option_parser.add_option(
+            '--db-host', dest='db_host', default='localhost',
+            help="MySQL server host (default: %default)"
+        )
+        option_parser.add_option(
+            '--db-name', dest='db_name', default='icestat',
+            help="MySQL database name (default: %default)"
+        )
+        option_parser.add_option(
+            '--db-user', dest='db_user', default='root',
+            help="MySQL user (default: %default)"
+        )
+        option_parser.add_option(
+            '--db-password', dest='db_password', default='',
+            help="MySQL password (default: empty)"
+        )
+        option_parser.add_option(
+            '--sqlite-path', dest='sqlite_path', default='icestat.sqlite',
+            help="With --sink=sqlite, path of the SQLite database, created if needed (default: %default)"
+        )
+        option_parser.add_option(
+            '--export-dir', dest='export_dir', default='export',
+            help="With --sink=export, directory where shards are written, in date=YYYY-MM-DD/path=PATH "
+            "subdirectories (default: %default)"
+        )
+        option_parser.add_option(
+            '--export-format', dest='export_format', default='auto', type='choice',
+            choices=['auto', 'parquet', 'csv'],
+            help="With --sink=export, format of the shards: 'parquet' requires pyarrow, 'csv' writes gzipped "
+            "CSV files with a header, and 'auto' uses Parquet when pyarrow is installed (default: %default)"
+        )
+        option_parser.add_option(
+            '--export-shard-size', dest='export_shard_size', default=DEFAULT_EXPORT_SHARD_SIZE, type='int',
+            help="With --sink=export, size in bytes after which a new shard is started (default: %default)"
+        )
+        option_parser.add_option(
+            '--db-pool-size', dest='db_pool_size', default=None, type='int',
+            help="Maximum number of database connections kept open and shared by the recorders "
+            "(default: the number of --recorders)"
+        )
+        option_parser.add_option(
+            '--db-idle-timeout', dest='db_idle_timeout', default=DEFAULT_DB_IDLE_TIMEOUT, type='int',
+            help="Close and reopen pooled database connections that have been idle for more than "
+            "this number of seconds (default: %default)"
+        )
+        option_parser.add_option(
+            '--db-max-statement-size', dest='db_max_statement_size', default=DEFAULT_DB_MAX_STATEMENT_SIZE, type='int',
+            help="Maximum size in bytes of one multi-row INSERT statement. Must be lower than the "
+            "max_allowed_packet setting of the MySQL server (default: %default)"
+        )
+        option_parser.add_option(
+            '--on-duplicate', dest='on_duplicate', default='error', type='choice',
+            choices=['error', 'ignore', 'update'],
+            help="What to do with hits that were already imported: 'error' reports each duplicate row, "
+            "'ignore' skips them and 'update' overwrites them (default: %default). "
+            "With 'ignore' and 'update', rows also get a file_id column identifying the log file "
+            "(a hash of its first lines, up to the first log entry), so a file can safely be imported again after a failure. "
+            "See my.sql for the required table changes"
+        )
+        option_parser.add_option(
+            '--bulk-load', dest='bulk_load', default=False, action='store_true',
+            help="Write hits to temporary tab separated files (in $TMPDIR) and import them with "
+            "LOAD DATA LOCAL INFILE instead of INSERT statements. Much faster for large imports; "
+            "requires local_infile to be enabled on the MySQL server"
+        )
+        option_parser.add_option(
+            '--bulk-load-rows', dest='bulk_load_rows', default=DEFAULT_BULK_LOAD_ROWS, type='int',
+            help="With --bulk-load, number of rows each recorder loads at once (default: %default)"
+        )
         option_parser.add_option(
             '--replay-tracking', dest='replay_tracking',
             action='store_true', default=False,
@@ -727,7 +1051,7 @@ class Configuration(object):
         if self.options.output:
             sys.stdout = sys.stderr = open(self.options.output, 'a+', 0)
 
-        if not self.filenames:
+        if not self.filenames and not self.options.replay_dead_letters:
             print(option_parser.format_help())
             sys.exit(1)
 
@@ -737,6 +1061,9 @@ class Configuration(object):
             level=logging.DEBUG if self.options.debug >= 1 else logging.INFO,
         )
 
+        if self.options.exclude_useragent_from:
+            user_agents = [user_agent.strip() for user_agent in open(self.options.exclude_useragent_from).readlines()]
+            self.options.excluded_useragents.extend(user_agent for user_agent in user_agents if len(user_agent) > 0)
         self.options.excluded_useragents = set([s.lower() for s in self.options.excluded_useragents])
 
         if self.options.exclude_path_from:
@@ -795,6 +1122,67 @@ class Configuration(object):
         if self.options.recorders < 1:
             self.options.recorders = 1
 
+        if self.options.dry_run:
+            self.options.sink = 'null'
+
+        if self.options.replay_dead_letters and not self.options.dead_letter_file:
+            fatal_error('--replay-dead-letters requires --dead-letter-file')
+
+        if SINKS[self.options.sink].isolates_rows and not self.options.dead_letter_file:
+            logging.warning('The rows which the database refuses are only logged, and lost: '
+                            'use --dead-letter-file to keep them.')
+
+        if self.options.bulk_load and not SINKS[self.options.sink].supports_bulk_load:
+            logging.info("--bulk-load is only supported by --sink=mysql, hits will be inserted in batches.")
+            self.options.bulk_load = False
+
+        if self.options.resume and not SINKS[self.options.sink].supports_checkpoints:
+            logging.info("--resume is only supported by --sink=mysql and --sink=sqlite, log files will be "
+                         "imported from the start.")
+            self.options.resume = False
+
+        if self.options.recorders_max is not None and self.options.recorders_max <= self.options.recorders:
+            self.options.recorders_max = None
+
+        if self.options.recorder_target_latency is not None:
+            if self.options.bulk_load:
+                logging.info("--recorder-target-latency does not apply to --bulk-load, which loads "
+                             "--bulk-load-rows rows at once.")
+                self.options.recorder_target_latency = None
+            elif self.options.recorder_target_latency <= 0:
+                fatal_error('--recorder-target-latency must be a positive number of seconds')
+            self.options.recorder_min_batch_size = max(self.options.recorder_min_batch_size, 1)
+            self.options.recorder_max_batch_size = max(
+                self.options.recorder_max_batch_size, self.options.recorder_min_batch_size)
+
+        if self.options.recorder_queue_high_watermark < 1:
+            self.options.recorder_queue_high_watermark = 1
+        if (self.options.recorder_queue_low_watermark is None or
+                self.options.recorder_queue_low_watermark > self.options.recorder_queue_high_watermark):
+            self.options.recorder_queue_low_watermark = self.options.recorder_queue_high_watermark / 2
+
+        if self.options.follow and self.format is None:
+            fatal_error('--follow requires --log-format-name or --log-format-regex, as the format '
+                        'of an empty log file cannot be detected')
+
+        if self.options.resume and self.options.on_duplicate == 'error':
+            self.options.on_duplicate = 'ignore'
+
+        if self.options.on_duplicate != 'error' and '-' in self.filenames:
+            logging.info("WARNING: logs read from stdin have no file identity, --on-duplicate=%s "
+                         "cannot detect lines that were already imported from stdin." % self.options.on_duplicate)
+
+        if self.options.geoip_database and not os.path.exists(self.options.geoip_database):
+            fatal_error('--geoip-database %s does not exist' % self.options.geoip_database)
+
+        if self.options.parse_workers > 1 and self.options.skip:
+            logging.info("--skip counts lines across the whole import, log files will be parsed by a single "
+                         "process. Use --resume to restart an import with --parse-workers.")
+            self.options.parse_workers = 1
+
+        if self.options.db_pool_size is None or self.options.db_pool_size < 1:
+            self.options.db_pool_size = self.options.recorders_max or self.options.recorders
+
         if self.options.download_extensions:
             self.options.download_extensions = set(self.options.download_extensions.split(','))
         else:
@@ -829,8 +1217,9 @@ class Statistics(object):
             self.value = self.counter.next()
 
         def advance(self, n):
-            for i in range(n):
-                self.increment()
+            if n > 0:
+                # islice consumes the n values without releasing the GIL.
+                self.value = next(itertools.islice(self.counter, n - 1, n))
 
         def __str__(self):
             return str(int(self.value))
@@ -864,11 +1253,105 @@ class Statistics(object):
         self.count_lines_downloads = self.Counter()
         # Ignored downloads when --download-extensions is used
         self.count_lines_skipped_downloads = self.Counter()
+        # IPs found in the --geoip-database.
+        self.count_lines_geolocated = self.Counter()
+
+        # Rows skipped by --on-duplicate=ignore as they were already imported.
+        self.count_lines_duplicate = self.Counter()
+        # Rows the sink failed to write, lost or in the --dead-letter-file.
+        self.count_lines_rejected = self.Counter()
+
+        # Milliseconds the parser waited for room in the recorder queues.
+        self.count_backpressure_ms = self.Counter()
+
+        # Database connections reused from the pool / newly opened.
+        self.count_db_pool_hits = self.Counter()
+        self.count_db_pool_misses = self.Counter()
+
+        # --timings: the {stage: Histogram} of each thread, and of other
+        # processes once merged.
+        self.timings = []
+        self.timings_lock = threading.Lock()
+        self.thread_timings = threading.local()
 
         # Misc
         self.dates_recorded = set()
         self.monitor_stop = False
 
+    def get_counters(self):
+        """
+        Return the values of all counters, by attribute name.
+        """
+        return dict(
+            (name, counter.value) for name, counter in vars(self).iteritems()
+            if isinstance(counter, self.Counter)
+        )
+
+    def add_counters(self, counters):
+        """
+        Add counter values returned by get_counters(), e.g. by another process.
+        """
+        for name, value in counters.iteritems():
+            getattr(self, name).advance(value)
+
+    def record_timing(self, stage, seconds):
+        """
+        Add the duration of a stage to the --timings histograms. Each thread
+        has its own histograms, so that no lock is taken.
+        """
+        try:
+            histograms = self.thread_timings.histograms
+        except AttributeError:
+            histograms = self.thread_timings.histograms = {}
+            with self.timings_lock:
+                self.timings.append(histograms)
+
+        histogram = histograms.get(stage)
+        if histogram is None:
+            histogram = histograms[stage] = Histogram()
+        histogram.add(seconds)
+
+    def get_timings(self):
+        """
+        Return the --timings histograms of all threads merged, by stage.
+        """
+        merged = {}
+        with self.timings_lock:
+            timings = list(self.timings)
+        for histograms in timings:
+            for stage, histogram in histograms.items():
+                merged.setdefault(stage, Histogram()).merge(histogram)
+        return merged
+
+    def add_timings(self, timings):
+        """
+        Add histograms returned by get_timings(), e.g. by another process.
+        """
+        with self.timings_lock:
+            self.timings.append(timings)
+
+    def snapshot(self):
+        """
+        Return the counters, timings and collected sites and dates, to be
+        merged into the statistics of another process.
+        """
+        return {
+            'counters': self.get_counters(),
+            'timings': self.get_timings(),
+            'piwik_sites': self.piwik_sites,
+            'piwik_sites_created': self.piwik_sites_created,
+            'piwik_sites_ignored': self.piwik_sites_ignored,
+            'dates_recorded': self.dates_recorded,
+        }
+
+    def merge(self, snapshot):
+        self.add_counters(snapshot['counters'])
+        self.add_timings(snapshot['timings'])
+        self.piwik_sites.update(snapshot['piwik_sites'])
+        self.piwik_sites_created.extend(snapshot['piwik_sites_created'])
+        self.piwik_sites_ignored.update(snapshot['piwik_sites_ignored'])
+        self.dates_recorded.update(snapshot['dates_recorded'])
+
     def set_time_start(self):
         self.time_start = time.time()
 
@@ -907,7 +1390,10 @@ Logs import summary
 -------------------
 
     %(count_lines_recorded)d requests imported successfully
+    %(count_lines_duplicate)d requests were already imported
+    %(count_lines_rejected)d requests could not be recorded%(dead_letter_file)s
     %(count_lines_downloads)d requests were downloads
+    %(count_lines_geolocated)d requests were located with --geoip-database
     %(total_lines_ignored)d requests ignored:
         %(count_lines_skipped_http_errors)d HTTP errors
         %(count_lines_skipped_http_redirects)d HTTP redirects
@@ -934,7 +1420,8 @@ Performance summary
 
     Total time: %(total_time)d seconds
     Requests imported per second: %(speed_recording)s requests per second
-
+    Time spent waiting for the recorders to catch up: %(backpressure_time).1f seconds
+%(db_pool_summary)s%(recorders_summary)s%(timings_summary)s
 Processing your log data
 ------------------------
 
@@ -944,6 +1431,10 @@ Processing your log data
 
     'count_lines_recorded': self.count_lines_recorded.value,
     'count_lines_downloads': self.count_lines_downloads.value,
+    'count_lines_geolocated': self.count_lines_geolocated.value,
+    'count_lines_duplicate': self.count_lines_duplicate.value,
+    'count_lines_rejected': self.count_lines_rejected.value,
+    'dead_letter_file': ' (written to %s)' % config.options.dead_letter_file if config.options.dead_letter_file else '',
     'total_lines_ignored': sum([
             self.count_lines_invalid.value,
             self.count_lines_skipped_user_agent.value,
@@ -991,15 +1482,66 @@ Processing your log data
             self.count_lines_recorded.value,
             self.time_start, self.time_stop,
         )),
+    'backpressure_time': self.count_backpressure_ms.value / 1000.0,
+    'db_pool_summary': self._db_pool_summary(),
+    'recorders_summary': self._recorders_summary(),
+    'timings_summary': self._timings_summary(),
     'url': config.options.piwik_url
 }
 
+    def _db_pool_summary(self):
+        """
+        Return how many pooled database connections were reused and opened,
+        if the sink pools connections.
+        """
+        if not self.count_db_pool_hits.value and not self.count_db_pool_misses.value:
+            return ''
+        return '    Database connections: %d reused, %d opened\n' % (
+            self.count_db_pool_hits.value, self.count_db_pool_misses.value)
+
+    def _recorders_summary(self):
+        """
+        Return the requests imported by each recorder, to show how evenly
+        they are spread by --recorder-shard-key.
+        """
+        if len(Recorder.recorders) <= 1:
+            return ''
+        return '    Requests imported per recorder:\n%s\n' % self._indent_text(
+            ['%d: %d requests, %s requests per second' % (
+                recorder.index, recorder.count_hits_recorded.value,
+                self._round_value(self._compute_speed(
+                    recorder.count_hits_recorded.value, self.time_start, self.time_stop,
+                )),
+            ) for recorder in Recorder.recorders],
+            level=2,
+        )
+
+    def _timings_summary(self):
+        """
+        Return the percentiles of the duration of each stage, with --timings.
+        """
+        timings = self.get_timings()
+        if not timings:
+            return ''
+        stages = [stage for stage in TIMING_STAGES if stage in timings]
+        stages.extend(sorted(stage for stage in timings if stage not in TIMING_STAGES))
+        return '    Time per stage, in milliseconds (--timings):\n%s\n' % self._indent_text(
+            ['%s: %d times, %.3f seconds in total, p50 %.3f, p95 %.3f, p99 %.3f' % (
+                stage, timings[stage].count, timings[stage].total,
+                timings[stage].percentile(50) * 1000,
+                timings[stage].percentile(95) * 1000,
+                timings[stage].percentile(99) * 1000,
+            ) for stage in stages],
+            level=2,
+        )
+
     ##
     ## The monitor is a thread that prints a short summary each second.
     ##
 
     def _monitor(self):
         latest_total_recorded = 0
+        latest_recorded_by_recorder = {}
         while not self.monitor_stop:
             current_total = stats.count_lines_recorded.value
             time_elapsed = time.time() - self.time_start
@@ -1010,6 +1552,26 @@ Processing your log data
                 (current_total - latest_total_recorded) / config.options.show_progress_delay,
             )
             latest_total_recorded = current_total
+
+            adaptive = config.options.recorder_target_latency is not None
+            if Recorder.recorders and (len(Recorder.recorders) > 1 or adaptive):
+                queued = []
+                speeds = []
+                batch_sizes = []
+                for recorder in Recorder.recorders:
+                    recorded = recorder.count_hits_recorded.value
+                    queued.append(str(recorder.get_queue_depth()))
+                    speeds.append(str(
+                        (recorded - latest_recorded_by_recorder.get(recorder, 0)) / config.options.show_progress_delay
+                    ))
+                    latest_recorded_by_recorder[recorder] = recorded
+                    if recorder.batch_size is not None:
+                        batch_sizes.append(str(recorder.batch_size.size))
+                print '    recorders: %s hits queued, %s records/sec (current)%s' % (
+                    ', '.join(queued), ', '.join(speeds),
+                    ', %s hits per transaction' % ', '.join(batch_sizes) if batch_sizes else '',
+                )
+
             time.sleep(config.options.show_progress_delay)
 
     def start_monitor(self):
@@ -1021,264 +1583,2417 @@ Processing your log data
         self.monitor_stop = True
 
 
-class Recorder(object):
-    """
-    A Recorder fetches hits from the Queue and inserts them into database.
+class DatabasePool(object):
     """
+    Keeps long-lived database connections so that recorders don't pay a
+    connection handshake for every batch of hits.
 
-    recorders = []
+    At most `size` connections are checked out at the same time. Connections
+    idle for more than `idle_timeout` seconds are closed and reopened, and
+    connections idle for more than DB_HEALTH_CHECK_INTERVAL seconds are
+    pinged before being handed out.
+    """
 
-    db_host = 'localhost'
-    db_name = 'icestat'
-    db_user = 'root'
-    db_pass = ''
+    def __init__(self, connect, size, idle_timeout):
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self.semaphore = threading.BoundedSemaphore(size)
+        # (connection, time of last use), most recently used last.
+        self.idle = []
+        self.lock = threading.Lock()
 
+    def acquire(self):
+        """
+        Return an open connection, reusing an idle one when possible.
+        """
+        self.semaphore.acquire()
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    connection, last_used = self.idle.pop()
+
+                idle_time = time.time() - last_used
+                if idle_time > self.idle_timeout:
+                    self._close(connection)
+                    continue
+                if idle_time > DB_HEALTH_CHECK_INTERVAL:
+                    try:
+                        connection.ping()
+                    except mdb.Error:
+                        logging.debug('Dropping dead pooled database connection')
+                        self._close(connection)
+                        continue
 
-    def __init__(self):
-        self.queue = Queue.Queue(maxsize=2)
+                stats.count_db_pool_hits.increment()
+                return connection
 
-        # if bulk tracking disabled, make sure we can store hits outside of the Queue
-        if not config.options.use_bulk_tracking:
-            self.unrecorded_hits = []
+            stats.count_db_pool_misses.increment()
+            return self.connect()
+        except:
+            self.semaphore.release()
+            raise
 
-    @classmethod
-    def launch(cls, recorder_count):
+    def release(self, connection, broken=False):
         """
-        Launch a bunch of Recorder objects in a separate thread.
+        Give a connection back to the pool. Broken connections are closed
+        instead of being reused.
         """
-        for i in xrange(recorder_count):
-            recorder = Recorder()
-            cls.recorders.append(recorder)
-
-            run = recorder._run_bulk if config.options.use_bulk_tracking else recorder._run_single
-            t = threading.Thread(target=run)
-
-            t.daemon = True
-            t.start()
-            logging.debug('Launched recorder')
+        try:
+            if broken:
+                self._close(connection)
+            else:
+                with self.lock:
+                    self.idle.append((connection, time.time()))
+        finally:
+            self.semaphore.release()
 
-    @classmethod
-    def add_hits(cls, all_hits):
+    @staticmethod
+    def is_connection_error(error):
         """
-        Add a set of hits to the recorders queue.
+        Return True if a database error means the connection itself is unusable.
         """
-        # Organize hits so that one client IP will always use the same queue.
-        # We have to do this so visits from the same IP will be added in the right order.
-        hits_by_client = [[] for r in cls.recorders]
-        for hit in all_hits:
-            hits_by_client[hit.get_visitor_id_hash() % len(cls.recorders)].append(hit)
+        return isinstance(error, mdb.OperationalError) and bool(error.args) and error.args[0] in DB_CONNECTION_ERRORS
 
-        for i, recorder in enumerate(cls.recorders):
-            recorder.queue.put(hits_by_client[i])
+    @staticmethod
+    def is_row_error(error):
+        """
+        Return True if a database error is caused by the values of a row.
+        """
+        return bool(error.args) and error.args[0] in DB_ROW_ERRORS
 
-    @classmethod
-    def wait_empty(cls):
+    @staticmethod
+    def is_transaction_error(error):
         """
-        Wait until all recorders have an empty queue.
+        Return True if a database error rolled back the whole transaction,
+        which should be retried.
         """
-        for recorder in cls.recorders:
-            recorder._wait_empty()
+        return bool(error.args) and error.args[0] in DB_TRANSACTION_ERRORS
 
-    def _run_bulk(self):
-        while True:
-            hits = self.queue.get()
-            if len(hits) > 0:
-                try:
-                    self._record_hits(hits)
-                except Exception, e:
-                    fatal_error(e, hits[0].filename, hits[0].lineno) # approximate location of error
-            self.queue.task_done()
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, last_used in idle:
+            self._close(connection)
 
-    def _run_single(self):
-        while True:
-            if config.options.force_one_action_interval != False:
-                time.sleep(config.options.force_one_action_interval)
+    def _close(self, connection):
+        try:
+            connection.close()
+        except mdb.Error:
+            pass
 
-            if len(self.unrecorded_hits) > 0:
-                hit = self.unrecorded_hits.pop(0)
 
-                try:
-                    self._record_hits([hit])
-                except Exception, e:
-                    fatal_error(e, hit.filename, hit.lineno)
-            else:
-                self.unrecorded_hits = self.queue.get()
-                self.queue.task_done()
+class BulkLoadFile(object):
+    """
+    A temporary tab separated file of rows, escaped the way LOAD DATA INFILE
+    expects: backslash escapes for special characters and \\N for NULL.
+    """
 
-    def _wait_empty(self):
-        """
-        Wait until the queue is empty.
-        """
-        while True:
-            if self.queue.empty():
-                # We still have to wait for the last queue item being processed
-                # (queue.empty() returns True before queue.task_done() is
-                # called).
-                self.queue.join()
-                return
-            time.sleep(1)
+    def __init__(self):
+        self.file = tempfile.NamedTemporaryFile(prefix='import_logs_', suffix='.tsv', delete=False)
+        self.path = self.file.name
+        self.rows = 0
+        # Number of hits the rows were built from.
+        self.hits = 0
+        # Pending resume point entries of these hits, see ResumePoints.detach().
+        self.resume_counts = []
+        # Resume points written when the file is loaded, by file id.
+        self.checkpoints = {}
 
-    def date_to_piwik(self, date):
-        date, time = date.isoformat(sep=' ').split()
-        return '%s %s' % (date, time.replace('-', ':'))
+    @staticmethod
+    def escape(value):
+        if value is None:
+            return '\\N'
+        if value is True:
+            return '1'
+        if value is False:
+            return '0'
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat(' ')
+        elif isinstance(value, unicode):
+            value = value.encode('utf8')
+        else:
+            value = str(value)
+        return (value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+                     .replace('\r', '\\r').replace('\0', '\\0'))
 
+    @staticmethod
+    def unescape(value):
+        if value == '\\N':
+            return None
+        return BULK_LOAD_UNESCAPE_REGEX.sub(
+            lambda match: BULK_LOAD_UNESCAPES[match.group(1)], value).decode('utf8')
 
-    def _record_hits(self, hits):
-        """
-        Inserts several hits into database.
+    def write_row(self, row):
+        self.file.write('\t'.join([self.escape(value) for value in row]) + '\n')
+        self.rows += 1
+
+    def read_rows(self):
         """
-        self.connection = mdb.connect(
-            host=self.db_host, user=self.db_user, passwd=self.db_pass,
-            db=self.db_name, charset='utf8')
-
-        sql = """
-            INSERT INTO statistics_access (ip, filename, is_download, session_time,
-                is_redirect, event_category, event_action, lineno, status,
-                is_error, event_name, date, session_start_date, path,
-                extension, referrer, userid, length, user_agent,
-                generation_time_milli, query_string, is_robot, full_path,
-                country_code, country, city, latitude, longitude,
-                region, region_name, organization)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s, %s)
+        Read back the rows of a closed file. Values are unicode strings, or
+        None for NULL.
         """
-        try:
-            c = self.connection.cursor()
-            for hit in hits:
-                if hit.session_time > 0:
-                    hit.session_start_date = hit.date - timedelta(
-                        seconds=hit.session_time)
-                    user_info = hit.user_agent.split(":")
-                    hit.country_code = ''
-                    hit.country = ''
-                    hit.city = ''
-                    hit.latitude = ''
-                    hit.longitude = ''
-                    hit.region = ''
-                    hit.region_name = ''
-                    hit.organization = ''
-                    if len(user_info) == 1:
-                        hit.user_agent = user_info[0]
-                    elif len(user_info) == 6:
-                        hit.country_code = user_info[0]
-                        hit.country = user_info[1]
-                        hit.city = user_info[2]
-                        hit.latitude = user_info[3]
-                        hit.longitude = user_info[4]
-                        hit.user_agent = user_info[5]
-                    elif len(user_info) == 7:
-                        hit.country_code = user_info[0]
-                        hit.country = user_info[1]
-                        hit.city = user_info[2]
-                        hit.latitude = user_info[3]
-                        hit.longitude = user_info[4]
-                        hit.organization = user_info[5]
-                        hit.user_agent = user_info[6]
-                    elif len(user_info) == 9:
-                        hit.country_code = user_info[0]
-                        hit.country = user_info[1]
-                        hit.city = user_info[2]
-                        hit.latitude = user_info[3]
-                        hit.longitude = user_info[4]
-                        hit.region = user_info[5]
-                        hit.region_name = user_info[6]
-                        hit.organization = user_info[7]
-                        hit.user_agent = user_info[8]
-                    try:
-                        c.execute(sql, (hit.ip, hit.filename, hit.is_download,
-                                        hit.session_time, hit.is_redirect,
-                                        hit.event_category, hit.event_action,
-                                        hit.lineno, hit.status, hit.is_error,
-                                        hit.event_name, hit.date,
-                                        hit.session_start_date, hit.path,
-                                        hit.extension, hit.referrer,
-                                        hit.userid, hit.length, hit.user_agent,
-                                        hit.generation_time_milli,
-                                        hit.query_string, hit.is_robot,
-                                        hit.full_path, hit.country_code,
-                                        hit.country, hit.city, hit.latitude,
-                                        hit.longitude, hit.region,
-                                        hit.region_name, hit.organization))
-                    except Exception, e:
-                        print e
-        except Exception, e:
-            print e
-        self.connection.commit()
-        self.connection.close()
-        stats.count_lines_recorded.advance(len(hits))
+        with open(self.path) as file:
+            for line in file:
+                yield tuple(self.unescape(value) for value in line[:-1].split('\t'))
 
-    def _is_json(self, result):
-        try:
-            json.loads(result)
-            return True
-        except ValueError, e:
-            return False
+    def close(self):
+        self.file.close()
 
-    def _on_tracking_failure(self, response, data):
-        """
-        Removes the successfully tracked hits from the request payload so
-        they are not logged twice.
-        """
+    def remove(self):
+        self.file.close()
         try:
-            response = json.loads(response)
-        except:
-            # the response should be in JSON, but in case it can't be parsed just try another attempt
-            logging.debug("cannot parse tracker response, should be valid JSON")
-            return response
+            os.remove(self.path)
+        except OSError:
+            pass
 
-        # remove the successfully tracked hits from payload
-        tracked = response['tracked']
-        data['requests'] = data['requests'][tracked:]
 
-        return response['message']
+class DeadLetterFile(object):
+    """
+    Rows which could not be recorded (--dead-letter-file), one JSON object
+    per line holding the columns, the row and the error, so that they can be
+    recorded again with --replay-dead-letters.
+    """
 
+    # columns holding datetimes, written as 'YYYY-MM-DD HH:MM:SS'
+    date_columns = ('date', 'session_start_date')
 
-class Hit(object):
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def encode(value):
+        if isinstance(value, datetime.datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        if isinstance(value, str):
+            return value.decode('utf-8', 'replace')
+        return value
+
+    def write(self, columns, rows, error):
+        lines = [
+            json.dumps({
+                'columns': columns,
+                'row': [self.encode(value) for value in row],
+                'error': unicode(error),
+            }) + '\n'
+            for row in rows
+        ]
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a')
+            self.file.writelines(lines)
+            self.file.flush()
+
+    @classmethod
+    def read(cls, path):
+        """
+        Yield the (columns, row) of the rows of a dead letter file.
+        """
+        for line in open(path):
+            if not line.strip():
+                continue
+            dead_letter = json.loads(line)
+            columns = tuple(dead_letter['columns'])
+            row = dead_letter['row']
+            for i, column in enumerate(columns[:len(row)]):
+                if column in cls.date_columns and row[i] is not None:
+                    row[i] = datetime.datetime.strptime(row[i], '%Y-%m-%d %H:%M:%S')
+            yield columns, tuple(row)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class Sink(object):
     """
-    It's a simple container.
+    Where the recorders write the rows of hits (--sink). Rows hold the values
+    of `columns`, in this order. Several recorder threads use a sink at once.
+    Sinks implement write(), and load_file() if they support --bulk-load.
     """
-    def __init__(self, **kwargs):
-        for key, value in kwargs.iteritems():
-            setattr(self, key, value)
-        super(Hit, self).__init__()
-
-        if config.options.force_lowercase_path:
-            self.full_path = self.full_path.lower()
 
-    def get_visitor_id_hash(self):
-        visitor_id = self.ip
+    __metaclass__ = abc.ABCMeta
 
-        if config.options.replay_tracking:
-            for param_name_to_use in ['uid', 'cid', '_id', 'cip']:
-                if param_name_to_use in self.args:
-                    visitor_id = self.args[param_name_to_use]
-                    break
+    # whether rows can be written with load_file() (--bulk-load)
+    supports_bulk_load = False
+    # whether write() stores the checkpoints used by --resume
+    supports_checkpoints = False
+    # whether write() rejects the rows refused by the database, and writes
+    # the others
+    isolates_rows = False
 
-        return abs(hash(visitor_id))
+    def __init__(self, columns, dead_letters=None):
+        self.columns = columns
+        self.dead_letters = dead_letters
+        # rows rejected by each thread, see rejected_count()
+        self.rejected = threading.local()
 
-    def add_page_custom_var(self, key, value):
+    def reject(self, rows, error):
         """
-        Adds a page custom variable to this Hit.
+        Handles rows which could not be written: they are appended to the
+        dead letter file if there is one, else they are logged with the
+        error and lost.
+        """
+        stats.count_lines_rejected.advance(len(rows))
+        self.rejected.count = self.rejected_count() + len(rows)
+        if self.dead_letters is None:
+            for row in rows:
+                logging.warning('Could not record %r: %s', row, error)
+        else:
+            self.dead_letters.write(self.columns, rows, error)
+
+    def rejected_count(self):
+        """
+        Returns the number of rows rejected so far by the calling thread, to
+        tell the rows of a write() which were rejected from those written.
+        """
+        return getattr(self.rejected, 'count', 0)
+
+    @abc.abstractmethod
+    def write(self, rows, checkpoints, recorder_index):
+        """
+        Writes rows, and with --resume the checkpoints (the resume point of
+        log files, by file ID, see ResumePoints), in one transaction. Returns
+        the number of rows written.
+        """
+
+    def load_file(self, bulk_load_file, recorder_index):
+        """
+        Writes the rows of a BulkLoadFile and the checkpoints it holds.
+        Returns the number of rows written. By default, the rows are read
+        back from the file and written with write().
+        """
+        return self.write(list(bulk_load_file.read_rows()), bulk_load_file.checkpoints, recorder_index)
+
+    def get_checkpoint(self, file_id):
+        """
+        Returns the (byte offset, line number) checkpointed for a log file,
+        or None.
+        """
+        return None
+
+    def close(self):
+        pass
+
+
+class NullSink(Sink):
+    """
+    Discards the rows, to measure parsing alone. Used by --dry-run.
+    """
+
+    def write(self, rows, checkpoints, recorder_index):
+        return len(rows)
+
+
+class MySQLSink(Sink):
+    """
+    Inserts the rows into the statistics_access table of a MySQL database,
+    with connections pooled between the recorders.
+    """
+
+    supports_bulk_load = True
+    supports_checkpoints = True
+    isolates_rows = True
+
+    def __init__(self, columns, dead_letters=None):
+        super(MySQLSink, self).__init__(columns, dead_letters)
+
+        global mdb
+        try:
+            import MySQLdb as mdb
+        except ImportError:
+            fatal_error('MySQLdb (http://pypi.python.org/pypi/MySQL-python/) is required by --sink=mysql')
+
+        self.pool = DatabasePool(
+            self.connect, config.options.db_pool_size, config.options.db_idle_timeout,
+        )
+
+    def connect(self):
+        """
+        Open a new database connection.
+        """
+        return mdb.connect(
+            host=config.options.db_host, user=config.options.db_user, passwd=config.options.db_password,
+            db=config.options.db_name, charset='utf8', local_infile=int(config.options.bulk_load))
+
+    def write(self, rows, checkpoints, recorder_index):
+        def write(connection):
+            # rejected rows are handled once committed, as the transaction
+            # may be retried
+            rejected = []
+            inserted = self._insert_rows(connection, rows, rejected)
+            self._write_checkpoints(connection, checkpoints)
+            return inserted, rejected
+
+        result = self._write(write, rows)
+        if result is None:
+            return 0
+        inserted, rejected = result
+        for row, error in rejected:
+            self.reject([row], error)
+        return inserted
+
+    def load_file(self, bulk_load_file, recorder_index):
+        sql = (
+            "LOAD DATA LOCAL INFILE %%s %sINTO TABLE statistics_access CHARACTER SET utf8 "
+            "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' (%s)"
+        ) % ('REPLACE ' if config.options.on_duplicate == 'update' else 'IGNORE ', ', '.join(self.columns))
+
+        def load(connection):
+            cursor = connection.cursor()
+            cursor.execute(sql, (bulk_load_file.path,))
+            self._write_checkpoints(connection, bulk_load_file.checkpoints)
+            return cursor.rowcount
+
+        return self._write(load)
+
+    def get_checkpoint(self, file_id):
+        connection = self.pool.acquire()
+        broken = True
+        try:
+            cursor = connection.cursor()
+            cursor.execute(
+                'SELECT `offset`, lineno FROM import_checkpoint WHERE file_id = %s', (file_id,))
+            row = cursor.fetchone()
+            broken = False
+        finally:
+            self.pool.release(connection, broken=broken)
+        if row is None:
+            return None
+        return int(row[0]), int(row[1])
+
+    def close(self):
+        """
+        Close the pooled database connections.
+        """
+        self.pool.close_all()
+
+    def _write(self, write, rows=None):
+        """
+        Calls write(connection) and commits. The transaction is retried on a
+        fresh connection if the connection is lost, and right away if InnoDB
+        rolled it back on a deadlock or a lock wait timeout. The connection
+        is given back to the pool whatever happens, and closed if anything
+        failed.
+
+        A connection lost during the commit is ambiguous: the server may
+        have committed the transaction. It is only written again with
+        --on-duplicate=ignore or update, where the rows can't be stored twice.
+        Otherwise, or if the commit fails for another reason, the rows are
+        rejected and None is returned. Without rows, the error is raised.
+        """
+        attempts = 0
+        while True:
+            connection = self.pool.acquire()
+            broken = True
+            committing = False
+            try:
+                time_start = time.time()
+                result = write(connection)
+                time_executed = time.time()
+                committing = True
+                connection.commit()
+                if config.options.timings:
+                    stats.record_timing('execute', time_executed - time_start)
+                    stats.record_timing('commit', time.time() - time_executed)
+                broken = False
+                return result
+            except mdb.Error, e:
+                error = e
+                if DatabasePool.is_transaction_error(e):
+                    pass
+                elif DatabasePool.is_connection_error(e) and (
+                        not committing or config.options.on_duplicate != 'error'):
+                    pass
+                elif committing and rows is not None:
+                    self.reject(rows, e)
+                    return None
+                else:
+                    raise
+            finally:
+                self.pool.release(connection, broken=broken)
+
+            attempts += 1
+            if attempts >= config.options.max_attempts:
+                raise error
+            if DatabasePool.is_transaction_error(error):
+                logging.debug('Transaction rolled back: %s, retrying', error)
+                continue
+            logging.info('Database error: %s, retrying in %d seconds', error, config.options.delay_after_failure)
+            time.sleep(config.options.delay_after_failure)
+
+    def _write_checkpoints(self, connection, checkpoints):
+        """
+        With --resume, stores the resume point of log files. Recorders commit
+        in any order, so a checkpoint never moves back.
+        """
+        if not config.options.resume or not checkpoints:
+            return
+
+        cursor = connection.cursor()
+        cursor.executemany(
+            'INSERT INTO import_checkpoint (file_id, filename, `offset`, lineno) '
+            'VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE '
+            'filename = IF(VALUES(`offset`) > `offset`, VALUES(filename), filename), '
+            'lineno = IF(VALUES(`offset`) > `offset`, VALUES(lineno), lineno), '
+            '`offset` = GREATEST(`offset`, VALUES(`offset`))',
+            [(file_id, hit.filename, hit.offset, hit.lineno)
+             for file_id, hit in checkpoints.iteritems()]
+        )
+
+    def _insert_rows(self, connection, rows, rejected):
+        """
+        Inserts rows using multi-row INSERT statements of at most
+        --db-max-statement-size bytes. Offending rows are rejected, as
+        (row, error) in `rejected`.
+
+        Returns the number of rows the server reported as affected.
+        """
+        cursor = connection.cursor()
+        insert, suffix = self._insert_statement()
+        affected = 0
+
+        for group in self._group_values(connection, rows, len(insert) + len(suffix)):
+            affected += self._insert_group(cursor, insert, suffix, group, rejected)
+        return affected
+
+    def _insert_group(self, cursor, insert, suffix, group, rejected):
+        """
+        Inserts a group of (row, value) with one statement. If it fails, each
+        half is inserted the same way, so that k offending rows among n cost
+        about 2k log2(n) statements, and the other rows are still inserted
+        by many at once. A failed InnoDB statement inserts none of its rows.
+
+        Only errors caused by the values of a row are handled this way: other
+        errors, like a deadlock which rolls back the whole transaction, are
+        raised so that the whole batch is written again or rejected.
+        """
+        try:
+            cursor.execute(insert + ','.join(value for row, value in group) + suffix)
+            return cursor.rowcount
+        except mdb.Error, e:
+            if not DatabasePool.is_row_error(e):
+                raise
+            if len(group) == 1:
+                rejected.append((group[0][0], e))
+                return 0
+
+        middle = len(group) / 2
+        return (self._insert_group(cursor, insert, suffix, group[:middle], rejected) +
+                self._insert_group(cursor, insert, suffix, group[middle:], rejected))
+
+    def _insert_statement(self):
+        """
+        Returns the beginning and the end of the INSERT statement to surround
+        the VALUES with, according to --on-duplicate.
+        """
+        on_duplicate = config.options.on_duplicate
+        insert = 'INSERT %sINTO statistics_access (%s) VALUES ' % (
+            'IGNORE ' if on_duplicate == 'ignore' else '', ', '.join(self.columns))
+        suffix = ''
+        if on_duplicate == 'update':
+            suffix = ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+                '%s = VALUES(%s)' % (column, column) for column in self.columns
+                if column not in ('file_id', 'lineno'))
+        return insert, suffix
+
+    def _group_values(self, connection, rows, prefix_size):
+        """
+        Escapes the rows and yields lists of (row, '(...)' value tuple), each
+        list fitting in a single statement.
+        """
+        max_size = config.options.db_max_statement_size
+        group = []
+        size = prefix_size
+        for row in rows:
+            value = '(%s)' % ','.join(connection.literal(row))
+            if group and size + len(value) + 1 > max_size:
+                yield group
+                group = []
+                size = prefix_size
+            group.append((row, value))
+            size += len(value) + 1
+        if group:
+            yield group
+
+
+
+class SQLiteSink(Sink):
+    """
+    Inserts the rows into the statistics_access table of a local SQLite
+    database (--sqlite-path), created if needed, for imports without a
+    database server. The database is in WAL mode and each batch of hits is
+    written in one transaction; recorders take turns as SQLite has a single
+    writer.
+    """
+
+    supports_checkpoints = True
+    isolates_rows = True
+
+    def __init__(self, columns, dead_letters=None):
+        super(SQLiteSink, self).__init__(columns, dead_letters)
+
+        global sqlite3
+        import sqlite3
+
+        self.lock = threading.Lock()
+        # transactions are started explicitly, to roll back to a savepoint
+        self.connection = sqlite3.connect(config.options.sqlite_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self._create_tables()
+
+        insert = {'error': 'INSERT', 'ignore': 'INSERT OR IGNORE', 'update': 'INSERT OR REPLACE'}
+        self.insert = '%s INTO statistics_access (%s) VALUES (%s)' % (
+            insert[config.options.on_duplicate], ', '.join(self.columns), ', '.join('?' for column in self.columns))
+
+    def _create_tables(self):
+        with self.lock:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS statistics_access (%s)' % ', '.join(self.columns))
+            existing = set(row[1] for row in self.connection.execute('PRAGMA table_info(statistics_access)'))
+            for column in self.columns:
+                if column not in existing:
+                    self.connection.execute('ALTER TABLE statistics_access ADD COLUMN %s' % column)
+            if 'file_id' in self.columns:
+                self.connection.execute(
+                    'CREATE UNIQUE INDEX IF NOT EXISTS unique_file_line ON statistics_access (file_id, lineno)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS import_checkpoint (file_id PRIMARY KEY, filename, offset, lineno)')
+
+    def write(self, rows, checkpoints, recorder_index):
+        rejected = []
+        with self.lock:
+            connection = self.connection
+            time_start = time.time()
+            connection.execute('BEGIN')
+            try:
+                inserted = self._insert_rows(rows, rejected)
+
+                if config.options.resume and checkpoints:
+                    # checkpoints never move back, see MySQLSink._write_checkpoints()
+                    connection.executemany(
+                        'INSERT OR IGNORE INTO import_checkpoint (file_id, filename, offset, lineno) '
+                        'VALUES (?, ?, -1, -1)',
+                        [(file_id, hit.filename) for file_id, hit in checkpoints.iteritems()]
+                    )
+                    connection.executemany(
+                        'UPDATE import_checkpoint SET filename = ?, offset = ?, lineno = ? '
+                        'WHERE file_id = ? AND offset < ?',
+                        [(hit.filename, hit.offset, hit.lineno, file_id, hit.offset)
+                         for file_id, hit in checkpoints.iteritems()]
+                    )
+                time_executed = time.time()
+                connection.execute('COMMIT')
+            except:
+                connection.execute('ROLLBACK')
+                raise
+            if config.options.timings:
+                stats.record_timing('execute', time_executed - time_start)
+                stats.record_timing('commit', time.time() - time_executed)
+
+        for row, error in rejected:
+            self.reject([row], error)
+        return inserted
+
+    def _insert_rows(self, rows, rejected):
+        """
+        Inserts rows with executemany(). If it fails, the rows are rolled
+        back and each half is inserted the same way, until the offending
+        rows are isolated and rejected, as (row, error) in `rejected`.
+        Operational errors, like a locked or full database, aren't caused by
+        the rows and are raised.
+
+        Returns the number of rows inserted.
+        """
+        connection = self.connection
+        connection.execute('SAVEPOINT rows')
+        changes = connection.total_changes
+        try:
+            connection.executemany(self.insert, rows)
+        except sqlite3.OperationalError:
+            raise
+        except sqlite3.Error, e:
+            connection.execute('ROLLBACK TO rows')
+            connection.execute('RELEASE rows')
+            if len(rows) == 1:
+                rejected.append((rows[0], e))
+                return 0
+            middle = len(rows) / 2
+            return self._insert_rows(rows[:middle], rejected) + self._insert_rows(rows[middle:], rejected)
+
+        inserted = connection.total_changes - changes
+        connection.execute('RELEASE rows')
+        return inserted
+
+    def get_checkpoint(self, file_id):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT offset, lineno FROM import_checkpoint WHERE file_id = ?', (file_id,)).fetchone()
+        if row is None:
+            return None
+        return int(row[0]), int(row[1])
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class CsvShard(object):
+    """
+    A gzipped CSV file of exported rows, with a header line.
+    """
+
+    extension = '.csv.gz'
+
+    def __init__(self, path, columns):
+        self.file = open(path, 'wb')
+        self.gzip_file = gzip.GzipFile(fileobj=self.file, mode='wb')
+        self.writer = csv.writer(self.gzip_file)
+        self.writer.writerow(columns)
+
+    @staticmethod
+    def encode(value):
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return int(value)
+        if isinstance(value, datetime.datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+    def write_rows(self, rows):
+        encode = self.encode
+        self.writer.writerows([[encode(value) for value in row] for row in rows])
+
+    def size(self):
+        """
+        Return the number of compressed bytes written so far.
+        """
+        return self.file.tell()
+
+    def close(self):
+        self.gzip_file.close()
+        self.file.close()
+
+class ParquetShard(object):
+    """
+    A Parquet file of exported rows. Rows are buffered and written by row
+    groups of EXPORT_PARQUET_ROW_GROUP_SIZE rows.
+    """
+
+    extension = '.parquet'
+
+    def __init__(self, path, columns):
+        self.file = open(path, 'wb')
+        self.columns = columns
+        self.types = [self.column_type(column) for column in columns]
+        self.schema = pa.schema([pa.field(column, type) for column, type in zip(columns, self.types)])
+        self.writer = pq.ParquetWriter(self.file, self.schema, compression='snappy')
+        self.rows = []
+
+    @staticmethod
+    def column_type(column):
+        if column in ('date', 'session_start_date'):
+            return pa.timestamp('s')
+        if column in ('session_time', 'lineno', 'length'):
+            return pa.int64()
+        if column == 'generation_time_milli':
+            return pa.float64()
+        if column in ('is_download', 'is_redirect', 'is_error', 'is_robot'):
+            return pa.bool_()
+        return pa.string()
+
+    def write_rows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= EXPORT_PARQUET_ROW_GROUP_SIZE:
+            self._write_row_group()
+
+    def _write_row_group(self):
+        if not self.rows:
+            return
+        arrays = []
+        for i, type in enumerate(self.types):
+            values = [row[i] for row in self.rows]
+            if type == pa.string():
+                values = [value if value is None or isinstance(value, unicode) else unicode(value)
+                          for value in values]
+            elif type in (pa.int64(), pa.float64()):
+                values = [None if value in (None, '') else value for value in values]
+            arrays.append(pa.array(values, type=type))
+        self.writer.write_table(pa.Table.from_arrays(arrays, names=list(self.columns)))
+        self.rows = []
+
+    def size(self):
+        """
+        Return the number of bytes written so far, buffered rows excluded.
+        """
+        return self.file.tell()
+
+    def close(self):
+        self._write_row_group()
+        self.writer.close()
+        self.file.close()
+
+class ExportSink(Sink):
+    """
+    Writes the rows to compressed columnar files (--export-dir), for reports
+    which would otherwise scan the statistics_access table.
+
+    Files are partitioned by date and path (the Icecast mount), in
+    date=YYYY-MM-DD/path=PATH directories. Each recorder writes its own
+    shards, so recorders don't wait for each other. A shard is closed once
+    it reaches --export-shard-size bytes, and each recorder keeps at most
+    EXPORT_MAX_OPEN_SHARDS shards open, closing the least recently used one,
+    so memory stays bounded however many days and mounts are exported.
+    """
+
+    def __init__(self, columns, dead_letters=None):
+        super(ExportSink, self).__init__(columns, dead_letters)
+
+        export_format = config.options.export_format
+        if export_format != 'csv':
+            global pa, pq
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                export_format = 'parquet'
+            except ImportError:
+                if export_format == 'parquet':
+                    fatal_error('pyarrow (https://pypi.python.org/pypi/pyarrow) is required by --export-format=parquet')
+                export_format = 'csv'
+        self.shard_class = ParquetShard if export_format == 'parquet' else CsvShard
+
+        self.directory = config.options.export_dir
+        self.date_index = columns.index('date')
+        self.path_index = columns.index('path')
+        self.lock = threading.Lock()
+        # recorder index: OrderedDict of partition: shard, least recently used first
+        self.shards = {}
+        self.shard_count = itertools.count()
+
+    def write(self, rows, checkpoints, recorder_index):
+        with self.lock:
+            shards = self.shards.setdefault(recorder_index, collections.OrderedDict())
+
+        rows_by_partition = collections.defaultdict(list)
+        for row in rows:
+            rows_by_partition[(row[self.date_index].date(), row[self.path_index])].append(row)
+
+        for partition, partition_rows in rows_by_partition.iteritems():
+            shard = shards.pop(partition, None)
+            if shard is None:
+                if len(shards) >= EXPORT_MAX_OPEN_SHARDS:
+                    shards.popitem(last=False)[1].close()
+                shard = self._open_shard(partition, recorder_index)
+            shard.write_rows(partition_rows)
+            if shard.size() >= config.options.export_shard_size:
+                shard.close()
+            else:
+                shards[partition] = shard
+        return len(rows)
+
+    def _open_shard(self, partition, recorder_index):
+        date, path = partition
+        path = (path or '').lstrip('/')
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        directory = os.path.join(
+            self.directory, 'date=%s' % date.isoformat(), 'path=%s' % urllib.quote(path, safe=''),
+        )
+        with self.lock:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            number = next(self.shard_count)
+
+        filename = 'part-%d-%d-%05d%s' % (os.getpid(), recorder_index, number, self.shard_class.extension)
+        return self.shard_class(os.path.join(directory, filename), self.columns)
+
+    def close(self):
+        with self.lock:
+            for shards in self.shards.itervalues():
+                for shard in shards.itervalues():
+                    shard.close()
+            self.shards = {}
+
+
+SINKS = {
+    'mysql': MySQLSink,
+    'sqlite': SQLiteSink,
+    'export': ExportSink,
+    'null': NullSink,
+}
+
+
+class BatchSizeController(object):
+    """
+    Adapt the number of hits inserted in one transaction to a target commit
+    latency (--recorder-target-latency): the size grows additively while
+    transactions are faster than the target, and is halved when one is
+    slower (AIMD).
+    """
+
+    def __init__(self, size, min_size, max_size, target_latency):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = min(max(size, min_size), max_size)
+        self.step = min_size
+        self.target_latency = target_latency
+
+    def update(self, hit_count, latency):
+        """
+        Adapt the size after hit_count hits were committed in latency seconds.
+        """
+        if latency > self.target_latency:
+            self.size = max(self.size / 2, self.min_size)
+        elif hit_count >= self.size:
+            # only a full batch tells that a larger one would be fast enough
+            self.size = min(self.size + self.step, self.max_size)
+
+class HitQueue(object):
+    """
+    The queue of batches of hits of a recorder, bounded by the number of
+    hits it holds rather than by the number of batches.
+
+    Once it holds high_watermark hits, put() blocks until the recorder has
+    brought it down to low_watermark, so the parser resumes with room for
+    several batches instead of waking up for each one.
+    """
+
+    def __init__(self, high_watermark, low_watermark):
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.batches = collections.deque()
+        self.size = 0           # hits in the queue
+        self.unfinished = 0     # batches put and not marked as done
+        self.full = False
+        self.closed = False
+
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.all_done = threading.Condition(self.lock)
+
+    def put(self, hits):
+        """
+        Add a batch of hits. Return the number of seconds spent waiting for
+        the queue to drain.
+        """
+        with self.lock:
+            blocked = 0
+            if self.full:
+                start = time.time()
+                while self.full:
+                    self.not_full.wait()
+                blocked = time.time() - start
+
+            self.batches.append(hits)
+            self.size += len(hits)
+            self.unfinished += 1
+            if self.size >= self.high_watermark:
+                self.full = True
+            self.not_empty.notify()
+            return blocked
+
+    def get(self):
+        """
+        Remove and return the oldest batch, waiting for one if needed.
+        Return None once the queue is closed and empty.
+        """
+        batches = self.get_batches()
+        return batches[0] if batches else None
+
+    def get_batches(self, max_hits=0):
+        """
+        Remove and return the oldest batch, waiting for one if needed, and
+        the following batches as long as they total at most max_hits hits.
+        Return an empty list once the queue is closed and empty.
+        """
+        with self.lock:
+            while not self.batches:
+                if self.closed:
+                    return []
+                self.not_empty.wait()
+
+            batches = [self.batches.popleft()]
+            hit_count = len(batches[0])
+            while self.batches and hit_count + len(self.batches[0]) <= max_hits:
+                batches.append(self.batches.popleft())
+                hit_count += len(batches[-1])
+
+            self.size -= hit_count
+            if self.full and self.size <= self.low_watermark:
+                self.full = False
+                self.not_full.notify_all()
+            return batches
+
+    def task_done(self, count=1):
+        """
+        Mark batches returned by get() or get_batches() as processed.
+        """
+        with self.lock:
+            self.unfinished -= count
+            if self.unfinished == 0:
+                self.all_done.notify_all()
+
+    def join(self):
+        """
+        Wait until all batches are processed.
+        """
+        with self.lock:
+            while self.unfinished:
+                self.all_done.wait()
+
+    def close(self):
+        """
+        Let the consumer return once the queued batches are processed.
+        """
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+
+    def idle(self):
+        return self.unfinished == 0
+
+
+class ResumePoints(object):
+    """
+    The last hit of each log file such that it and all the hits before it are
+    recorded, where --resume and --follow start again.
+
+    The hits of a log file are spread between recorders which commit them at
+    their own pace, so the last hit committed by one recorder doesn't mean
+    the hits before it, sent to the others, are recorded. Each batch of hits
+    given to Recorder.add_hits() makes a pending entry per log file counting
+    its hits not recorded yet, and the resume point of a file only moves past
+    an entry once it and all the entries before it are recorded. Rejected
+    hits count as recorded, as they are kept in the dead letter file.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # file id: deque of pending entries [hits not recorded, last hit, file id]
+        self.pending = {}
+        # file id: resume point
+        self.points = {}
+        # resume points which moved since they were last written to the sink
+        self.moved = {}
+
+    def add(self, hits):
+        """
+        Make a pending entry for the hits of each log file, which must come
+        in the order of the file.
+        """
+        with self.lock:
+            entries = {}
+            for hit in hits:
+                if hit.file_id is None:
+                    continue
+                entry = entries.get(hit.file_id)
+                if entry is None:
+                    entry = entries[hit.file_id] = [0, None, hit.file_id]
+                    self.pending.setdefault(hit.file_id, collections.deque()).append(entry)
+                entry[0] += 1
+                entry[1] = hit
+                hit.resume_entry = entry
+
+    @staticmethod
+    def detach(hits):
+        """
+        Return the pending entries of hits as [entry, number of hits], to
+        release() once the hits are recorded.
+        """
+        counts = {}
+        for hit in hits:
+            entry = hit.resume_entry
+            if entry is not None:
+                hit.resume_entry = None
+                count = counts.get(id(entry))
+                if count is None:
+                    counts[id(entry)] = [entry, 1]
+                else:
+                    count[1] += 1
+        return counts.values()
+
+    def release(self, counts):
+        """
+        Count the hits of entries returned by detach() as recorded, and move
+        the resume points past the entries which are all recorded.
+        """
+        with self.lock:
+            file_ids = set()
+            for entry, count in counts:
+                entry[0] -= count
+                file_ids.add(entry[2])
+            for file_id in file_ids:
+                pending = self.pending[file_id]
+                while pending and pending[0][0] == 0:
+                    self.points[file_id] = self.moved[file_id] = pending.popleft()[1]
+                if not pending:
+                    del self.pending[file_id]
+
+    def get(self, file_id):
+        """
+        Return the resume point of a log file, or None.
+        """
+        with self.lock:
+            return self.points.get(file_id)
+
+    def take(self):
+        """
+        Return the resume points which moved since they were last taken, by
+        file id, to write to the sink.
+        """
+        with self.lock:
+            moved, self.moved = self.moved, {}
+        return moved
+
+    def give_back(self, points):
+        """
+        Give back resume points taken but not written, unless they moved again.
+        """
+        with self.lock:
+            for file_id, hit in points.iteritems():
+                self.moved.setdefault(file_id, hit)
+
+
+class Recorder(object):
+    """
+    A Recorder fetches hits from the Queue and inserts them into database.
+    """
+
+    recorders = []
+    sink = None
+    dead_letters = None
+    # adds and removes recorders with --recorders-max
+    scaler = None
+
+    # shard keys counted to find those overloading a recorder
+    heavy_hitters = None
+    heavy_hitters_reported = set()
+    # recorder receiving the next hit with --recorder-shard-key=round-robin
+    next_recorder = 0
+    # position in each log file up to which all hits are recorded
+    resume_points = ResumePoints()
+    # serializes add_hits(), called by a thread per file with --follow
+    add_hits_lock = threading.Lock()
+
+
+    def __init__(self, index):
+        self.index = index
+        self.queue = HitQueue(
+            config.options.recorder_queue_high_watermark, config.options.recorder_queue_low_watermark,
+        )
+
+        self.batch_size = None
+        if config.options.recorder_target_latency is not None:
+            self.batch_size = BatchSizeController(
+                config.options.recorder_max_payload_size, config.options.recorder_min_batch_size,
+                config.options.recorder_max_batch_size, config.options.recorder_target_latency,
+            )
+
+        # hits sent to / recorded by this recorder, to show sharding skew
+        self.count_hits_queued = Statistics.Counter()
+        self.count_hits_recorded = Statistics.Counter()
+        # moving average of the seconds spent recording one hit
+        self.hit_latency = None
+        # a retiring recorder gets no new visitors, and stops once the
+        # visits it records are over
+        self.retiring = False
+
+        # idempotent imports identify rows by source file and line number
+        self.with_file_id = config.options.on_duplicate != 'error'
+
+        # rows waiting to be imported with --bulk-load
+        self.bulk_load_file = None
+        self.bulk_load_lock = threading.Lock()
+
+    @classmethod
+    def launch(cls, recorder_count):
+        """
+        Launch a bunch of Recorder objects in a separate thread.
+        """
+        cls.recorders = []
+        if config.options.dead_letter_file:
+            cls.dead_letters = DeadLetterFile(config.options.dead_letter_file)
+        cls.sink = SINKS[config.options.sink](cls.get_columns(), cls.dead_letters)
+
+        cls.heavy_hitters = None
+        cls.heavy_hitters_reported = set()
+        max_count = config.options.recorders_max or recorder_count
+        if max_count > 1 and config.options.recorder_shard_key != 'round-robin':
+            cls.heavy_hitters = HeavyHitters(HEAVY_HITTERS_SIZE)
+
+        cls.scaler = None
+        if config.options.recorders_max:
+            cls.scaler = RecorderScaler(
+                recorder_count, config.options.recorders_max, config.options.recorders_scale_interval,
+            )
+
+        for i in xrange(recorder_count):
+            cls.start_recorder()
+
+    @classmethod
+    def get_columns(cls):
+        """
+        Return the columns of the rows written to the sink.
+        """
+        if config.options.on_duplicate != 'error':
+            # idempotent imports identify rows by source file and line number
+            return cls.columns + ('file_id',)
+        return cls.columns
+
+    @classmethod
+    def start_recorder(cls):
+        """
+        Launch a new Recorder in a separate thread. It takes the lowest free
+        index.
+        """
+        indexes = set(recorder.index for recorder in cls.recorders)
+        index = 0
+        while index in indexes:
+            index += 1
+
+        recorder = Recorder(index)
+        cls.recorders.append(recorder)
+
+        run = recorder._run_bulk if config.options.use_bulk_tracking else recorder._run_single
+        recorder.thread = threading.Thread(target=run)
+
+        recorder.thread.daemon = True
+        recorder.thread.start()
+        logging.debug('Launched recorder')
+        return recorder
+
+    @classmethod
+    def stop_recorder(cls, recorder):
+        """
+        Stop a recorder whose queue is processed and which gets no more hits.
+        """
+        if config.options.bulk_load:
+            recorder._flush_bulk_load()
+        cls.recorders.remove(recorder)
+        recorder.queue.close()
+        logging.debug('Stopped recorder')
+
+    @classmethod
+    def add_hits(cls, all_hits):
+        """
+        Add a set of hits to the recorders queue. With --follow, the parser
+        threads of the files add hits concurrently: they are added one set at
+        a time, as the state choosing recorders (next_recorder, heavy_hitters
+        and scaler) isn't thread safe.
+        """
+        with cls.add_hits_lock:
+            cls._add_hits(all_hits)
+
+    @classmethod
+    def _add_hits(cls, all_hits):
+        cls.resume_points.add(all_hits)
+        recorders = list(cls.recorders)
+        scaler = cls.scaler
+        active = [recorder for recorder in recorders if not recorder.retiring]
+        recorder_count = len(active)
+        hits_by_client = dict((recorder, []) for recorder in recorders)
+        shard_key = config.options.recorder_shard_key
+
+        if shard_key == 'round-robin':
+            # Hits of a visitor may be recorded in any order.
+            start = cls.next_recorder
+            for i, hit in enumerate(all_hits):
+                hits_by_client[active[(start + i) % recorder_count]].append(hit)
+            cls.next_recorder = (start + len(all_hits)) % recorder_count
+        else:
+            # Organize hits so that one client will always use the same queue.
+            # We have to do this so visits from the same client will be added in the right order.
+            get_key = Hit.get_visitor_id if shard_key == 'visitor' else Hit.get_visitor_path_key
+            heavy_hitters = cls.heavy_hitters
+            for hit in all_hits:
+                key = get_key(hit)
+                if heavy_hitters is not None:
+                    heavy_hitters.add(key)
+                if scaler is None:
+                    recorder = active[abs(hash(key)) % recorder_count]
+                else:
+                    recorder = scaler.get_recorder(key, hit, active)
+                hits_by_client[recorder].append(hit)
+            if heavy_hitters is not None:
+                cls._report_heavy_hitters()
+
+        for recorder in recorders:
+            hits = hits_by_client[recorder]
+            recorder.count_hits_queued.advance(len(hits))
+            blocked = recorder.queue.put(hits)
+            if blocked:
+                stats.count_backpressure_ms.advance(int(blocked * 1000))
+            if config.options.timings:
+                stats.record_timing('queue_wait', blocked or 0)
+
+        if scaler is not None:
+            scaler.check()
+
+    @classmethod
+    def _report_heavy_hitters(cls):
+        """
+        Warn about the shard keys having more hits than a recorder's share, as
+        the recorder they are sent to is busier than the others.
+        """
+        heavy_hitters = cls.heavy_hitters
+        if heavy_hitters.total < HEAVY_HITTERS_MIN_HITS:
+            return
+
+        for key, count in heavy_hitters.top(1.0 / len(cls.recorders)):
+            if key in cls.heavy_hitters_reported:
+                continue
+            cls.heavy_hitters_reported.add(key)
+            logging.info(
+                'WARNING: %d%% of hits have the shard key %r and are all recorded by the same recorder. '
+                'Use --recorder-shard-key=ip-ua-path, or --recorder-shard-key=round-robin if the order '
+                'of the hits of a visitor does not matter.',
+                100 * count / heavy_hitters.total, key)
+
+    def get_queue_depth(self):
+        """
+        Return the number of hits sent to this recorder and not recorded yet.
+        """
+        return self.count_hits_queued.value - self.count_hits_recorded.value
+
+    @classmethod
+    def wait_empty(cls):
+        """
+        Wait until all recorders have an empty queue.
+        """
+        for recorder in cls.recorders:
+            recorder._wait_empty()
+
+        if config.options.bulk_load:
+            for recorder in cls.recorders:
+                try:
+                    recorder._flush_bulk_load()
+                except Exception, e:
+                    fatal_error(e)
+
+        cls._write_checkpoints()
+
+    @classmethod
+    def _write_checkpoints(cls):
+        """
+        With --resume, write the resume points which moved since the last
+        batch was written, as those of the last hits recorded are only known
+        once their batch is committed.
+        """
+        if not config.options.resume or not cls.sink.supports_checkpoints:
+            return
+        checkpoints = cls.resume_points.take()
+        if checkpoints:
+            try:
+                cls.sink.write([], checkpoints, 0)
+            except Exception, e:
+                fatal_error(e)
+
+    @classmethod
+    def get_checkpoint(cls, file_id):
+        """
+        Return the (byte offset, line number) of the last line of a log file
+        such that all the lines up to it are known to be recorded, or None.
+        """
+        return cls.sink.get_checkpoint(file_id)
+
+    @classmethod
+    def close(cls):
+        """
+        Stop the recorders which recorded all their hits, and close the
+        sink, e.g. the pooled database connections or the exported files.
+        """
+        for recorder in cls.recorders:
+            recorder.queue.close()
+            if recorder.queue.idle():
+                recorder.thread.join()
+
+        if cls.sink is not None:
+            cls.sink.close()
+        if cls.dead_letters is not None:
+            cls.dead_letters.close()
+
+    def _run_bulk(self):
+        while True:
+            batches = self.queue.get_batches(self.batch_size.size if self.batch_size is not None else 0)
+            if not batches:
+                return
+            if len(batches) == 1:
+                hits = batches[0]
+            else:
+                hits = list(itertools.chain.from_iterable(batches))
+
+            start = 0
+            while start < len(hits):
+                end = len(hits) if self.batch_size is None else start + self.batch_size.size
+                batch = hits[start:end]
+                start = end
+                try:
+                    time_start = time.time()
+                    self._record_hits(batch)
+                    if self.batch_size is not None:
+                        self.batch_size.update(len(batch), time.time() - time_start)
+                except Exception, e:
+                    fatal_error(e, batch[0].filename, batch[0].lineno) # approximate location of error
+            self.queue.task_done(len(batches))
+
+    def _run_single(self):
+        while True:
+            hits = self.queue.get()
+            if hits is None:
+                return
+            for hit in hits:
+                if config.options.force_one_action_interval != False:
+                    time.sleep(config.options.force_one_action_interval)
+
+                try:
+                    self._record_hits([hit])
+                except Exception, e:
+                    fatal_error(e, hit.filename, hit.lineno)
+            self.queue.task_done()
+
+    def _wait_empty(self):
+        """
+        Wait until the queued hits are recorded.
+        """
+        self.queue.join()
+
+    def date_to_piwik(self, date):
+        date, time = date.isoformat(sep=' ').split()
+        return '%s %s' % (date, time.replace('-', ':'))
+
+
+    # Columns of the statistics_access table, in the order of the rows built
+    # by _hit_to_row().
+    columns = (
+        'ip', 'filename', 'is_download', 'session_time',
+        'is_redirect', 'event_category', 'event_action', 'lineno', 'status',
+        'is_error', 'event_name', 'date', 'session_start_date', 'path',
+        'extension', 'referrer', 'userid', 'length', 'user_agent',
+        'generation_time_milli', 'query_string', 'is_robot', 'full_path',
+        'country_code', 'country', 'city', 'latitude', 'longitude',
+        'region', 'region_name', 'organization',
+    )
+
+    def _record_hits(self, hits):
+        """
+        Inserts several hits into database.
+        """
+        rows = []
+        invalid = 0
+        for hit in hits:
+            if hit.session_time > 0:
+                try:
+                    row = self._hit_to_row(hit)
+                except Exception, e:
+                    # rejected with the attributes it has, to be kept in
+                    # the dead letter file
+                    self.sink.reject([tuple(getattr(hit, column, None) for column in self.sink.columns)], e)
+                    invalid += 1
+                    continue
+                if self.with_file_id:
+                    row += (hit.file_id,)
+                rows.append(row)
+
+        # the resume points move past these hits once they are recorded
+        resume_counts = ResumePoints.detach(hits)
+        if config.options.bulk_load:
+            self.count_hits_recorded.advance(invalid)
+            self._bulk_load_rows(rows, len(hits) - invalid, resume_counts)
+            return
+
+        # resume points of the hits recorded before, with --resume
+        checkpoints = self.resume_points.take()
+        rejected = self.sink.rejected_count()
+        time_start = time.time()
+        try:
+            inserted = self.sink.write(rows, checkpoints, self.index)
+        except Exception, e:
+            self.resume_points.give_back(checkpoints)
+            if self.dead_letters is None:
+                raise
+            # the rows are only kept in the dead letter file: the resume
+            # points move past them, --replay-dead-letters records them
+            logging.info('WARNING: could not record %d rows (%s), they are written to %s',
+                         len(rows), e, config.options.dead_letter_file)
+            self.sink.reject(rows, e)
+            self.resume_points.release(resume_counts)
+            self.count_hits_recorded.advance(len(hits))
+            return
+        self.resume_points.release(resume_counts)
+        self._measure_latency(len(hits), time.time() - time_start)
+        # rows rejected by the sink are neither recorded nor duplicates
+        rejected = self.sink.rejected_count() - rejected
+        if config.options.on_duplicate == 'ignore':
+            stats.count_lines_duplicate.advance(len(rows) - rejected - inserted)
+        stats.count_lines_recorded.advance(len(hits) - invalid - rejected)
+        self.count_hits_recorded.advance(len(hits))
+
+    def _bulk_load_rows(self, rows, hit_count, resume_counts):
+        """
+        Appends rows to this recorder's bulk load file, and loads the file
+        once it holds --bulk-load-rows rows.
+        """
+        with self.bulk_load_lock:
+            if self.bulk_load_file is None:
+                self.bulk_load_file = BulkLoadFile()
+            for row in rows:
+                self.bulk_load_file.write_row(row)
+            self.bulk_load_file.hits += hit_count
+            self.bulk_load_file.resume_counts.extend(resume_counts)
+
+            if self.bulk_load_file.rows >= config.options.bulk_load_rows:
+                self._load_bulk_load_file()
+
+    def _flush_bulk_load(self):
+        with self.bulk_load_lock:
+            if self.bulk_load_file is not None:
+                self._load_bulk_load_file()
+
+    def _load_bulk_load_file(self):
+        bulk_load_file = self.bulk_load_file
+        # the next rows go to a new file, even if loading this one fails
+        self.bulk_load_file = None
+        bulk_load_file.close()
+        bulk_load_file.checkpoints = self.resume_points.take()
+
+        time_start = time.time()
+        try:
+            loaded = self.sink.load_file(bulk_load_file, self.index)
+        except Exception, e:
+            self.resume_points.give_back(bulk_load_file.checkpoints)
+            if self.dead_letters is None:
+                logging.info('WARNING: the rows which failed to load are kept in %s', bulk_load_file.path)
+                raise
+            # see _record_hits()
+            logging.info('WARNING: could not load %d rows (%s), they are written to %s',
+                         bulk_load_file.rows, e, config.options.dead_letter_file)
+            self.sink.reject(list(bulk_load_file.read_rows()), e)
+            self.resume_points.release(bulk_load_file.resume_counts)
+            self.count_hits_recorded.advance(bulk_load_file.hits)
+            bulk_load_file.remove()
+            return
+        self._measure_latency(bulk_load_file.hits, time.time() - time_start)
+        if config.options.on_duplicate == 'ignore':
+            stats.count_lines_duplicate.advance(bulk_load_file.rows - loaded)
+        elif loaded != bulk_load_file.rows and config.options.on_duplicate == 'error':
+            logging.info('WARNING: %d of %d rows were not loaded by LOAD DATA (duplicates or invalid rows)',
+                         bulk_load_file.rows - loaded, bulk_load_file.rows)
+
+        self.resume_points.release(bulk_load_file.resume_counts)
+        stats.count_lines_recorded.advance(bulk_load_file.hits)
+        self.count_hits_recorded.advance(bulk_load_file.hits)
+        bulk_load_file.remove()
+
+    def _measure_latency(self, hit_count, seconds):
+        if hit_count == 0:
+            return
+        latency = seconds / hit_count
+        if self.hit_latency is None:
+            self.hit_latency = latency
+        else:
+            self.hit_latency = 0.8 * self.hit_latency + 0.2 * latency
+
+    def _hit_to_row(self, hit):
+        hit.session_start_date = hit.date - timedelta(
+            seconds=hit.session_time)
+        return (hit.ip, hit.filename, hit.is_download,
+                hit.session_time, hit.is_redirect,
+                hit.event_category, hit.event_action,
+                hit.lineno, hit.status, hit.is_error,
+                hit.event_name, hit.date,
+                hit.session_start_date, hit.path,
+                hit.extension, hit.referrer,
+                hit.userid, hit.length, hit.user_agent,
+                hit.generation_time_milli,
+                hit.query_string, hit.is_robot,
+                hit.full_path, hit.country_code,
+                hit.country, hit.city, hit.latitude,
+                hit.longitude, hit.region,
+                hit.region_name, hit.organization)
+
+    def _is_json(self, result):
+        try:
+            json.loads(result)
+            return True
+        except ValueError, e:
+            return False
+
+    def _on_tracking_failure(self, response, data):
+        """
+        Removes the successfully tracked hits from the request payload so
+        they are not logged twice.
+        """
+        try:
+            response = json.loads(response)
+        except:
+            # the response should be in JSON, but in case it can't be parsed just try another attempt
+            logging.debug("cannot parse tracker response, should be valid JSON")
+            return response
+
+        # remove the successfully tracked hits from payload
+        tracked = response['tracked']
+        data['requests'] = data['requests'][tracked:]
+
+        return response['message']
+
+
+class RecorderScaler(object):
+    """
+    Add and remove recorders while importing (--recorders-max).
+
+    Every --recorders-scale-interval seconds, a recorder is added if the
+    parser waited for room in the queues, or if they are more than half
+    full. One is retired if the queues are empty, or if recording a hit
+    takes RECORDER_LATENCY_OVERLOAD_FACTOR times longer than the fastest
+    rate seen, as more recorders would only overload the database.
+
+    Visitors keep the recorder they were sent to until their visit ends,
+    i.e. for VISIT_TIMEOUT after their last hit, in log time. A retiring
+    recorder gets no new visitors, and is stopped once its visits are over
+    and its queue is processed.
+
+    The parser threads of --follow use it at the same time: the visits and
+    the recorders are only changed with the lock held.
+    """
+
+    def __init__(self, min_count, max_count, interval):
+        self.lock = threading.Lock()
+        self.min_count = min_count
+        self.max_count = max_count
+        self.interval = interval
+        self.assignments = {}       # shard key: [recorder, date of its last hit]
+        self.latest_date = None     # date of the latest hit sent
+        self.best_latency = None
+        self.last_check = time.time()
+        self.last_backpressure = stats.count_backpressure_ms.value
+
+    def get_recorder(self, key, hit, active):
+        """
+        Return the recorder of the visit of a hit, or assign one among the
+        active recorders to a new visit.
+        """
+        date = hit.date
+        with self.lock:
+            if self.latest_date is None or date > self.latest_date:
+                self.latest_date = date
+
+            assignment = self.assignments.get(key)
+            if assignment is not None and date - assignment[1] <= VISIT_TIMEOUT:
+                if date > assignment[1]:
+                    assignment[1] = date
+                return assignment[0]
+
+            recorder = active[abs(hash(key)) % len(active)]
+            self.assignments[key] = [recorder, date]
+            return recorder
+
+    def check(self):
+        """
+        Change the number of recorders if needed, at most once per interval.
+        """
+        with self.lock:
+            now = time.time()
+            if now - self.last_check < self.interval:
+                return
+            self.last_check = now
+            self._scale()
+
+    def _scale(self):
+        self._expire_visits()
+        busy = set(assignment[0] for assignment in self.assignments.itervalues())
+        for recorder in list(Recorder.recorders):
+            if recorder.retiring and recorder.queue.idle() and recorder not in busy:
+                Recorder.stop_recorder(recorder)
+
+        active = [recorder for recorder in Recorder.recorders if not recorder.retiring]
+        backpressure = stats.count_backpressure_ms.value - self.last_backpressure
+        self.last_backpressure = stats.count_backpressure_ms.value
+        queued = sum(recorder.queue.size for recorder in active)
+        capacity = sum(recorder.queue.high_watermark for recorder in active)
+
+        latencies = [recorder.hit_latency for recorder in active if recorder.hit_latency is not None]
+        latency = max(latencies) if latencies else None
+        if latency is not None and (self.best_latency is None or latency < self.best_latency):
+            self.best_latency = latency
+        overloaded = latency is not None and latency > RECORDER_LATENCY_OVERLOAD_FACTOR * self.best_latency
+
+        if (overloaded or (queued == 0 and not backpressure)) and len(active) > self.min_count:
+            recorder = active[-1]
+            recorder.retiring = True
+            logging.info('Retiring recorder %d (%s), %d recorders left',
+                         recorder.index, 'database overloaded' if overloaded else 'queues empty', len(active) - 1)
+        elif (backpressure or queued * 2 > capacity) and not overloaded and len(active) < self.max_count:
+            retiring = [recorder for recorder in Recorder.recorders if recorder.retiring]
+            if retiring:
+                recorder = retiring[0]
+                recorder.retiring = False
+            else:
+                recorder = Recorder.start_recorder()
+            logging.info('Added recorder %d (queues full), %d recorders', recorder.index, len(active) + 1)
+
+    def _expire_visits(self):
+        if self.latest_date is None:
+            return
+        oldest = self.latest_date - VISIT_TIMEOUT
+        for key, assignment in self.assignments.items():
+            if assignment[1] < oldest:
+                del self.assignments[key]
+
+
+class Hit(object):
+    """
+    It's a simple container. Its attributes are fixed, as millions of hits
+    can be held in the recorder queues. Attributes which are not set, such
+    as host for formats without one, raise AttributeError.
+    """
+    __slots__ = (
+        'filename', 'file_id', 'lineno', 'offset', 'status', 'full_path',
+        'is_download', 'is_robot', 'is_error', 'is_redirect',
+        'path', 'query_string', 'extension', 'referrer', 'user_agent', 'ip', 'length',
+        'generation_time_milli', 'host', 'userid', 'event_category', 'event_action', 'event_name',
+        'session_time', 'date', 'country_code', 'country', 'city', 'latitude', 'longitude',
+        'region', 'region_name', 'organization',
+        # set when recorded
+        'session_start_date',
+        # pending entry of the hit's resume point, see ResumePoints
+        'resume_entry',
+        # replay tracking arguments and custom variables, created when first used
+        '_args',
+    )
+
+    def __init__(self, filename, file_id, lineno, offset, status, full_path):
+        self.filename = filename
+        self.file_id = file_id
+        self.lineno = lineno
+        self.offset = offset
+        self.status = status
+        self.resume_entry = None
+        if config.options.force_lowercase_path:
+            full_path = full_path.lower()
+        self.full_path = full_path
+        self.is_download = self.is_robot = self.is_error = self.is_redirect = False
+        self._args = None
+
+    @property
+    def args(self):
+        if self._args is None:
+            self._args = {}
+        return self._args
+
+    def to_dict(self):
+        """
+        Return the attributes which are set, by name.
+        """
+        attributes = dict(
+            (name, getattr(self, name)) for name in self.__slots__
+            if name not in ('_args', 'resume_entry') and hasattr(self, name)
+        )
+        attributes['args'] = self.args
+        return attributes
+
+    def get_visitor_id(self):
+        visitor_id = self.ip
+
+        if config.options.replay_tracking and self._args:
+            for param_name_to_use in ['uid', 'cid', '_id', 'cip']:
+                if param_name_to_use in self.args:
+                    visitor_id = self.args[param_name_to_use]
+                    break
+
+        return visitor_id
+
+    def get_visitor_id_hash(self):
+        return abs(hash(self.get_visitor_id()))
+
+    def get_visitor_path_key(self):
+        """
+        Return the visitor ID with the user agent and the path, which tell
+        apart the listeners of a relay and the mounts they listen to.
+        """
+        return (self.get_visitor_id(), self.user_agent, self.path)
+
+    def add_page_custom_var(self, key, value):
+        """
+        Adds a page custom variable to this Hit.
         """
         self._add_custom_var(key, value, 'cvar')
 
-    def add_visit_custom_var(self, key, value):
-        """
-        Adds a visit custom variable to this Hit.
-        """
-        self._add_custom_var(key, value, '_cvar')
+    def add_visit_custom_var(self, key, value):
+        """
+        Adds a visit custom variable to this Hit.
+        """
+        self._add_custom_var(key, value, '_cvar')
+
+    def _add_custom_var(self, key, value, api_arg_name):
+        if api_arg_name not in self.args:
+            self.args[api_arg_name] = {}
+
+        if isinstance(self.args[api_arg_name], basestring):
+            logging.debug("Ignoring custom %s variable addition [ %s = %s ], custom var already set to string." % (api_arg_name, key, value))
+            return
+
+        index = len(self.args[api_arg_name]) + 1
+        self.args[api_arg_name][index] = [key, value]
+
+class FileFingerprint(object):
+    """
+    Identifies a log file by its first lines: the SHA-1 of the (decompressed)
+    lines up to and including the first log entry, i.e. the first line which
+    is neither blank nor a comment. Many log files begin with the same
+    headers, like the #Version and #Fields lines of W3C logs, while their
+    first entry has a timestamp, which tells them apart. The id doesn't change
+    when a log file is renamed, compressed or grows, so the same lines always
+    get the same file id.
+    """
+
+    def __init__(self):
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        self.file_id = None
+
+    def update(self, line):
+        """
+        Add the next complete line of the file. Returns the file id once it
+        is known, else None.
+        """
+        if self.file_id is None:
+            self.sha1.update(line)
+            self.size += len(line)
+            entry = line.strip()
+            if (entry and not entry.startswith('#')) or self.size >= FILE_FINGERPRINT_MAX_SIZE:
+                self.file_id = self.sha1.hexdigest()
+        return self.file_id
+
+
+class FollowedFile(object):
+    """
+    A log file followed with --follow. Reads the complete lines appended to
+    it and detects when it is rotated (renamed and replaced) or truncated.
+    """
+
+    def __init__(self, filename, file, file_id, offset, lineno):
+        self.filename = filename
+        self.file = file
+        self.inode = os.fstat(file.fileno()).st_ino
+        self.file_id = file_id
+        # position after the last complete line read
+        self.offset = offset
+        self.lineno = lineno
+        # beginning of a line whose end hasn't been written yet
+        self.partial = ''
+        self.rotating = False
+        self.fingerprint = FileFingerprint()
+
+    def readline(self):
+        """
+        Return the next (lineno, offset, line), or None if there is no new
+        complete line.
+        """
+        line = self.file.readline()
+        if not line:
+            return None
+        if self.partial:
+            line = self.partial + line
+            self.partial = ''
+        if not line.endswith('\n'):
+            self.partial = line
+            return None
+
+        if self.file_id is None:
+            self.file_id = self.fingerprint.update(line)
+        lineno = self.lineno
+        self.lineno += 1
+        self.offset += len(line)
+        return lineno, self.offset, line
+
+    def restore(self, state):
+        """
+        Continue from a position saved in the --follow-state-file, if it is
+        about the same file.
+        """
+        if state['inode'] != self.inode or os.fstat(self.file.fileno()).st_size < state['offset']:
+            logging.info('%s changed since it was last followed, importing it from the start', self.filename)
+            return
+        self.file.seek(state['offset'])
+        self.offset = state['offset']
+        self.lineno = state['lineno']
+        self.file_id = state['file_id']
+
+    def rotated(self):
+        """
+        Return True when the end of the file has been reached and the file was
+        replaced by a new one. The first time a rotation is detected, False is
+        returned so that lines written just before the rotation are read.
+        """
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            # the new file hasn't been created yet
+            return False
+        if st.st_ino == self.inode:
+            return False
+        if not self.rotating:
+            self.rotating = True
+            return False
+        return True
+
+    def truncated(self):
+        try:
+            return os.fstat(self.file.fileno()).st_size < self.offset + len(self.partial)
+        except OSError:
+            return False
+
+    def reopen(self):
+        logging.info('%s was rotated, following the new file', self.filename)
+        self.file.close()
+        self.file = open(self.filename, 'r')
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self._reset()
+
+    def rewind(self):
+        logging.info('%s was truncated, following it from the start', self.filename)
+        self.file.seek(0)
+        self._reset()
+
+    def _reset(self):
+        self.file_id = None
+        self.offset = 0
+        self.lineno = 0
+        self.partial = ''
+        self.rotating = False
+        self.fingerprint = FileFingerprint()
+
+
+class FollowState(object):
+    """
+    Position in each log file followed with --follow, saved to the
+    --follow-state-file as JSON.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        if os.path.exists(path):
+            try:
+                self.files = json.load(open(path))
+            except ValueError:
+                logging.info('WARNING: cannot read %s, following all files from the start', path)
+
+    def get(self, filename):
+        return self.files.get(filename)
+
+    def save(self, followed, hit):
+        """
+        Save the position of a followed file after a hit, the last one of
+        the file such that all the hits before it are recorded.
+        """
+        with self.lock:
+            self.files[followed.filename] = {
+                'inode': followed.inode,
+                'offset': hit.offset,
+                'lineno': hit.lineno + 1,
+                'file_id': followed.file_id,
+            }
+            # write a new file and rename it so that the state is never half written
+            tmp_path = self.path + '.tmp'
+            tmp_file = open(tmp_path, 'w')
+            json.dump(self.files, tmp_file)
+            tmp_file.close()
+            os.rename(tmp_path, self.path)
+
+
+class Histogram(object):
+    """
+    Count durations in buckets growing exponentially from a microsecond, so
+    that adding one is cheap and percentiles are within a bucket's width,
+    about 9% (see HISTOGRAM_BUCKETS_PER_DOUBLING).
+    """
+
+    def __init__(self):
+        # bucket index: number of durations
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        if seconds > 0.000001:
+            bucket = int(math.log(seconds * 1000000, 2) * HISTOGRAM_BUCKETS_PER_DOUBLING)
+        else:
+            bucket = 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+
+    def merge(self, histogram):
+        for bucket, count in histogram.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += histogram.count
+        self.total += histogram.total
+
+    def percentile(self, percent):
+        """
+        Returns the duration, in seconds, that percent % of the durations do
+        not exceed: the upper bound of its bucket.
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                break
+        return 2 ** (float(bucket + 1) / HISTOGRAM_BUCKETS_PER_DOUBLING) / 1000000
+
+
+class LRUCache(object):
+    """
+    A bounded cache of the most recently used values.
+
+    The LRU order is approximated with two generations of dicts: values found
+    in the old generation are moved to the recent one, and the old generation
+    is dropped when the recent one is full. As it only uses single dict
+    operations, it can be shared between threads without a lock.
+    """
+
+    def __init__(self, size):
+        self.generation_size = max(size / 2, 1)
+        self.recent = {}
+        self.old = {}
+
+    def get(self, key, default=None):
+        try:
+            return self.recent[key]
+        except KeyError:
+            pass
+        try:
+            value = self.old[key]
+        except KeyError:
+            return default
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        if len(self.recent) >= self.generation_size:
+            self.old = self.recent
+            self.recent = {}
+        self.recent[key] = value
+
+class GeoIpDatabase(object):
+    """
+    Look up the geo attributes of IPs (see USER_AGENT_GEO_ATTRIBUTES) in a
+    local database, with an LRU cache of the recent IPs. Databases implement
+    lookup().
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    # path: database opened by this process, or inherited from its parent by
+    # --parse-workers and --import-processes
+    opened = {}
+
+    @classmethod
+    def open(cls, path):
+        """
+        Return the database at path, loaded once per process.
+        """
+        database = cls.opened.get(path)
+        if database is None:
+            if path.lower().endswith('.mmdb'):
+                database = MmdbGeoIpDatabase(path)
+            else:
+                database = CsvGeoIpDatabase(path)
+            cls.opened[path] = database
+        return database
+
+    def __init__(self):
+        # ip: geo attributes, or False if the IP is unknown
+        self.cache = LRUCache(GEOIP_CACHE_SIZE)
+
+    def enrich(self, hit):
+        """
+        Set the geo attributes of the hit from its IP. Returns whether the IP
+        was found.
+        """
+        geo = self.cache.get(hit.ip)
+        if geo is None:
+            try:
+                geo = self.lookup(hit.ip) or False
+            except ValueError:
+                geo = False
+            self.cache.set(hit.ip, geo)
+        if geo:
+            for name, value in zip(USER_AGENT_GEO_ATTRIBUTES, geo):
+                setattr(hit, name, value)
+        return bool(geo)
+
+    @abc.abstractmethod
+    def lookup(self, ip):
+        """
+        Returns the tuple of geo attributes of the IP, or None. Raises
+        ValueError if the IP is invalid.
+        """
+
+
+class MmdbGeoIpDatabase(GeoIpDatabase):
+    """
+    A MaxMind database, memory mapped so that it's shared between processes
+    and only the pages searched are read.
+    """
+
+    def __init__(self, path):
+        super(MmdbGeoIpDatabase, self).__init__()
+
+        global maxminddb
+        try:
+            import maxminddb
+        except ImportError:
+            fatal_error('maxminddb (https://pypi.python.org/pypi/maxminddb) is required to read '
+                        '--geoip-database %s' % path)
+        self.reader = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+
+    def lookup(self, ip):
+        record = self.reader.get(ip)
+        if not record:
+            return None
+
+        def name(entry):
+            return entry.get('names', {}).get('en', '')
+
+        country = record.get('country', {})
+        location = record.get('location', {})
+        subdivisions = record.get('subdivisions') or [{}]
+
+        def coordinate(key):
+            value = location.get(key)
+            return '' if value is None else unicode(value)
+
+        return (
+            country.get('iso_code', ''), name(country), name(record.get('city', {})),
+            coordinate('latitude'), coordinate('longitude'),
+            subdivisions[0].get('iso_code', ''), name(subdivisions[0]),
+            record.get('autonomous_system_organization', record.get('organization', '')),
+        )
+
+
+class CsvGeoIpDatabase(GeoIpDatabase):
+    """
+    A CSV file of IP ranges, loaded in arrays sorted by the start of the
+    ranges and searched by bisection. The ranges must not overlap.
+
+    The geo attributes are only stored once per distinct location, and the
+    IPv4 ranges in arrays of 32 bits integers, 12 bytes per range. Files
+    sorted by range, like the GeoLite2 ones, are loaded straight into the
+    arrays; others are sorted once loaded, which temporarily takes a Python
+    integer per range.
+    """
+
+    # Column names of GeoLite2 CSV files joined with their locations.
+    COLUMN_ALIASES = {
+        'country_iso_code': 'country_code',
+        'country_name': 'country',
+        'city_name': 'city',
+        'subdivision_1_iso_code': 'region',
+        'subdivision_1_name': 'region_name',
+        'autonomous_system_organization': 'organization',
+    }
+
+    def __init__(self, path):
+        super(CsvGeoIpDatabase, self).__init__()
+
+        # family: (range starts, range ends, location of each range)
+        self.ranges = {
+            socket.AF_INET: (array.array('I'), array.array('I'), array.array('I')),
+            socket.AF_INET6: ([], [], array.array('I')),
+        }
+        # geo attributes of each distinct location
+        self.locations = []
+        location_indexes = {}
+
+        # families whose ranges are not in order in the file
+        unsorted = set()
+        with open(path, 'rb') as file:
+            reader = csv.reader(file)
+            try:
+                header = [self.COLUMN_ALIASES.get(column, column) for column in next(reader)]
+            except StopIteration:
+                fatal_error('--geoip-database %s is empty' % path)
+            columns = dict((column, i) for i, column in enumerate(header))
+            if 'network' not in columns and not ('start_ip' in columns and 'end_ip' in columns):
+                fatal_error('--geoip-database %s has neither a network column nor start_ip and end_ip '
+                            'columns' % path)
+            geo_columns = [columns.get(name) for name in USER_AGENT_GEO_ATTRIBUTES]
+
+            for lineno, row in enumerate(reader, 2):
+                try:
+                    if 'network' in columns:
+                        family, start, end = self.parse_network(row[columns['network']])
+                    else:
+                        family, start = self.parse_ip(row[columns['start_ip']])
+                        end_family, end = self.parse_ip(row[columns['end_ip']])
+                        if end_family != family or end < start:
+                            raise ValueError('invalid range')
+                except (ValueError, IndexError):
+                    logging.debug('Invalid IP range at line %d of %s', lineno, path)
+                    continue
+
+                geo = tuple(
+                    '' if i is None or i >= len(row) else row[i].decode('utf-8')
+                    for i in geo_columns
+                )
+                location = location_indexes.get(geo)
+                if location is None:
+                    location = location_indexes[geo] = len(self.locations)
+                    self.locations.append(geo)
+
+                starts, ends, locations = self.ranges[family]
+                if starts and start < starts[-1]:
+                    unsorted.add(family)
+                starts.append(start)
+                ends.append(end)
+                locations.append(location)
+
+        for family in unsorted:
+            starts, ends, locations = self.ranges[family]
+            order = sorted(xrange(len(starts)), key=starts.__getitem__)
+            self.ranges[family] = tuple(
+                array.array(values.typecode, (values[i] for i in order)) if isinstance(values, array.array)
+                else [values[i] for i in order]
+                for values in (starts, ends, locations)
+            )
+
+    @staticmethod
+    def parse_ip(ip):
+        """
+        Returns the address family of the IP and its value as an integer.
+        """
+        try:
+            return socket.AF_INET, struct.unpack('!I', socket.inet_pton(socket.AF_INET, ip))[0]
+        except socket.error:
+            pass
+        try:
+            high, low = struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6, ip))
+        except socket.error:
+            raise ValueError('invalid IP: %r' % ip)
+        return socket.AF_INET6, (high << 64) | low
+
+    @classmethod
+    def parse_network(cls, network):
+        """
+        Returns the address family and the first and last IPs of a CIDR
+        network, e.g. 192.0.2.0/24.
+        """
+        ip, _, prefix_length = network.partition('/')
+        family, start = cls.parse_ip(ip)
+        bits = 32 if family == socket.AF_INET else 128
+        prefix_length = int(prefix_length) if prefix_length else bits
+        if not 0 <= prefix_length <= bits:
+            raise ValueError('invalid network: %r' % network)
+        host_mask = (1 << (bits - prefix_length)) - 1
+        start &= ~host_mask
+        return family, start, start | host_mask
+
+    def lookup(self, ip):
+        family, value = self.parse_ip(ip)
+        starts, ends, locations = self.ranges[family]
+        i = bisect.bisect_right(starts, value) - 1
+        if i < 0 or value > ends[i]:
+            return None
+        return self.locations[locations[i]]
+
+
+class HeavyHitters(object):
+    """
+    Find the keys making up a large share of a stream with the Misra-Gries
+    summary: at most `size` keys are counted, and their counts are lower
+    than their number of occurrences by at most total / (size + 1).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.counts = {}
+        self.total = 0
+
+    def add(self, key):
+        self.total += 1
+        counts = self.counts
+        if key in counts:
+            counts[key] += 1
+        elif len(counts) < self.size:
+            counts[key] = 1
+        else:
+            # each decrement is paid for by a previous increment
+            for other, count in counts.items():
+                if count == 1:
+                    del counts[other]
+                else:
+                    counts[other] = count - 1
+
+    def top(self, min_share):
+        """
+        Return the (key, count) of the keys counted at least min_share of
+        the total, most frequent first.
+        """
+        min_count = min_share * self.total
+        return sorted(
+            ((key, count) for key, count in self.counts.iteritems() if count >= min_count),
+            key=lambda item: item[1], reverse=True,
+        )
+
+class SubstringMatcher(object):
+    """
+    Find whether strings contain any of a set of substrings.
+
+    The substrings are compiled into a single regex whose alternatives are
+    factored as a trie, so that the cost of a search depends on the length
+    of the string rather than on the number of substrings.
+    """
+
+    def __init__(self, substrings):
+        trie = {}
+        for substring in substrings:
+            if not substring:
+                continue
+            node = trie
+            for char in substring:
+                node = node.setdefault(char, {})
+            node[''] = {}
+        self.regex = re.compile(self._trie_regex(trie)) if trie else None
+
+    def search(self, string):
+        return self.regex is not None and self.regex.search(string) is not None
+
+    @classmethod
+    def _trie_regex(cls, node):
+        if '' in node:
+            # the substrings continuing from here contain this one
+            return ''
+        alternatives = [re.escape(char) + cls._trie_regex(child) for char, child in sorted(node.iteritems())]
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return '(?:%s)' % '|'.join(alternatives)
+
+class GlobMatcher(object):
+    """
+    Find whether strings match any of a set of fnmatch patterns, with a
+    single regex combining the translated patterns.
+    """
+
+    def __init__(self, patterns):
+        regexes = []
+        for pattern in patterns:
+            regex = fnmatch.translate(os.path.normcase(pattern))
+            # the flags of each pattern are set once for the combined regex
+            if regex.endswith('(?ms)'):
+                regex = regex[:-len('(?ms)')]
+            regexes.append('(?:%s)' % regex)
+        self.regex = re.compile('|'.join(regexes), re.M | re.S) if regexes else None
+
+    def match(self, string):
+        return self.regex is not None and self.regex.match(os.path.normcase(string)) is not None
+
+class DateParser(object):
+    """
+    Parse the dates and timezones of hits into UTC datetimes.
+
+    The usual date formats are parsed without strptime, and the last results
+    are cached as consecutive lines mostly share the same second.
+    """
+
+    class Error(ValueError):
+        pass
 
-    def _add_custom_var(self, key, value, api_arg_name):
-        if api_arg_name not in self.args:
-            self.args[api_arg_name] = {}
+    CACHE_SIZE = 64
 
-        if isinstance(self.args[api_arg_name], basestring):
-            logging.debug("Ignoring custom %s variable addition [ %s = %s ], custom var already set to string." % (api_arg_name, key, value))
-            return
+    MONTHS = dict(
+        (month, i + 1) for i, month in enumerate(
+            ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+        )
+    )
 
-        index = len(self.args[api_arg_name]) + 1
-        self.args[api_arg_name][index] = [key, value]
+    # ISO date formats, by the separator of their date and time
+    ISO_FORMATS = {
+        '%Y-%m-%dT%H:%M:%S': 'T',
+        '%Y-%m-%d %H:%M:%S': ' ',
+    }
+
+    def __init__(self):
+        self.cache = {}
+
+    def parse(self, date_string, date_format, timezone):
+        """
+        Return the UTC datetime of a date and its timezone, which may be
+        None. Raise DateParser.Error with the reason if either is invalid.
+        """
+        key = (date_string, date_format, timezone)
+        date = self.cache.get(key)
+        if date is None:
+            try:
+                date = self.parse_date(date_string, date_format)
+            except ValueError:
+                raise DateParser.Error('invalid date')
+            if timezone is not None:
+                try:
+                    date -= self.parse_timezone(timezone)
+                except (ValueError, OverflowError):
+                    raise DateParser.Error('invalid timezone')
+
+            if len(self.cache) >= self.CACHE_SIZE:
+                self.cache.clear()
+            self.cache[key] = date
+        return date
+
+    def parse_date(self, date_string, date_format):
+        date = None
+        if date_format == '%d/%b/%Y:%H:%M:%S':
+            date = self._parse_clf_date(date_string)
+        elif date_format in self.ISO_FORMATS:
+            date = self._parse_iso_date(date_string, self.ISO_FORMATS[date_format])
+        if date is None:
+            date = datetime.datetime.strptime(date_string, date_format)
+        return date
+
+    def parse_timezone(self, timezone):
+        """
+        Return the offset of a [+-]HHMM timezone as a timedelta.
+        """
+        value = float(timezone)
+        hours, minutes = divmod(abs(value), 100)
+        minutes += hours * 60
+        return datetime.timedelta(minutes=-minutes if value < 0 else minutes)
+
+    def _parse_clf_date(self, date_string):
+        # 10/Feb/2012:16:42:07
+        if (len(date_string) != 20 or date_string[2] != '/' or date_string[6] != '/'
+                or date_string[11] != ':' or date_string[14] != ':' or date_string[17] != ':'):
+            return None
+        month = self.MONTHS.get(date_string[3:6])
+        day, year = date_string[0:2], date_string[7:11]
+        hour, minute, second = date_string[12:14], date_string[15:17], date_string[18:20]
+        if month is None or (day + year + hour + minute + second).strip('0123456789'):
+            return None
+        return datetime.datetime(int(year), month, int(day), int(hour), int(minute), int(second))
+
+    def _parse_iso_date(self, date_string, separator):
+        # 2012-02-10T16:42:07
+        if (len(date_string) != 19 or date_string[4] != '-' or date_string[7] != '-'
+                or date_string[10] != separator or date_string[13] != ':' or date_string[16] != ':'):
+            return None
+        year, month, day = date_string[0:4], date_string[5:7], date_string[8:10]
+        hour, minute, second = date_string[11:13], date_string[14:16], date_string[17:19]
+        if (year + month + day + hour + minute + second).strip('0123456789'):
+            return None
+        return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
 
 class Parser(object):
     """
@@ -1291,6 +4006,35 @@ class Parser(object):
                               in inspect.getmembers(self, predicate=inspect.ismethod)
                               if name.startswith('check_')]
 
+        # --follow
+        self.stop_following = threading.Event()
+        self.follow_state = None
+        self.followed = []
+
+        # --parse-workers
+        self.workers = None
+
+        self.date_parser = DateParser()
+
+        self.excluded_user_agents = SubstringMatcher(
+            itertools.chain(EXCLUDED_USER_AGENTS, config.options.excluded_useragents)
+        )
+        # user agent: whether it is excluded
+        self.excluded_user_agents_cache = LRUCache(USER_AGENT_CACHE_SIZE)
+        # raw user agent: (user agent, geo attributes), see USER_AGENT_GEO_FIELDS
+        self.user_agent_geo_cache = LRUCache(USER_AGENT_CACHE_SIZE)
+        # --geoip-database
+        self.geoip_database = None
+        if config.options.geoip_database:
+            self.geoip_database = GeoIpDatabase.open(config.options.geoip_database)
+
+        self.hostnames = GlobMatcher(config.options.hostnames)
+        self.hostnames_cache = LRUCache(GLOB_CACHE_SIZE)
+        self.excluded_paths = GlobMatcher(config.options.excluded_paths)
+        self.included_paths = GlobMatcher(config.options.included_paths)
+        # path: whether it is imported
+        self.paths_cache = LRUCache(GLOB_CACHE_SIZE)
+
     ## All check_* methods are called for each hit and must return True if the
     ## hit can be imported, False otherwise.
 
@@ -1300,10 +4044,10 @@ class Parser(object):
             return True
 
         # Accept the hostname only if it matches one pattern in the list.
-        result = any(
-            fnmatch.fnmatch(hit.host, pattern)
-            for pattern in config.options.hostnames
-        )
+        result = self.hostnames_cache.get(hit.host)
+        if result is None:
+            result = self.hostnames.match(hit.host)
+            self.hostnames_cache.set(hit.host, result)
         if not result:
             stats.count_lines_hostname_skipped.increment()
         return result
@@ -1331,15 +4075,18 @@ class Parser(object):
         return True
 
     def check_user_agent(self, hit):
-        user_agent = hit.user_agent.lower()
-        for s in itertools.chain(EXCLUDED_USER_AGENTS, config.options.excluded_useragents):
-            if s in user_agent:
-                if config.options.enable_bots:
-                    hit.is_robot = True
-                    return True
-                else:
-                    stats.count_lines_skipped_user_agent.increment()
-                    return False
+        excluded = self.excluded_user_agents_cache.get(hit.user_agent)
+        if excluded is None:
+            excluded = self.excluded_user_agents.search(hit.user_agent.lower())
+            self.excluded_user_agents_cache.set(hit.user_agent, excluded)
+
+        if excluded:
+            if config.options.enable_bots:
+                hit.is_robot = True
+                return True
+            else:
+                stats.count_lines_skipped_user_agent.increment()
+                return False
         return True
 
     def check_http_error(self, hit):
@@ -1366,16 +4113,17 @@ class Parser(object):
         return True
 
     def check_path(self, hit):
-        for excluded_path in config.options.excluded_paths:
-            if fnmatch.fnmatch(hit.path, excluded_path):
-                return False
-        # By default, all paths are included.
-        if config.options.included_paths:
-           for included_path in config.options.included_paths:
-               if fnmatch.fnmatch(hit.path, included_path):
-                   return True
-           return False
-        return True
+        result = self.paths_cache.get(hit.path)
+        if result is None:
+            if self.excluded_paths.match(hit.path):
+                result = False
+            # By default, all paths are included.
+            elif config.options.included_paths:
+                result = self.included_paths.match(hit.path)
+            else:
+                result = True
+            self.paths_cache.set(hit.path, result)
+        return result
 
     @staticmethod
     def check_format(lineOrFile):
@@ -1458,18 +4206,39 @@ class Parser(object):
         logging.debug('Format %s is the best match', format.name)
         return format
 
+    @staticmethod
+    def file_fingerprint(open_func, filename):
+        """
+        Return an identifier of the log file contents (see FileFingerprint),
+        or None if the file has no complete log entry yet.
+        """
+        fingerprint = FileFingerprint()
+        file = open_func(filename, 'r')
+        try:
+            while True:
+                line = file.readline(FILE_FINGERPRINT_MAX_SIZE)
+                if not line.endswith('\n') and len(line) < FILE_FINGERPRINT_MAX_SIZE:
+                    # the end of the file, or a line still being written
+                    return None
+                if fingerprint.update(line) is not None:
+                    return fingerprint.file_id
+        finally:
+            file.close()
+
+    def _invalid_line(self, line, reason):
+        stats.count_lines_invalid.increment()
+        if config.options.debug >= 2:
+            logging.debug('Invalid line detected (%s): %s' % (reason, line))
+
     def parse(self, filename):
         """
         Parse the specified filename and insert hits in the queue.
         """
-        def invalid_line(line, reason):
-            stats.count_lines_invalid.increment()
-            if config.options.debug >= 2:
-                logging.debug('Invalid line detected (%s): %s' % (reason, line))
-
         if filename == '-':
             filename = '(stdin)'
             file = sys.stdin
+            file_id = None
+            open_func = None
         else:
             if not os.path.exists(filename):
                 print >> sys.stderr, "\n=====> Warning: File %s does not exist <=====" % filename
@@ -1481,6 +4250,7 @@ class Parser(object):
                     open_func = gzip.open
                 else:
                     open_func = open
+                file_id = self.file_fingerprint(open_func, filename)
                 file = open_func(filename, 'r')
 
         if config.options.show_progress:
@@ -1489,6 +4259,9 @@ class Parser(object):
         if config.format:
             # The format was explicitely specified.
             format = config.format
+            if config.options.follow:
+                # each followed file is parsed in its own thread
+                format = copy.copy(format)
 
             if isinstance(format, W3cExtendedFormat):
                 format.create_regex(file)
@@ -1525,188 +4298,450 @@ class Parser(object):
             logging.info("--dump-log-regex option used, aborting log import.")
             os._exit(0)
 
+        offset, first_lineno = self._start_position(file, filename, file_id)
+
+        if config.options.follow and open_func is open:
+            # at the start of the file, the file id is computed once the first line is complete
+            followed = FollowedFile(filename, file, file_id if offset else None, offset, first_lineno)
+            self.followed.append(followed)
+            if self.follow_state is not None and not config.options.resume:
+                state = self.follow_state.get(filename)
+                if state is not None:
+                    followed.restore(state)
+            return self._follow(format, followed)
+
+        if self.workers is not None and open_func is open:
+            return self._parse_in_workers(format, filename, file, file_id, offset, first_lineno)
+
         hits = []
-        for lineno, line in enumerate(file):
-            try:
-                line = line.decode(config.options.encoding)
-            except UnicodeDecodeError:
-                invalid_line(line, 'invalid encoding')
+        lines = self._timed_lines(file) if config.options.timings else file
+        for lineno, line in enumerate(lines, first_lineno):
+            # offset of the next line, where to resume after this one
+            offset += len(line)
+            hit = self.parse_line(format, filename, file_id, lineno, offset, line)
+            if hit is None:
                 continue
 
-            stats.count_lines_parsed.increment()
-            if stats.count_lines_parsed.value <= config.options.skip:
-                continue
+            hits.append(hit)
+            if len(hits) >= config.options.recorder_max_payload_size * len(Recorder.recorders):
+                Recorder.add_hits(hits)
+                hits = []
+        if len(hits) > 0:
+            Recorder.add_hits(hits)
 
-            match = format.match(line)
-            if not match:
-                invalid_line(line, 'line did not match')
-                continue
+    def parse_line(self, format, filename, file_id, lineno, offset, line):
+        """
+        Parse one raw log line. Return the Hit, or None if the line is invalid
+        or must be excluded.
+        """
+        timings = config.options.timings
+        if timings:
+            time_start = time.time()
+        try:
+            line = line.decode(config.options.encoding)
+        except UnicodeDecodeError:
+            self._invalid_line(line, 'invalid encoding')
+            return None
+        if timings:
+            stats.record_timing('decode', time.time() - time_start)
 
-            hit = Hit(
-                filename=filename,
-                lineno=lineno,
-                status=format.get('status'),
-                full_path=format.get('path'),
-                is_download=False,
-                is_robot=False,
-                is_error=False,
-                is_redirect=False,
-                args={},
-            )
+        stats.count_lines_parsed.increment()
+        if stats.count_lines_parsed.value <= config.options.skip:
+            return None
 
-            if config.options.regex_group_to_page_cvars_map:
-                self._add_custom_vars_from_regex_groups(hit, format, config.options.regex_group_to_page_cvars_map, True)
+        if timings:
+            time_start = time.time()
+        match = format.match(line)
+        if timings:
+            stats.record_timing('match', time.time() - time_start)
+        if not match:
+            self._invalid_line(line, 'line did not match')
+            return None
 
-            if config.options.regex_group_to_visit_cvars_map:
-                self._add_custom_vars_from_regex_groups(hit, format, config.options.regex_group_to_visit_cvars_map, False)
+        hit = Hit(filename, file_id, lineno, offset, format.get('status'), format.get('path'))
 
-            if config.options.regex_groups_to_ignore:
-                format.remove_ignored_groups(config.options.regex_groups_to_ignore)
+        if config.options.regex_group_to_page_cvars_map:
+            self._add_custom_vars_from_regex_groups(hit, format, config.options.regex_group_to_page_cvars_map, True)
 
-            try:
-                hit.query_string = format.get('query_string')
-                hit.path = hit.full_path
-            except BaseFormatException:
-                hit.path, _, hit.query_string = hit.full_path.partition(config.options.query_string_delimiter)
+        if config.options.regex_group_to_visit_cvars_map:
+            self._add_custom_vars_from_regex_groups(hit, format, config.options.regex_group_to_visit_cvars_map, False)
 
-            # W3cExtendedFormat detaults to - when there is no query string, but we want empty string
-            if hit.query_string == '-':
-                hit.query_string = ''
+        if config.options.regex_groups_to_ignore:
+            format.remove_ignored_groups(config.options.regex_groups_to_ignore)
 
-            hit.extension = hit.path.rsplit('.')[-1].lower()
+        try:
+            hit.query_string = format.get('query_string')
+            hit.path = hit.full_path
+        except BaseFormatException:
+            hit.path, _, hit.query_string = hit.full_path.partition(config.options.query_string_delimiter)
 
-            try:
-                hit.referrer = format.get('referrer')
+        # W3cExtendedFormat detaults to - when there is no query string, but we want empty string
+        if hit.query_string == '-':
+            hit.query_string = ''
 
-                if hit.referrer.startswith('"'):
-                    hit.referrer = hit.referrer[1:-1]
-            except BaseFormatException:
-                hit.referrer = ''
-            if hit.referrer == '-':
-                hit.referrer = ''
+        hit.extension = hit.path.rsplit('.')[-1].lower()
 
-            try:
-                hit.user_agent = format.get('user_agent')
+        try:
+            hit.referrer = format.get('referrer')
 
-                # in case a format parser included enclosing quotes, remove them so they are not
-                # sent to Piwik
-                if hit.user_agent.startswith('"'):
-                    hit.user_agent = hit.user_agent[1:-1]
-            except BaseFormatException:
-                hit.user_agent = ''
+            if hit.referrer.startswith('"'):
+                hit.referrer = hit.referrer[1:-1]
+        except BaseFormatException:
+            hit.referrer = ''
+        if hit.referrer == '-':
+            hit.referrer = ''
 
-            hit.ip = format.get('ip')
-            try:
-                hit.length = int(format.get('length'))
-            except (ValueError, BaseFormatException):
-                # Some lines or formats don't have a length (e.g. 304 redirects, W3C logs)
-                hit.length = 0
+        try:
+            hit.user_agent = format.get('user_agent')
+
+            # in case a format parser included enclosing quotes, remove them so they are not
+            # sent to Piwik
+            if hit.user_agent.startswith('"'):
+                hit.user_agent = hit.user_agent[1:-1]
+        except BaseFormatException:
+            hit.user_agent = ''
+        self._parse_user_agent_geo(hit)
+
+        hit.ip = format.get('ip')
+        try:
+            hit.length = int(format.get('length'))
+        except (ValueError, BaseFormatException):
+            # Some lines or formats don't have a length (e.g. 304 redirects, W3C logs)
+            hit.length = 0
 
+        try:
+            hit.generation_time_milli = float(format.get('generation_time_milli'))
+        except BaseFormatException:
             try:
-                hit.generation_time_milli = float(format.get('generation_time_milli'))
+                hit.generation_time_milli = float(format.get('generation_time_micro')) / 1000
             except BaseFormatException:
                 try:
-                    hit.generation_time_milli = float(format.get('generation_time_micro')) / 1000
-                except BaseFormatException:
-                    try:
-                        hit.generation_time_milli = float(format.get('generation_time_secs')) * 1000
-                    except BaseFormatException:
-                        hit.generation_time_milli = 0
-
-            if config.options.log_hostname:
-                hit.host = config.options.log_hostname
-            else:
-                try:
-                    hit.host = format.get('host').lower().strip('.')
-
-                    if hit.host.startswith('"'):
-                        hit.host = hit.host[1:-1]
+                    hit.generation_time_milli = float(format.get('generation_time_secs')) * 1000
                 except BaseFormatException:
-                    # Some formats have no host.
-                    pass
+                    hit.generation_time_milli = 0
 
-            # Add userid
+        if config.options.log_hostname:
+            hit.host = config.options.log_hostname
+        else:
             try:
-                hit.userid = None
+                hit.host = format.get('host').lower().strip('.')
 
-                userid = format.get('userid')
-                if userid != '-':
-                    hit.args['uid'] = hit.userid = userid
-            except:
+                if hit.host.startswith('"'):
+                    hit.host = hit.host[1:-1]
+            except BaseFormatException:
+                # Some formats have no host.
                 pass
 
-            # add event info
-            try:
-                hit.event_category = hit.event_action = hit.event_name = None
+        # Add userid
+        try:
+            hit.userid = None
 
-                hit.event_category = format.get('event_category')
-                hit.event_action = format.get('event_action')
+            userid = format.get('userid')
+            if userid != '-':
+                hit.args['uid'] = hit.userid = userid
+        except:
+            pass
 
-                hit.event_name = format.get('event_name')
-                if hit.event_name == '-':
-                    hit.event_name = None
-            except:
-                pass
+        # add event info
+        try:
+            hit.event_category = hit.event_action = hit.event_name = None
 
-            # add session time
-            try:
-                hit.session_time = None
+            hit.event_category = format.get('event_category')
+            hit.event_action = format.get('event_action')
 
-                session_time = format.get('session_time')
-                hit.session_time = int(session_time)
-            except:
-                pass
+            hit.event_name = format.get('event_name')
+            if hit.event_name == '-':
+                hit.event_name = None
+        except:
+            pass
 
-            # Check if the hit must be excluded.
-            if not all((method(hit) for method in self.check_methods)):
-                continue
+        # add session time
+        try:
+            hit.session_time = None
+
+            session_time = format.get('session_time')
+            hit.session_time = int(session_time)
+        except:
+            pass
+
+        # Check if the hit must be excluded.
+        if timings:
+            time_start = time.time()
+        included = all((method(hit) for method in self.check_methods))
+        if timings:
+            stats.record_timing('filter', time.time() - time_start)
+        if not included:
+            return None
+
+        # the geo fields prefixed to the user agent take precedence
+        if self.geoip_database is not None and not hit.country_code:
+            if self.geoip_database.enrich(hit):
+                stats.count_lines_geolocated.increment()
+
+        # Parse date and substract the timezone from it.
+        # We parse it after calling check_methods as it's quite CPU hungry, and
+        # we want to avoid that cost for excluded hits.
+        date_string = format.get('date')
+        try:
+            timezone = format.get('timezone')
+        except BaseFormatException:
+            timezone = None
+        if timings:
+            time_start = time.time()
+        try:
+            hit.date = self.date_parser.parse(date_string, format.date_format, timezone)
+        except DateParser.Error, e:
+            self._invalid_line(line, str(e))
+            return None
+        if timings:
+            stats.record_timing('date', time.time() - time_start)
+
+        if config.options.replay_tracking:
+            # we need a query string and we only consider requests with piwik.php
+            if not hit.query_string or not hit.path.lower().endswith(config.options.replay_tracking_expected_tracker_file):
+                self._invalid_line(line, 'no query string, or ' + hit.path.lower() + ' does not end with piwik.php')
+                return None
+
+            query_arguments = urlparse.parse_qs(hit.query_string)
+            if not "idsite" in query_arguments:
+                self._invalid_line(line, 'missing idsite')
+                return None
 
-            # Parse date.
-            # We parse it after calling check_methods as it's quite CPU hungry, and
-            # we want to avoid that cost for excluded hits.
-            date_string = format.get('date')
             try:
-                hit.date = datetime.datetime.strptime(date_string, format.date_format)
-            except ValueError:
-                invalid_line(line, 'invalid date')
+                hit.args.update((k, v.pop().encode('raw_unicode_escape').decode(config.options.encoding)) for k, v in query_arguments.iteritems())
+            except UnicodeDecodeError:
+                self._invalid_line(line, 'invalid encoding')
+                return None
+
+        return hit
+
+    def follow(self, filenames):
+        """
+        Parse the log files as they grow, each one in its own thread, until
+        interrupted by Ctrl-C or SIGTERM.
+        """
+        if config.options.follow_state_file:
+            self.follow_state = FollowState(config.options.follow_state_file)
+
+        threads = []
+        for filename in filenames:
+            t = threading.Thread(target=self.parse, args=(filename,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        def on_sigterm(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, on_sigterm)
+
+        try:
+            while any(t.is_alive() for t in threads):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            logging.info('Stopping, waiting for the parsed hits to be recorded...')
+
+        self.stop_following.set()
+        for t in threads:
+            t.join()
+
+    def _follow(self, format, followed):
+        """
+        Parse the lines appended to a followed file until stop_following is
+        set. Hits are sent to the recorders when there are enough of them or
+        after --follow-flush-interval seconds.
+        """
+        max_hits = config.options.recorder_max_payload_size * len(Recorder.recorders)
+        hits = []
+        last_flush = time.time()
+
+        while True:
+            next_line = followed.readline()
+            if next_line is not None:
+                lineno, offset, line = next_line
+                hit = self.parse_line(format, followed.filename, followed.file_id, lineno, offset, line)
+                if hit is not None:
+                    hits.append(hit)
+            elif self.stop_following.is_set():
+                break
+            elif followed.rotated():
+                followed.reopen()
+                continue
+            elif followed.truncated():
+                followed.rewind()
                 continue
+            else:
+                self.stop_following.wait(config.options.follow_interval)
+
+            if len(hits) >= max_hits or time.time() - last_flush >= config.options.follow_flush_interval:
+                if hits:
+                    Recorder.add_hits(hits)
+                    hits = []
+                self._save_follow_state(followed)
+                last_flush = time.time()
+
+        if hits:
+            Recorder.add_hits(hits)
+        followed.file.close()
+
+    def _save_follow_state(self, followed):
+        """
+        Save the position of a followed file up to which its hits are
+        recorded, which lags behind the parsed lines. Nothing is saved before
+        a hit of the file is recorded.
+        """
+        if self.follow_state is None or followed.file_id is None:
+            return
+        hit = Recorder.resume_points.get(followed.file_id)
+        if hit is not None:
+            self.follow_state.save(followed, hit)
+
+    def save_follow_state(self):
+        """
+        Save the position of all the followed files, once the recorders are
+        done.
+        """
+        for followed in self.followed:
+            self._save_follow_state(followed)
+
+    def start_workers(self):
+        """
+        Start the --parse-workers processes. Must be called before starting
+        any thread, as the processes are forked.
+        """
+        self.workers = multiprocessing.Pool(config.options.parse_workers)
+
+    def stop_workers(self, terminate=False):
+        if self.workers is not None:
+            if terminate:
+                self.workers.terminate()
+            else:
+                self.workers.close()
+            self.workers.join()
+            self.workers = None
 
-            # Parse timezone and substract its value from the date
+    def _parse_in_workers(self, format, filename, file, file_id, offset, lineno):
+        """
+        Parse chunks of a file in the worker processes. Chunks are recorded in
+        the order of the file, and only a few more chunks than there are
+        workers are parsed ahead, to bound memory use.
+        """
+        max_hits = max(config.options.recorder_max_payload_size * len(Recorder.recorders), 1)
+        chunks = self._split_file(file, offset, config.options.parse_chunk_size)
+        pending = collections.deque()
+
+        def submit(count):
+            for start, end in itertools.islice(chunks, count):
+                pending.append(self.workers.apply_async(
+                    _parse_chunk, (format, filename, file_id, start, end)))
+
+        submit(config.options.parse_workers + 1)
+        while pending:
+            # a timeout keeps the wait interruptible by Ctrl-C
+            hits, line_count, counters, timings = pending.popleft().get(sys.maxint)
+            submit(1)
+
+            stats.add_counters(counters)
+            stats.add_timings(timings)
+            for hit in hits:
+                hit.lineno += lineno
+            lineno += line_count
+
+            for i in xrange(0, len(hits), max_hits):
+                Recorder.add_hits(hits[i:i + max_hits])
+        file.close()
+
+    def _split_file(self, file, start, chunk_size):
+        """
+        Yield (start, end) byte ranges of about chunk_size bytes covering the
+        file from start, each beginning at the start of a line.
+        """
+        size = os.fstat(file.fileno()).st_size
+        while start < size:
+            file.seek(start + chunk_size)
+            file.readline()
+            end = min(file.tell(), size)
+            yield start, end
+            start = end
+
+    def _timed_lines(self, file):
+        """
+        Yield the lines of a file, timing how long reading (and decompressing)
+        each one takes, with --timings.
+        """
+        lines = iter(file)
+        while True:
+            time_start = time.time()
             try:
-                timezone = float(format.get('timezone'))
-            except BaseFormatException:
-                timezone = 0
-            except ValueError:
-                invalid_line(line, 'invalid timezone')
-                continue
+                line = next(lines)
+            except StopIteration:
+                return
+            stats.record_timing('read', time.time() - time_start)
+            yield line
 
-            if timezone:
-                hit.date -= datetime.timedelta(hours=timezone/100)
+    def parse_chunk(self, format, filename, file_id, start, end):
+        """
+        Parse the lines of a file between two byte offsets. Return the hits,
+        with line numbers relative to the start of the chunk, and the number
+        of lines in the chunk.
+        """
+        file = open(filename, 'r')
+        file.seek(start)
+        offset = start
+        hits = []
+        line_count = 0
+        lines = self._timed_lines(file) if config.options.timings else file
+        for lineno, line in enumerate(lines):
+            offset += len(line)
+            line_count += 1
+            hit = self.parse_line(format, filename, file_id, lineno, offset, line)
+            if hit is not None:
+                hits.append(hit)
+            if offset >= end:
+                break
+        file.close()
+        return hits, line_count
 
-            if config.options.replay_tracking:
-                # we need a query string and we only consider requests with piwik.php
-                if not hit.query_string or not hit.path.lower().endswith(config.options.replay_tracking_expected_tracker_file):
-                    invalid_line(line, 'no query string, or ' + hit.path.lower() + ' does not end with piwik.php')
-                    continue
+    def _start_position(self, file, filename, file_id):
+        """
+        Return the byte offset and the line number parsing starts at, i.e. the
+        current position in the file or, with --resume, the file's checkpoint.
+        """
+        try:
+            offset = file.tell()
+        except IOError:
+            # stdin
+            offset = 0
+        lineno = 0
 
-                query_arguments = urlparse.parse_qs(hit.query_string)
-                if not "idsite" in query_arguments:
-                    invalid_line(line, 'missing idsite')
-                    continue
+        if config.options.resume and file_id is not None:
+            checkpoint = Recorder.get_checkpoint(file_id)
+            if checkpoint is not None:
+                offset, lineno = checkpoint
+                logging.info('Resuming import of %s at line %d', filename, lineno + 1)
+                file.seek(offset)
+                lineno += 1
 
-                try:
-                    hit.args.update((k, v.pop().encode('raw_unicode_escape').decode(config.options.encoding)) for k, v in query_arguments.iteritems())
-                except UnicodeDecodeError:
-                    invalid_line(line, 'invalid encoding')
-                    continue
+        return offset, lineno
 
-            hits.append(hit)
-            if len(hits) >= config.options.recorder_max_payload_size * len(Recorder.recorders):
-                Recorder.add_hits(hits)
-                hits = []
-        if len(hits) > 0:
-            Recorder.add_hits(hits)
+    def _parse_user_agent_geo(self, hit):
+        """
+        Move the geo fields prefixed to the user agent to their own
+        attributes, which are empty if there are none.
+        """
+        geo = self.user_agent_geo_cache.get(hit.user_agent)
+        if geo is None:
+            fields = hit.user_agent.split(':')
+            names = USER_AGENT_GEO_FIELDS.get(len(fields))
+            if names is None:
+                geo = (hit.user_agent, ('',) * len(USER_AGENT_GEO_ATTRIBUTES))
+            else:
+                values = dict(zip(names, fields))
+                geo = (fields[-1], tuple(values.get(name, '') for name in USER_AGENT_GEO_ATTRIBUTES))
+            self.user_agent_geo_cache.set(hit.user_agent, geo)
 
+        hit.user_agent, values = geo
+        for name, value in zip(USER_AGENT_GEO_ATTRIBUTES, values):
+            setattr(hit, name, value)
 
     def _add_custom_vars_from_regex_groups(self, hit, format, groups, is_page_var):
         for group_name, custom_var_name in groups.iteritems():
@@ -1722,24 +4757,251 @@ class Parser(object):
                 else:
                     hit.add_visit_custom_var(custom_var_name, value)
 
+class ImportProcesses(object):
+    """
+    Import several log files at once (--import-processes), in worker
+    processes with their own recorders and statistics, each importing one
+    file at a time. With --show-progress, the workers send the counters of
+    their statistics every --show-progress-delay seconds, and the rest of
+    their statistics once a file is imported.
+    """
+
+    def __init__(self, filenames, size):
+        self.pending = sorted(filenames, key=os.path.getsize, reverse=True)
+        self.size = min(size, len(filenames))
+        self.workers = []       # [process, task queue, filename being imported]
+        self.failed = []
+        self.results = multiprocessing.Queue()
+
+    @staticmethod
+    def usable(filenames):
+        if config.options.import_processes <= 1 or len(filenames) <= 1 or config.options.follow:
+            return False
+        if not all(os.path.isfile(filename) for filename in filenames):
+            logging.info("--import-processes only applies to regular files, log files will be imported one at a time.")
+            return False
+        return True
+
+    def start(self):
+        """
+        Fork the worker processes. Must be called before starting any thread,
+        such as the --show-progress monitor.
+        """
+        for index in xrange(self.size):
+            tasks = multiprocessing.Queue()
+            process = multiprocessing.Process(target=self._work, args=(index, tasks))
+            process.start()
+            self.workers.append([process, tasks, None])
+
+    def run(self):
+        """
+        Import all files. Return the files which were not imported, because
+        their process failed or because a previous one did.
+        """
+        try:
+            while True:
+                for worker in self.workers:
+                    if worker[2] is None and worker[0].is_alive() and self.pending and not self.failed:
+                        worker[2] = self.pending.pop(0)
+                        worker[1].put(worker[2])
+
+                running = [worker for worker in self.workers if worker[2] is not None]
+                if not running:
+                    break
+
+                try:
+                    index, result, done = self.results.get(timeout=1)
+                except Queue.Empty:
+                    pass
+                else:
+                    if done:
+                        stats.merge(result)
+                        self.workers[index][2] = None
+                    else:
+                        stats.add_counters(result)
+                    continue
+
+                for worker in running:
+                    # workers only exit once told to
+                    if not worker[0].is_alive():
+                        logging.info('WARNING: the import of "%s" failed', worker[2])
+                        self.failed.append(worker[2])
+                        worker[2] = None
+        except KeyboardInterrupt:
+            for process, tasks, filename in self.workers:
+                process.terminate()
+                process.join()
+            raise
+
+        for process, tasks, filename in self.workers:
+            tasks.put(None)
+        for process, tasks, filename in self.workers:
+            process.join()
+        return self.failed + self.pending
+
+    def _work(self, index, tasks):
+        try:
+            if config.options.parse_workers > 1:
+                parser.start_workers()
+            for filename in iter(tasks.get, None):
+                self._import(index, filename)
+            parser.stop_workers()
+        except KeyboardInterrupt:
+            os._exit(1)
+
+    def _import(self, index, filename):
+        global stats
+        stats = Statistics()
+        # counter values already sent to the main process
+        sent = {}
+
+        Recorder.launch(config.options.recorders)
+        if config.options.show_progress:
+            stop_progress = threading.Event()
+            progress = threading.Thread(target=self._send_progress, args=(index, sent, stop_progress))
+            progress.daemon = True
+            progress.start()
+
+        parser.parse(filename)
+        Recorder.wait_empty()
+        Recorder.close()
+
+        if config.options.show_progress:
+            stop_progress.set()
+            progress.join()
+        result = stats.snapshot()
+        result['counters'] = self._counters_delta(sent)
+        self.results.put((index, result, True))
+
+    def _send_progress(self, index, sent, stop):
+        while not stop.wait(config.options.show_progress_delay):
+            self.results.put((index, self._counters_delta(sent), False))
+
+    @staticmethod
+    def _counters_delta(sent):
+        """
+        Return how much the counters advanced since the values in sent, which
+        are updated.
+        """
+        delta = {}
+        for name, value in stats.get_counters().iteritems():
+            delta[name] = value - sent.get(name, 0)
+            sent[name] = value
+        return delta
+
+def _parse_chunk(format, filename, file_id, start, end):
+    """
+    Parse a chunk of a log file in a --parse-workers process. Return the
+    hits, the number of lines and the statistics counters and timings of the
+    chunk.
+    """
+    global stats, chunk_parser
+    stats = Statistics()
+    # one parser per worker, keeping its caches between chunks
+    if chunk_parser is None:
+        chunk_parser = Parser()
+    hits, line_count = chunk_parser.parse_chunk(format, filename, file_id, start, end)
+    return hits, line_count, stats.get_counters(), stats.get_timings()
+
+# the parser of a --parse-workers process, see _parse_chunk()
+chunk_parser = None
+
+def replay_dead_letters():
+    """
+    Record the rows of the dead letter file again (--replay-dead-letters),
+    by batches of DEAD_LETTER_REPLAY_BATCH_SIZE rows. The file is renamed
+    while it is replayed, and rows failing again are written to a new
+    dead letter file.
+    """
+    path = config.options.dead_letter_file
+    replayed_path = path + '.replaying'
+    # an interrupted replay is resumed from its file
+    if not os.path.exists(replayed_path):
+        if not os.path.exists(path):
+            logging.info('No dead letter file at %s, nothing to replay.', path)
+            return
+        os.rename(path, replayed_path)
+
+    dead_letters = DeadLetterFile(path)
+    sinks = {}      # columns: sink
+
+    def write(columns, rows):
+        if columns not in sinks:
+            sinks[columns] = SINKS[config.options.sink](columns, dead_letters)
+        sink = sinks[columns]
+        rejected = sink.rejected_count()
+        try:
+            inserted = sink.write(rows, {}, 0)
+        except Exception, e:
+            logging.info('WARNING: could not record %d rows (%s), they are written to %s', len(rows), e, path)
+            sink.reject(rows, e)
+            return
+        rejected = sink.rejected_count() - rejected
+        if config.options.on_duplicate == 'ignore':
+            stats.count_lines_duplicate.advance(len(rows) - rejected - inserted)
+        stats.count_lines_recorded.advance(len(rows) - rejected)
+
+    batch_columns = None
+    batch = []
+    for columns, row in DeadLetterFile.read(replayed_path):
+        if batch and (columns != batch_columns or len(batch) >= DEAD_LETTER_REPLAY_BATCH_SIZE):
+            write(batch_columns, batch)
+            batch = []
+        batch_columns = columns
+        batch.append(row)
+    if batch:
+        write(batch_columns, batch)
+
+    for sink in sinks.itervalues():
+        sink.close()
+    dead_letters.close()
+    os.remove(replayed_path)
+
 def main():
     """
     Start the importing process.
     """
     stats.set_time_start()
 
+    if config.options.replay_dead_letters:
+        replay_dead_letters()
+        stats.set_time_stop()
+        stats.print_summary()
+        return
+
+    # processes are forked before the --show-progress monitor thread starts
+    import_processes = None
+    if ImportProcesses.usable(config.filenames):
+        import_processes = ImportProcesses(config.filenames, config.options.import_processes)
+        import_processes.start()
+    elif config.options.parse_workers > 1 and not config.options.follow:
+        parser.start_workers()
+
     if config.options.show_progress:
         stats.start_monitor()
 
-    recorders = Recorder.launch(config.options.recorders)
+    not_imported = []
+    if import_processes is not None:
+        try:
+            not_imported = import_processes.run()
+        except KeyboardInterrupt:
+            pass
+    else:
+        recorders = Recorder.launch(config.options.recorders)
 
-    try:
-        for filename in config.filenames:
-            parser.parse(filename)
+        try:
+            if config.options.follow:
+                parser.follow(config.filenames)
+            else:
+                for filename in config.filenames:
+                    parser.parse(filename)
 
-        Recorder.wait_empty()
-    except KeyboardInterrupt:
-        pass
+            Recorder.wait_empty()
+            parser.save_follow_state()
+            parser.stop_workers()
+        except KeyboardInterrupt:
+            parser.stop_workers(terminate=True)
+        Recorder.close()
 
     stats.set_time_stop()
 
@@ -1748,12 +5010,19 @@ def main():
 
     stats.print_summary()
 
+    if not_imported:
+        fatal_error(
+            'the following log files were not imported: %s. Import them again with '
+            '--resume or --on-duplicate=ignore.' % ', '.join(not_imported)
+        )
+
 def fatal_error(error, filename=None, lineno=None):
     print >> sys.stderr, 'Fatal error: %s' % error
     if filename and lineno is not None:
         print >> sys.stderr, (
             'You can restart the import of "%s" from the point it failed by '
-            'specifying --skip=%d on the command line.\n' % (filename, lineno)
+            'specifying --skip=%d on the command line, or import the whole file '
+            'again with --on-duplicate=ignore.\n' % (filename, lineno)
         )
     os._exit(1)
 
@@ -25,3 +25,22 @@ CREATE TABLE `icecast`.`access_log` (
   `full_path` VARCHAR(255) NULL,
   PRIMARY KEY (`id`),
   UNIQUE KEY `unique_access` (`date`,`lineno`));
+
+-- Required by --on-duplicate=ignore and --on-duplicate=update: rows are
+-- identified by the log file they come from (file_id, a SHA-1 of the file's
+-- first lines, up to its first log entry) and their line number, so importing a file twice doesn't
+-- create duplicates. The (date, lineno) key above can collide for different
+-- log files and should be dropped in favour of this one.
+ALTER TABLE `statistics_access`
+  ADD COLUMN `file_id` CHAR(40) NULL,
+  ADD UNIQUE KEY `unique_file_line` (`file_id`, `lineno`);
+
+-- Required by --resume: position of the last line of each log file such that
+-- all the lines up to it are recorded, updated in the same transaction as
+-- recorded hits.
+CREATE TABLE `import_checkpoint` (
+  `file_id` CHAR(40) NOT NULL,
+  `filename` VARCHAR(255) NULL,
+  `offset` BIGINT NOT NULL,
+  `lineno` INT(11) NOT NULL,
+  PRIMARY KEY (`file_id`)) ENGINE=InnoDB;
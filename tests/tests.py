@@ -1,4 +1,5 @@
 # vim: et sw=4 ts=4:
+import fnmatch
 import functools
 import os
 import datetime
@@ -131,6 +132,10 @@ class Options(object):
     replay_tracking = True
     show_progress = False
     skip = False
+    resume = False
+    follow = False
+    parse_workers = 1
+    parse_chunk_size = 4 * 1024 * 1024
     hostnames = []
     excluded_paths = []
     excluded_useragents = []
@@ -148,6 +153,89 @@ class Options(object):
     regex_group_to_page_cvars_map = {}
     regex_groups_to_ignore = None
     replay_tracking_expected_tracker_file = 'piwik.php'
+    on_duplicate = 'error'
+    use_bulk_tracking = True
+    recorder_shard_key = 'visitor'
+    recorder_queue_high_watermark = 2000
+    recorder_queue_low_watermark = 1000
+    recorder_target_latency = None
+    recorders_max = None
+    bulk_load = False
+    geoip_database = None
+    timings = False
+    max_attempts = 3
+    delay_after_failure = 0
+    db_max_statement_size = 1000000
+
+class MySQLdb(object):
+    """Mock MySQLdb module, for the errors the MySQL sink handles."""
+    class Error(Exception):
+        pass
+
+    class OperationalError(Error):
+        pass
+
+    class IntegrityError(Error):
+        pass
+
+class MySQLConnection(object):
+    """Mock MySQLdb connection, executing statements with execute(sql, args)."""
+
+    def __init__(self, execute=None, commit=None):
+        self.execute = execute
+        self.commit_error = commit
+        self.statements = []
+        self.committed = []
+        self.closed = False
+
+    def cursor(self):
+        return MySQLCursor(self)
+
+    def literal(self, row):
+        return ["'%s'" % value for value in row]
+
+    def commit(self):
+        if self.commit_error is not None:
+            raise self.commit_error
+        self.committed.extend(self.statements)
+        self.statements = []
+
+    def ping(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class MySQLCursor(object):
+    """Mock MySQLdb cursor, counting the rows of INSERT statements as affected."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = 0
+
+    def execute(self, sql, args=None):
+        if self.connection.execute is not None:
+            self.connection.execute(sql, args)
+        self.connection.statements.append(sql)
+        self.rowcount = sql.count('),(') + 1
+
+    def executemany(self, sql, args):
+        for arg in args:
+            self.execute(sql, arg)
+
+def mysql_sink(connections, dead_letters=None):
+    """Return a MySQL sink handing out the given mock connections, with a pool of one."""
+    import_logs.mdb = MySQLdb
+    import_logs.stats = import_logs.Statistics()
+    sink = import_logs.MySQLSink.__new__(import_logs.MySQLSink)
+    import_logs.Sink.__init__(sink, ('ip', 'lineno'), dead_letters)
+    sink.pool = import_logs.DatabasePool(iter(connections).next, 1, 600)
+    return sink
+
+def assert_released(pool):
+    """Assert that no connection of the pool is checked out."""
+    assert pool.semaphore.acquire(False)
+    pool.semaphore.release()
 
 class Config(object):
     """Mock configuration."""
@@ -159,6 +247,23 @@ class Resolver(object):
     def check_format(self, format_):
         pass
 
+# the recorder class of import_logs, replaced by the mock below in tests parsing logs
+RealRecorder = import_logs.Recorder
+
+def with_real_recorder(test):
+    """Run a test with the recorder class of import_logs, as the code it calls uses it, and restore the mock."""
+    @functools.wraps(test)
+    def run():
+        mock = import_logs.Recorder
+        import_logs.Recorder = RealRecorder
+        try:
+            return test()
+        finally:
+            import_logs.Recorder = mock
+    # nose runs tests in the order of their definition
+    run.compat_co_firstlineno = test.func_code.co_firstlineno
+    return run
+
 class Recorder(object):
     """Mock recorder which collects hits but doesn't put their in database."""
     recorders = []
@@ -397,7 +502,7 @@ def test_iis_custom_format():
     # import_logs.config.options.w3c_time_taken_in_millisecs = True test that even w/o this, we get the right values
     import_logs.parser.parse(file_)
 
-    hits = [hit.__dict__ for hit in Recorder.recorders]
+    hits = [hit.to_dict() for hit in Recorder.recorders]
 
     assert hits[0]['status'] == '200'
     assert hits[0]['is_error'] == False
@@ -472,7 +577,7 @@ def test_netscaler_parsing():
     import_logs.config.options.w3c_time_taken_in_millisecs = False
     import_logs.parser.parse(file_)
 
-    hits = [hit.__dict__ for hit in Recorder.recorders]
+    hits = [hit.to_dict() for hit in Recorder.recorders]
 
     assert hits[0]['status'] == u'302'
     assert hits[0]['userid'] == None
@@ -510,7 +615,7 @@ def test_amazon_cloudfront_web_parsing():
     import_logs.config.options.w3c_time_taken_in_millisecs = False
     import_logs.parser.parse(file_)
 
-    hits = [hit.__dict__ for hit in Recorder.recorders]
+    hits = [hit.to_dict() for hit in Recorder.recorders]
 
     assert hits[0]['status'] == u'200'
     assert hits[0]['userid'] == None
@@ -550,7 +655,7 @@ def test_amazon_cloudfront_rtmp_parsing():
     import_logs.config.options.w3c_time_taken_in_millisecs = False
     import_logs.parser.parse(file_)
 
-    hits = [hit.__dict__ for hit in Recorder.recorders]
+    hits = [hit.to_dict() for hit in Recorder.recorders]
 
     assert hits[0]['is_download'] == False
     assert hits[0]['ip'] == u'192.0.2.147'
@@ -618,7 +723,7 @@ def test_ignore_groups_option_removes_groups():
     import_logs.config.options.regex_groups_to_ignore = set(['userid','generation_time_milli'])
     import_logs.parser.parse(file_)
 
-    hits = [hit.__dict__ for hit in Recorder.recorders]
+    hits = [hit.to_dict() for hit in Recorder.recorders]
 
     assert hits[0]['userid'] == None
     assert hits[0]['generation_time_milli'] == 0
@@ -648,7 +753,7 @@ def test_regex_group_to_custom_var_options():
     }
     import_logs.parser.parse(file_)
 
-    hits = [hit.__dict__ for hit in Recorder.recorders]
+    hits = [hit.to_dict() for hit in Recorder.recorders]
 
     assert hits[0]['args']['_cvar'] == {1: ['The Date', '2012-04-01 00:00:13'], 2: ['User Name', 'theuser']} # check visit custom vars
     assert hits[0]['args']['cvar'] == {1: ['Geneartion Time', '1687']} # check page custom vars
@@ -692,3 +797,1018 @@ def test_w3c_custom_field_regex_option():
     assert match is not None
     assert format.get('substatus') == '654'
     assert format.get('win32_status') == '456'
+
+def test_bulk_load_file_escaping():
+    """Test that rows written for LOAD DATA INFILE are escaped."""
+
+    bulk_load_file = import_logs.BulkLoadFile()
+    bulk_load_file.write_row((None, True, False, 42, datetime.datetime(2015, 4, 11, 10, 54, 48),
+                              u'a\tb\nc\\d', u'caf\xe9'))
+    bulk_load_file.close()
+
+    contents = open(bulk_load_file.path).read()
+    rows = list(bulk_load_file.read_rows())
+    bulk_load_file.remove()
+
+    assert contents == '\\N\t1\t0\t42\t2015-04-11 10:54:48\ta\\tb\\nc\\\\d\tcaf\xc3\xa9\n'
+    assert rows == [(None, u'1', u'0', u'42', u'2015-04-11 10:54:48', u'a\tb\nc\\d', u'caf\xe9')]
+    assert bulk_load_file.rows == 1
+    assert not os.path.exists(bulk_load_file.path)
+
+def test_sink_interface():
+    """Test that sinks must implement write(), and load files with it by default."""
+
+    class Sink(import_logs.Sink):
+        def write(self, rows, checkpoints, recorder_index):
+            self.written = rows, checkpoints, recorder_index
+            return len(rows)
+
+    class IncompleteSink(import_logs.Sink):
+        pass
+
+    try:
+        IncompleteSink(('ip',))
+    except TypeError:
+        pass
+    else:
+        assert False, 'a sink without write() was created'
+
+    sink = Sink(('ip', 'lineno'))
+    bulk_load_file = import_logs.BulkLoadFile()
+    bulk_load_file.write_row((u'1.2.3.4', 0))
+    bulk_load_file.close()
+    bulk_load_file.checkpoints = {'f1': None}
+    try:
+        assert sink.load_file(bulk_load_file, 2) == 1
+        assert sink.written == ([(u'1.2.3.4', u'0')], {'f1': None}, 2)
+    finally:
+        bulk_load_file.remove()
+
+@with_real_recorder
+def test_bulk_load_failure():
+    """Test that a recorder starts a new bulk load file after failing to load one."""
+
+    class Sink(object):
+        def __init__(self):
+            self.failed = None
+            self.loaded = []
+
+        def load_file(self, bulk_load_file, recorder_index):
+            if self.failed is None:
+                self.failed = bulk_load_file.path
+                raise IOError('LOAD DATA failed')
+            self.loaded.append(open(bulk_load_file.path).read())
+            return bulk_load_file.rows
+
+    import_logs.config.options.bulk_load_rows = 1
+    import_logs.stats = import_logs.Statistics()
+    recorder = import_logs.Recorder(0)
+    sink = import_logs.Recorder.sink = Sink()
+    try:
+        try:
+            recorder._bulk_load_rows([(u'1.2.3.4', 0)], 1, [])
+        except IOError:
+            pass
+        else:
+            assert False, 'the load error was swallowed'
+        assert recorder.bulk_load_file is None
+        assert open(sink.failed).read() == '1.2.3.4\t0\n'
+
+        recorder._bulk_load_rows([(u'1.2.3.5', 1)], 1, [])
+        assert sink.loaded == ['1.2.3.5\t1\n']
+        assert recorder.bulk_load_file is None
+    finally:
+        import_logs.Recorder.sink = None
+        if sink.failed is not None:
+            os.remove(sink.failed)
+
+def test_file_fingerprint():
+    """Test that log files are told apart by their first entry, whatever their headers."""
+
+    import gzip
+
+    fingerprint = import_logs.Parser.file_fingerprint
+    paths = ['logs/amazon_cloudfront_rtmp.log', 'logs/amazon_cloudfront_web.log', 'logs/netscaler.log',
+             'logs/iis.log', 'logs/iis_custom.log', 'logs/common.log']
+    file_ids = [fingerprint(open, path) for path in paths]
+    assert None not in file_ids
+    assert len(set(file_ids)) == len(paths)
+
+    header = '#Version: 1.0\n\n#Fields: date time c-ip\n'
+    contents = {
+        'tmp1.log': header + '2012-04-01 00:00:13 1.2.3.4\n',
+        'tmp2.log': header + '2012-04-01 00:00:14 1.2.3.4\n2012-04-01 00:00:15 1.2.3.4\n',
+        'tmp3.log': '\n1.2.3.4 - - [10/Feb/2012:16:42:07 -0500] "GET / HTTP/1.0" 301 368\n',
+        'tmp4.log': '\n1.2.3.5 - - [10/Feb/2012:16:42:07 -0500] "GET / HTTP/1.0" 301 368\n',
+        'tmp5.log': header,
+        'tmp6.log': header + '2012-04-01 00:00:13',
+    }
+    try:
+        for path, content in contents.iteritems():
+            open(path, 'w').write(content)
+        gzip_file = gzip.open('tmp1.log.gz', 'w')
+        gzip_file.write(contents['tmp1.log'] + '2012-04-01 00:00:16 1.2.3.4\n')
+        gzip_file.close()
+
+        assert fingerprint(open, 'tmp1.log') != fingerprint(open, 'tmp2.log')
+        assert fingerprint(open, 'tmp3.log') != fingerprint(open, 'tmp4.log')
+        assert fingerprint(gzip.open, 'tmp1.log.gz') == fingerprint(open, 'tmp1.log')
+        assert fingerprint(open, 'tmp5.log') is None
+        assert fingerprint(open, 'tmp6.log') is None
+
+        # followed files get the same ids once their first entry is read
+        followed = import_logs.FollowedFile('tmp2.log', open('tmp2.log'), None, 0, 0)
+        while followed.readline() is not None:
+            pass
+        assert followed.file_id == fingerprint(open, 'tmp2.log')
+        followed.file.close()
+    finally:
+        for path in contents.keys() + ['tmp1.log.gz']:
+            if os.path.exists(path):
+                os.remove(path)
+
+@with_real_recorder
+def test_bulk_load_dead_letters():
+    """Test that the rows of a failed bulk load go to the dead letter file."""
+
+    class Sink(import_logs.Sink):
+        def write(self, rows, checkpoints, recorder_index):
+            return len(rows)
+
+        def load_file(self, bulk_load_file, recorder_index):
+            raise IOError('LOAD DATA failed')
+
+    import_logs.config.options.bulk_load_rows = 2
+    import_logs.config.options.dead_letter_file = 'tmp.dead_letters'
+    import_logs.stats = import_logs.Statistics()
+    dead_letters = import_logs.Recorder.dead_letters = import_logs.DeadLetterFile('tmp.dead_letters')
+    import_logs.Recorder.sink = Sink(('ip', 'lineno'), dead_letters)
+    recorder = import_logs.Recorder(0)
+    try:
+        recorder._bulk_load_rows([(u'1.2.3.4', 0), (u'1.2.3.5', 1)], 2, [])
+        assert recorder.bulk_load_file is None
+        assert recorder.count_hits_recorded.value == 2
+        dead_letters.close()
+        assert list(import_logs.DeadLetterFile.read('tmp.dead_letters')) == [
+            (('ip', 'lineno'), (u'1.2.3.4', u'0')), (('ip', 'lineno'), (u'1.2.3.5', u'1')),
+        ]
+    finally:
+        import_logs.Recorder.sink = import_logs.Recorder.dead_letters = None
+        import_logs.config.options.dead_letter_file = None
+        if os.path.exists('tmp.dead_letters'):
+            os.remove('tmp.dead_letters')
+
+@with_real_recorder
+def test_record_hits_rejected_rows():
+    """Test that rejected rows are not counted as recorded or as duplicates."""
+
+    class Sink(import_logs.Sink):
+        def write(self, rows, checkpoints, recorder_index):
+            # rows of odd lines are rejected, the first row is a duplicate
+            lineno = self.columns.index('lineno')
+            self.reject([row for row in rows if row[lineno] % 2], ValueError('invalid row'))
+            return len([row for row in rows if not row[lineno] % 2]) - 1
+
+    import_logs.config.options.on_duplicate = 'ignore'
+    import_logs.stats = import_logs.Statistics()
+    sink = import_logs.Recorder.sink = Sink(import_logs.Recorder.get_columns())
+    recorder = import_logs.Recorder(0)
+    hits = []
+    for i in xrange(6):
+        hit = import_logs.Hit('a.log', 'f1', i, 10 * i, '200', '/')
+        for column in import_logs.Recorder.columns:
+            if not hasattr(hit, column):
+                setattr(hit, column, None)
+        hit.session_time = 1
+        hit.date = datetime.datetime(2015, 4, 11, 10, 54, 48)
+        hits.append(hit)
+    hits[4].session_time = 0
+    # the row of this hit can't be made
+    hits[5].date = None
+    try:
+        recorder._record_hits(hits)
+        stats = import_logs.stats
+        assert stats.count_lines_rejected.value == 3
+        assert sink.rejected_count() == 3
+        assert stats.count_lines_duplicate.value == 1
+        assert stats.count_lines_recorded.value == 3
+        assert recorder.count_hits_recorded.value == 6
+    finally:
+        import_logs.Recorder.sink = None
+        import_logs.config.options.on_duplicate = 'error'
+
+def test_sink_reject_without_dead_letters():
+    """Test that rejected rows are logged with their error when there is no dead letter file."""
+
+    class Sink(import_logs.Sink):
+        def write(self, rows, checkpoints, recorder_index):
+            return len(rows)
+
+    class Handler(import_logs.logging.Handler):
+        def emit(self, record):
+            messages.append((record.levelno, record.getMessage()))
+
+    messages = []
+    handler = Handler()
+    import_logs.logging.getLogger().addHandler(handler)
+    try:
+        Sink(('ip', 'lineno')).reject([(u'1.2.3.4', 0), (u'1.2.3.5', 1)], ValueError('invalid row'))
+    finally:
+        import_logs.logging.getLogger().removeHandler(handler)
+    assert messages == [
+        (import_logs.logging.WARNING, "Could not record (u'1.2.3.4', 0): invalid row"),
+        (import_logs.logging.WARNING, "Could not record (u'1.2.3.5', 1): invalid row"),
+    ]
+
+def test_strict_regex_formats():
+    """Test that the strict regexes of formats give the groups of their regex."""
+
+    lines = []
+    for filename in sorted(os.listdir('logs')):
+        lines.extend(open(os.path.join('logs', filename)))
+    lines.extend([
+        '1.2.3.4 - - [10/Feb/2012:16:42:07 -0500] "GET /a b" c HTTP/1.0" 200 5 "-" "x" 7\n',
+        '1.2.3.4 - - [10/Feb/2012:16:42:07 -0500] "GET / HTTP/1.0" 200 5 "a" "b" "c" "d" 7\n',
+        '1.2.3.4 - - [10/Feb/2012:16:42:07 -0500] "GET / HTTP/1.0" 200 5 "" "a"b" 7 8\n',
+        '1.2.3.4 - - [10/Feb/2012:16:42:07] "GET / HTTP/1.0" 200 5 "-" "-" 7\n',
+        '1.2.3.4 - - [10/Feb/2012:16:42:07 -0500] "GET  / HTTP/1.0" 200 5 "-" "-" 7\n',
+        '1.2.3.4 - - [10/Feb/2012:16:42:07 -0500] "GET / HTTP/1.0" 200 5 "-" "-"\r\n',
+        '1.2.3.4 - - [10/Feb/2012:16:42:07 -0500] "GET / HTTP/1.0" 200\n',
+        '1.2.3.4 - - [10/Feb/2012:16:42:07 -0500] "GET /a  HTTP/1.0" 200 5 "-" "-" 7\n',
+        '1.2.3.4 - - [10/Feb/2012:16:42:07 -0500] "GET /a\t HTTP/1.0" 200 5 "-" "-" 7\n',
+        ' 1.2.3.4 - - [10/Feb/2012:16:42:07 -0500] "GET / HTTP/1.0" 200 5 "-" "-" 7\n',
+    ])
+
+    for name in ('common', 'ncsa_extended', 'icecast2'):
+        format = import_logs.FORMATS[name]
+        for line in lines:
+            match = format.regex.match(line)
+            strict_match = format.strict_regex.match(line)
+            if strict_match is not None:
+                assert match is not None and strict_match.groupdict() == match.groupdict(), (name, line)
+
+    format = import_logs.FORMATS['icecast2']
+    for line in open('logs/icecast2.log'):
+        assert format.strict_regex.match(line) is not None
+
+def test_substring_matcher():
+    """Test that the substring matcher finds the same substrings as the in operator."""
+
+    substrings = list(import_logs.EXCLUDED_USER_AGENTS) + ['bot', 'a.b', '(x)', 'a+b', '']
+    matcher = import_logs.SubstringMatcher(substrings)
+    for string in [
+        'googlebot/2.1', 'mozilla/5.0', 'curl/7.0', 'axb', 'a.b', 'the (x) agent', 'aab',
+        'a+b', 'ro', 'robo', 'java/1.6', 'javascript', '',
+    ]:
+        assert matcher.search(string) == any(s and s in string for s in substrings), string
+
+    assert not import_logs.SubstringMatcher([]).search('robot')
+
+def test_glob_matcher():
+    """Test that the glob matcher matches the same strings as fnmatch."""
+
+    patterns = ['/static/*', '*.jpg', '/LOUNGE_?56k', '/[abc]x', '/[!a]y', '/a.b', '/exact']
+    matcher = import_logs.GlobMatcher(patterns)
+    for string in [
+        '/static/a.css', '/img/a.jpg', '/img/a.jpgx', '/LOUNGE_256k', '/LOUNGE_2566k', '/bx', '/dx',
+        '/by', '/ay', '/a.b', '/axb', '/exact', '/exact/', '/line\n/static/a',
+    ]:
+        assert matcher.match(string) == any(fnmatch.fnmatch(string, pattern) for pattern in patterns), string
+
+    assert not import_logs.GlobMatcher([]).match('/static/a.css')
+
+def test_lru_cache():
+    """Test that the LRU cache keeps recently used values and bounds its size."""
+
+    cache = import_logs.LRUCache(4)
+    for i in xrange(10):
+        cache.set(i, i * 2)
+        cache.get(0)
+    assert cache.get(0) == 0
+    assert cache.get(9) == 18
+    assert cache.get(1) is None
+    assert len(cache.recent) + len(cache.old) <= 4
+
+def test_date_parser():
+    """Test that dates are parsed as by strptime, and timezones in hours and minutes."""
+
+    date_parser = import_logs.DateParser()
+    for date_string, date_format in [
+        ('10/Feb/2012:16:42:07', '%d/%b/%Y:%H:%M:%S'),
+        (u'01/Dec/2015:00:00:59', '%d/%b/%Y:%H:%M:%S'),
+        ('1/Dec/2015:00:00:59', '%d/%b/%Y:%H:%M:%S'),
+        ('2012-02-10T16:42:07', '%Y-%m-%dT%H:%M:%S'),
+        ('2012-02-10 16:42:07', '%Y-%m-%d %H:%M:%S'),
+    ]:
+        expected = datetime.datetime.strptime(date_string, date_format)
+        assert date_parser.parse(date_string, date_format, None) == expected
+        assert date_parser.parse(date_string, date_format, None) == expected
+
+    date_string = '10/Feb/2012:16:42:07'
+    date_format = '%d/%b/%Y:%H:%M:%S'
+    assert date_parser.parse(date_string, date_format, '+0300') == datetime.datetime(2012, 2, 10, 13, 42, 7)
+    assert date_parser.parse(date_string, date_format, '+0530') == datetime.datetime(2012, 2, 10, 11, 12, 7)
+    assert date_parser.parse(date_string, date_format, '-0930') == datetime.datetime(2012, 2, 11, 2, 12, 7)
+    assert date_parser.parse(date_string, date_format, '+0000') == datetime.datetime(2012, 2, 10, 16, 42, 7)
+
+    for date_string, timezone, reason in [
+        ('31/Feb/2012:16:42:07', '+0000', 'invalid date'),
+        ('10/Fev/2012:16:42:07', '+0000', 'invalid date'),
+        ('10/Feb/2012:16:4a:07', '+0000', 'invalid date'),
+        ('10/Feb/2012:16:42:07', 'UTC', 'invalid timezone'),
+    ]:
+        try:
+            date_parser.parse(date_string, date_format, timezone)
+            assert False, date_string
+        except import_logs.DateParser.Error, e:
+            assert str(e) == reason
+
+def test_statistics_merge():
+    """Test that statistics of another process are added to the current ones."""
+
+    worker_stats = import_logs.Statistics()
+    worker_stats.count_lines_parsed.advance(10)
+    worker_stats.count_lines_invalid.increment()
+    worker_stats.dates_recorded.add(datetime.date(2015, 1, 1))
+
+    merged_stats = import_logs.Statistics()
+    merged_stats.count_lines_parsed.advance(5)
+    merged_stats.merge(worker_stats.snapshot())
+    merged_stats.merge(worker_stats.snapshot())
+
+    assert merged_stats.count_lines_parsed.value == 25
+    assert merged_stats.count_lines_invalid.value == 2
+    assert merged_stats.count_lines_recorded.value == 0
+    assert merged_stats.dates_recorded == set([datetime.date(2015, 1, 1)])
+
+def test_import_processes_progress():
+    """Test that import processes send each counter increment to the main process once."""
+
+    import_logs.stats = import_logs.Statistics()
+    sent = {}
+    import_logs.stats.count_lines_parsed.advance(5)
+    assert import_logs.ImportProcesses._counters_delta(sent)['count_lines_parsed'] == 5
+    import_logs.stats.count_lines_parsed.advance(3)
+    delta = import_logs.ImportProcesses._counters_delta(sent)
+    assert delta['count_lines_parsed'] == 3
+    assert delta['count_lines_recorded'] == 0
+    assert import_logs.ImportProcesses._counters_delta(sent)['count_lines_parsed'] == 0
+
+def test_hit_byte_offsets():
+    """Test that each hit records the byte offset of the line following it."""
+
+    file_ = 'logs/icecast2.log'
+
+    import_logs.config.options.custom_w3c_fields = {}
+    Recorder.recorders = []
+    import_logs.parser = import_logs.Parser()
+    import_logs.config.format = None
+    import_logs.config.options.replay_tracking = False
+    import_logs.config.options.regex_groups_to_ignore = None
+    import_logs.config.options.regex_group_to_visit_cvars_map = {}
+    import_logs.config.options.regex_group_to_page_cvars_map = {}
+    import_logs.parser.parse(file_)
+
+    lines = open(file_).readlines()
+    hits = Recorder.recorders
+
+    assert len(hits) == len(lines)
+    for hit in hits:
+        assert hit.offset == sum(len(line) for line in lines[:hit.lineno + 1])
+    assert hits[-1].offset == os.path.getsize(file_)
+
+def test_parse_workers():
+    """Test that parsing in worker processes gives the hits of serial parsing, in order."""
+
+    file_ = 'logs/icecast2.log'
+
+    import_logs.config.options.custom_w3c_fields = {}
+    import_logs.config.format = None
+    import_logs.config.options.replay_tracking = False
+    import_logs.config.options.regex_groups_to_ignore = None
+    import_logs.config.options.regex_group_to_visit_cvars_map = {}
+    import_logs.config.options.regex_group_to_page_cvars_map = {}
+
+    Recorder.recorders = []
+    import_logs.parser = import_logs.Parser()
+    import_logs.parser.parse(file_)
+    serial_hits = [hit.to_dict() for hit in Recorder.recorders]
+
+    import_logs.config.options.parse_workers = 2
+    import_logs.config.options.parse_chunk_size = 1
+    try:
+        Recorder.recorders = []
+        import_logs.parser = import_logs.Parser()
+        import_logs.parser.start_workers()
+        import_logs.parser.parse(file_)
+        import_logs.parser.stop_workers()
+    finally:
+        import_logs.config.options.parse_workers = 1
+        import_logs.config.options.parse_chunk_size = 4 * 1024 * 1024
+
+    assert [hit.to_dict() for hit in Recorder.recorders] == serial_hits
+
+def test_heavy_hitters():
+    """Test that the heavy hitters summary finds the keys making up a large share of hits."""
+
+    heavy_hitters = import_logs.HeavyHitters(4)
+    for i in xrange(1000):
+        heavy_hitters.add('127.0.0.1')
+        heavy_hitters.add(i)
+        if i % 2:
+            heavy_hitters.add('10.0.0.1')
+
+    assert heavy_hitters.total == 2500
+    assert len(heavy_hitters.counts) <= 4
+    assert [key for key, count in heavy_hitters.top(0.1)] == ['127.0.0.1']
+    assert [key for key, count in heavy_hitters.top(0.05)] == ['127.0.0.1', '10.0.0.1']
+    for key, count in heavy_hitters.top(0.05):
+        assert count >= {'127.0.0.1': 1000, '10.0.0.1': 500}[key] - 2500 / 5
+
+@with_real_recorder
+def test_recorder_shard_keys():
+    """Test that hits of a relay are spread between recorders by the shard keys."""
+
+    def make_hit(ip, user_agent, path):
+        hit = import_logs.Hit('a.log', None, 0, 0, '200', path)
+        hit.ip = ip
+        hit.user_agent = user_agent
+        hit.path = path
+        return hit
+
+    hits = [
+        make_hit('127.0.0.1', 'agent%d' % (i % 7), '/mount%d' % (i % 5))
+        for i in xrange(1400)
+    ]
+
+    def shard(shard_key):
+        import_logs.config.options.recorder_shard_key = shard_key
+        import_logs.Recorder.recorders = [import_logs.Recorder(i) for i in xrange(3)]
+        import_logs.Recorder.heavy_hitters = import_logs.HeavyHitters(import_logs.HEAVY_HITTERS_SIZE)
+        import_logs.Recorder.heavy_hitters_reported = set()
+        import_logs.Recorder.next_recorder = 0
+        import_logs.Recorder.add_hits(hits)
+        import_logs.Recorder.add_hits(hits[:2])
+        return [recorder.get_queue_depth() for recorder in import_logs.Recorder.recorders]
+
+    import_logs.config.options.replay_tracking = False
+    try:
+        assert sorted(shard('visitor')) == [0, 0, 1402]
+        assert import_logs.Recorder.heavy_hitters_reported == set(['127.0.0.1'])
+
+        assert all(depth > 0 for depth in shard('ip-ua-path'))
+        assert import_logs.Recorder.heavy_hitters_reported == set()
+
+        assert shard('round-robin') == [468, 467, 467]
+    finally:
+        import_logs.config.options.recorder_shard_key = 'visitor'
+        import_logs.config.options.replay_tracking = True
+        import_logs.Recorder.recorders = []
+        import_logs.Recorder.heavy_hitters = None
+
+def test_hit_queue_watermarks():
+    """Test that a full hit queue blocks the producer until it drains to its low watermark."""
+
+    queue = import_logs.HitQueue(4, 1)
+    assert queue.put([1, 2]) == 0
+    assert queue.put([3, 4]) == 0
+    assert queue.full
+
+    got = []
+    def consume():
+        import_logs.time.sleep(0.2)
+        got.append(queue.get())
+        queue.task_done()
+        import_logs.time.sleep(0.2)
+        got.append(queue.get())
+        queue.task_done()
+        got.append(queue.get())
+        queue.task_done()
+    thread = import_logs.threading.Thread(target=consume)
+    thread.start()
+
+    # [3, 4] leaves 2 hits, above the low watermark: the queue drains further
+    assert queue.put([5]) >= 0.3
+    queue.join()
+    thread.join()
+    assert got == [[1, 2], [3, 4], [5]]
+    assert queue.size == 0 and queue.unfinished == 0
+
+def test_batch_size_controller():
+    """Test that the batch size grows while commits are fast and is halved when one is slow."""
+
+    controller = import_logs.BatchSizeController(100, 10, 130, 0.5)
+    controller.update(100, 0.1)
+    assert controller.size == 110
+    controller.update(50, 0.1)
+    assert controller.size == 110
+    controller.update(110, 0.1)
+    controller.update(120, 0.1)
+    controller.update(130, 0.1)
+    assert controller.size == 130
+    controller.update(130, 0.6)
+    assert controller.size == 65
+    for i in xrange(5):
+        controller.update(65, 1)
+    assert controller.size == 10
+
+    assert import_logs.BatchSizeController(1000, 10, 130, 0.5).size == 130
+
+def test_hit_queue_get_batches():
+    """Test that batches are taken together as long as they fit in the requested number of hits."""
+
+    queue = import_logs.HitQueue(100, 50)
+    for batch in ([1, 2, 3], [4, 5], [6], [7, 8, 9, 10]):
+        queue.put(batch)
+    assert queue.get_batches(2) == [[1, 2, 3]]
+    assert queue.get_batches(3) == [[4, 5], [6]]
+    assert queue.get_batches(0) == [[7, 8, 9, 10]]
+    queue.task_done(4)
+    queue.join()
+
+@with_real_recorder
+def test_recorder_scaler_keeps_visits():
+    """Test that visitors keep their recorder until their visit ends when recorders are added."""
+
+    def make_hit(ip, minute):
+        hit = import_logs.Hit('a.log', None, 0, 0, '200', '/stream')
+        hit.ip = ip
+        hit.date = datetime.datetime(2015, 1, 1, 10, 0) + datetime.timedelta(minutes=minute)
+        return hit
+
+    recorders = [import_logs.Recorder(i) for i in xrange(4)]
+    scaler = import_logs.RecorderScaler(1, 4, 10)
+    ips = ['10.0.0.%d' % i for i in xrange(50)]
+
+    assigned = dict((ip, scaler.get_recorder(ip, make_hit(ip, 0), recorders[:1])) for ip in ips)
+    assert set(assigned.values()) == set([recorders[0]])
+
+    # during the visits, the added recorders only get new visitors
+    for ip in ips:
+        assert scaler.get_recorder(ip, make_hit(ip, 20), recorders) is recorders[0]
+    new_visitors = set(scaler.get_recorder(ip, make_hit(ip, 20), recorders) for ip in ['10.1.0.%d' % i for i in xrange(50)])
+    assert len(new_visitors) > 1
+
+    # after VISIT_TIMEOUT, visitors are spread between all recorders
+    spread = set(scaler.get_recorder(ip, make_hit(ip, 60), recorders) for ip in ips)
+    assert len(spread) > 1
+
+    scaler._expire_visits()
+    assert sorted(scaler.assignments) == sorted(ips)
+
+def test_mysql_sink_releases_connections():
+    """Test that a connection is given back to the pool, and closed, whatever error the write raises."""
+
+    def execute(sql, args):
+        raise ValueError('not a database error')
+
+    connection = MySQLConnection(execute)
+    sink = mysql_sink([connection])
+    try:
+        sink.write([(u'1.2.3.4', 0)], {}, 0)
+    except ValueError:
+        pass
+    else:
+        assert False, 'the error was swallowed'
+    assert connection.closed
+    assert sink.pool.idle == []
+    assert_released(sink.pool)
+
+def test_mysql_sink_retries_lost_connections():
+    """Test that a batch is written again on a fresh connection when the connection is lost."""
+
+    def execute(sql, args):
+        raise MySQLdb.OperationalError(2006, 'MySQL server has gone away')
+
+    lost = MySQLConnection(execute)
+    connection = MySQLConnection()
+    sink = mysql_sink([lost, connection])
+
+    assert sink.write([(u'1.2.3.4', 0), (u'1.2.3.5', 1)], {}, 0) == 2
+    assert lost.closed and lost.committed == []
+    assert len(connection.committed) == 1
+    assert [c for c, last_used in sink.pool.idle] == [connection]
+    assert_released(sink.pool)
+
+def test_mysql_sink_connection_lost_on_commit():
+    """Test that a batch whose commit may have gone through is only written again if duplicates are skipped."""
+
+    lost = MySQLdb.OperationalError(2013, 'Lost connection to MySQL server during query')
+    rows = [(u'1.2.3.4', 0), (u'1.2.3.5', 1)]
+
+    committing = MySQLConnection(commit=lost)
+    connection = MySQLConnection()
+    sink = mysql_sink([committing, connection])
+    assert sink.write(rows, {}, 0) == 0
+    assert import_logs.stats.count_lines_rejected.value == 2
+    assert connection.committed == []
+    assert_released(sink.pool)
+
+    options = import_logs.config.options
+    options.on_duplicate = 'ignore'
+    try:
+        committing = MySQLConnection(commit=lost)
+        connection = MySQLConnection()
+        sink = mysql_sink([committing, connection])
+        assert sink.write(rows, {}, 0) == 2
+        assert import_logs.stats.count_lines_rejected.value == 0
+        assert len(connection.committed) == 1
+    finally:
+        options.on_duplicate = 'error'
+
+def test_mysql_sink_rejects_rows():
+    """Test that offending rows are rejected, and that a failed commit rejects the whole batch."""
+
+    def execute(sql, args):
+        if "'bad'" in sql:
+            raise MySQLdb.IntegrityError(1062, 'Duplicate entry')
+
+    connection = MySQLConnection(execute)
+    sink = mysql_sink([connection])
+    rows = [(u'1.2.3.4', 0), (u'bad', 1), (u'1.2.3.5', 2), (u'1.2.3.6', 3)]
+
+    assert sink.write(rows, {}, 0) == 3
+    assert import_logs.stats.count_lines_rejected.value == 1
+    assert "'bad'" not in ''.join(connection.committed)
+    assert_released(sink.pool)
+
+    failing = MySQLConnection(commit=MySQLdb.OperationalError(1180, 'Got error 5 during COMMIT'))
+    sink = mysql_sink([failing])
+
+    assert sink.write(rows[:1] + rows[2:], {}, 0) == 0
+    assert import_logs.stats.count_lines_rejected.value == 3
+    assert failing.closed
+    assert_released(sink.pool)
+
+def test_resume_points():
+    """Test that the resume point of a file only moves past hits once all hits before them are recorded."""
+
+    points = import_logs.ResumePoints()
+    hits = [import_logs.Hit('a.log', 'f1', i, 10 * (i + 1), '200', '/') for i in xrange(6)]
+    stdin_hit = import_logs.Hit('(stdin)', None, 0, 10, '200', '/')
+    points.add(hits[:4] + [stdin_hit])
+    points.add(hits[4:])
+
+    # one recorder got hits 0 and 2, another hits 1 and 3, a third one the second batch
+    late = points.detach([hits[0], hits[2], stdin_hit])
+    points.release(points.detach(hits[4:]))
+    points.release(points.detach([hits[1], hits[3]]))
+    assert points.get('f1') is None
+    assert points.take() == {}
+
+    points.release(late)
+    assert points.get('f1') is hits[5]
+    taken = points.take()
+    assert taken == {'f1': hits[5]}
+    assert points.take() == {}
+    points.give_back(taken)
+    assert points.take() == taken
+    assert points.pending == {}
+
+def test_followed_file():
+    """Test that a followed file returns complete lines only, and starts again when rotated or truncated."""
+
+    try:
+        open('tmp_follow.log', 'w').write('a\nb')
+        followed = import_logs.FollowedFile('tmp_follow.log', open('tmp_follow.log'), None, 0, 0)
+
+        # partial lines are returned once complete
+        assert followed.readline() == (0, 2, 'a\n')
+        assert followed.readline() is None
+        open('tmp_follow.log', 'a').write('c\n')
+        assert followed.readline() == (1, 5, 'bc\n')
+        assert followed.readline() is None
+        file_id = followed.file_id
+        assert file_id is not None
+
+        # truncated
+        assert not followed.truncated()
+        open('tmp_follow.log', 'w').write('x\n')
+        assert followed.readline() is None
+        assert followed.truncated()
+        followed.rewind()
+        assert followed.readline() == (0, 2, 'x\n')
+        assert followed.file_id not in (None, file_id)
+
+        # rotated: the lines written to the old file just before are read first
+        os.rename('tmp_follow.log', 'tmp_follow.log.1')
+        open('tmp_follow.log', 'w').write('new\n')
+        open('tmp_follow.log.1', 'a').write('y\n')
+        assert not followed.rotated()
+        assert followed.readline() == (1, 4, 'y\n')
+        assert followed.rotated()
+        followed.reopen()
+        assert followed.readline() == (0, 4, 'new\n')
+        assert followed.inode == os.stat('tmp_follow.log').st_ino
+        followed.file.close()
+    finally:
+        for path in ('tmp_follow.log', 'tmp_follow.log.1'):
+            if os.path.exists(path):
+                os.remove(path)
+
+def test_follow_state():
+    """Test that the position of a followed file is saved and restored through the state file."""
+
+    try:
+        open('tmp_follow.log', 'w').write('a\nb\nc\n')
+        followed = import_logs.FollowedFile('tmp_follow.log', open('tmp_follow.log'), None, 0, 0)
+        lineno, offset, line = followed.readline()
+        hit = import_logs.Hit('tmp_follow.log', followed.file_id, lineno, offset, '200', '/')
+        lineno, offset, line = followed.readline()
+
+        # the state holds the position after the last recorded hit, not the last parsed line
+        import_logs.FollowState('tmp_follow.state').save(followed, hit)
+        followed.file.close()
+        state = import_logs.FollowState('tmp_follow.state').get('tmp_follow.log')
+        assert state == {
+            'inode': os.stat('tmp_follow.log').st_ino, 'offset': 2, 'lineno': 1, 'file_id': followed.file_id,
+        }
+
+        restored = import_logs.FollowedFile('tmp_follow.log', open('tmp_follow.log'), None, 0, 0)
+        restored.restore(state)
+        assert restored.file_id == followed.file_id
+        assert restored.readline() == (1, 4, 'b\n')
+        restored.file.close()
+
+        # another file with the same name is followed from the start
+        os.remove('tmp_follow.log')
+        open('tmp_follow.log', 'w').write('d\n')
+        other = import_logs.FollowedFile('tmp_follow.log', open('tmp_follow.log'), None, 0, 0)
+        if other.inode != state['inode']:
+            other.restore(state)
+            assert other.readline() == (0, 2, 'd\n')
+        other.file.close()
+    finally:
+        for path in ('tmp_follow.log', 'tmp_follow.state'):
+            if os.path.exists(path):
+                os.remove(path)
+
+def test_mysql_sink_retries_deadlocks():
+    """Test that a batch is written again as a whole when a deadlock rolls back its transaction."""
+
+    statements = []
+
+    def execute(sql, args):
+        statements.append(sql)
+        if len(statements) == 2:
+            raise MySQLdb.OperationalError(1213, 'Deadlock found when trying to get lock')
+
+    deadlocked = MySQLConnection(execute)
+    connection = MySQLConnection()
+    sink = mysql_sink([deadlocked, connection])
+    rows = [(u'1.2.3.4', i) for i in xrange(10)]
+    options = import_logs.config.options
+    options.db_max_statement_size = 100
+    try:
+        assert sink.write(rows, {}, 0) == 10
+    finally:
+        options.db_max_statement_size = 1000000
+
+    assert len(statements) == 2
+    assert deadlocked.closed and deadlocked.committed == []
+    assert ''.join(connection.committed).count("'1.2.3.4'") == 10
+    assert import_logs.stats.count_lines_rejected.value == 0
+    assert_released(sink.pool)
+
+def test_sqlite_sink():
+    """Test that the SQLite sink creates its tables, skips duplicates and stores checkpoints."""
+
+    options = import_logs.config.options
+    options.sqlite_path = 'tmp.sqlite'
+    options.on_duplicate = 'ignore'
+    options.resume = True
+    try:
+        sink = import_logs.SQLiteSink(('ip', 'date', 'lineno', 'file_id'))
+        date = datetime.datetime(2015, 4, 11, 10, 54, 48)
+        rows = [(u'1.2.3.4', date, 0, 'f1'), (u'1.2.3.5', date, 1, 'f1')]
+        hit = import_logs.Hit('a.log', 'f1', 1, 120, '200', '/')
+
+        assert sink.write(rows, {'f1': hit}, 0) == 2
+        assert sink.write(rows, {}, 1) == 0
+        assert sink.get_checkpoint('f1') == (120, 1)
+        assert sink.get_checkpoint('f2') is None
+        # checkpoints committed out of order never move back
+        assert sink.write([], {'f1': import_logs.Hit('a.log', 'f1', 0, 60, '200', '/')}, 1) == 0
+        assert sink.get_checkpoint('f1') == (120, 1)
+        assert sink.write([], {'f1': import_logs.Hit('a.log', 'f1', 2, 180, '200', '/')}, 1) == 0
+        assert sink.get_checkpoint('f1') == (180, 2)
+        assert sink.connection.execute('SELECT ip, date FROM statistics_access ORDER BY lineno').fetchall() == [
+            (u'1.2.3.4', u'2015-04-11 10:54:48'), (u'1.2.3.5', u'2015-04-11 10:54:48'),
+        ]
+        sink.close()
+    finally:
+        options.on_duplicate = 'error'
+        options.resume = False
+        for path in ('tmp.sqlite', 'tmp.sqlite-wal', 'tmp.sqlite-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+
+def test_export_sink():
+    """Test that exported rows are partitioned by date and path, in rotated gzipped CSV shards."""
+
+    import csv
+    import gzip
+    import shutil
+
+    options = import_logs.config.options
+    options.export_dir = 'tmp_export'
+    options.export_format = 'csv'
+    options.export_shard_size = 1
+    try:
+        sink = import_logs.ExportSink(('ip', 'date', 'path', 'is_robot'))
+        rows = [
+            (u'1.2.3.4', datetime.datetime(2015, 4, 11, 10, 54, 48), u'/LOUNGE_256k', False),
+            (u'1.2.3.5', datetime.datetime(2015, 4, 11, 23, 0, 0), u'/LOUNGE_256k', True),
+            (u'1.2.3.6', datetime.datetime(2015, 4, 12, 0, 0, 0), u'/NE.FM', False),
+        ]
+        assert sink.write(rows, {}, 0) == 3
+        assert sink.write(rows[:1], {}, 1) == 1
+        sink.close()
+
+        exported = {}
+        for directory, subdirectories, filenames in os.walk('tmp_export'):
+            for filename in filenames:
+                assert filename.endswith('.csv.gz')
+                lines = list(csv.reader(gzip.open(os.path.join(directory, filename))))
+                assert lines[0] == ['ip', 'date', 'path', 'is_robot']
+                exported.setdefault(os.path.relpath(directory, 'tmp_export'), []).extend(lines[1:])
+
+        assert sorted(exported) == ['date=2015-04-11/path=LOUNGE_256k', 'date=2015-04-12/path=NE.FM']
+        assert sorted(exported['date=2015-04-11/path=LOUNGE_256k']) == [
+            ['1.2.3.4', '2015-04-11 10:54:48', '/LOUNGE_256k', '0'],
+            ['1.2.3.4', '2015-04-11 10:54:48', '/LOUNGE_256k', '0'],
+            ['1.2.3.5', '2015-04-11 23:00:00', '/LOUNGE_256k', '1'],
+        ]
+    finally:
+        shutil.rmtree('tmp_export', ignore_errors=True)
+
+def test_dead_letters():
+    """Test that rows the sink fails to write go to the dead letter file, and can be read back."""
+
+    options = import_logs.config.options
+    options.sqlite_path = 'tmp.sqlite'
+    options.on_duplicate = 'ignore'
+    dead_letters = import_logs.DeadLetterFile('tmp.dead_letters')
+    try:
+        sink = import_logs.SQLiteSink(('ip', 'date', 'lineno', 'file_id'), dead_letters)
+        date = datetime.datetime(2015, 4, 11, 10, 54, 48)
+        rows = [(u'1.2.3.4', date, 0, 'f1'), (u'1.2.3.5', date), (u'1.2.3.6', date, 2, 'f1')]
+
+        assert sink.write(rows, {}, 0) == 2
+        assert sink.connection.execute('SELECT lineno FROM statistics_access ORDER BY lineno').fetchall() == [(0,), (2,)]
+        sink.close()
+        dead_letters.close()
+
+        assert list(import_logs.DeadLetterFile.read('tmp.dead_letters')) == [
+            (('ip', 'date', 'lineno', 'file_id'), (u'1.2.3.5', date)),
+        ]
+        assert 'bindings' in import_logs.json.loads(open('tmp.dead_letters').readline())['error']
+    finally:
+        options.on_duplicate = 'error'
+        for path in ('tmp.sqlite', 'tmp.sqlite-wal', 'tmp.sqlite-shm', 'tmp.dead_letters'):
+            if os.path.exists(path):
+                os.remove(path)
+
+def test_sqlite_sink_bisection():
+    """Test that the rows of a failed batch are inserted but for the offending ones, in order."""
+
+    options = import_logs.config.options
+    options.sqlite_path = 'tmp.sqlite'
+    try:
+        sink = import_logs.SQLiteSink(('ip', 'lineno'), import_logs.DeadLetterFile('tmp.dead_letters'))
+        rows = [(u'1.2.3.4', i) if i not in (13, 57, 58) else (u'1.2.3.4',) for i in xrange(100)]
+
+        assert sink.write(rows, {}, 0) == 97
+        assert [lineno for lineno, in sink.connection.execute('SELECT lineno FROM statistics_access')] == [
+            i for i in xrange(100) if i not in (13, 57, 58)
+        ]
+        sink.close()
+        sink.dead_letters.close()
+        assert len(open('tmp.dead_letters').readlines()) == 3
+    finally:
+        for path in ('tmp.sqlite', 'tmp.sqlite-wal', 'tmp.sqlite-shm', 'tmp.dead_letters'):
+            if os.path.exists(path):
+                os.remove(path)
+
+def test_user_agent_geo_fields():
+    """Test that the geo fields prefixed to user agents are parsed into their own attributes."""
+
+    parser = import_logs.Parser()
+
+    def parse(user_agent):
+        hit = import_logs.Hit('a.log', None, 0, 0, '200', '/stream')
+        hit.user_agent = user_agent
+        parser._parse_user_agent_geo(hit)
+        return hit
+
+    hit = parse('FR:France:Paris:48.85:2.35:VLC/3.0.8 LibVLC/3.0.8')
+    assert hit.user_agent == 'VLC/3.0.8 LibVLC/3.0.8'
+    assert (hit.country_code, hit.country, hit.city, hit.latitude, hit.longitude) == (
+        'FR', 'France', 'Paris', '48.85', '2.35')
+    assert hit.organization == hit.region == ''
+
+    hit = parse('US:United States:Austin:30.26:-97.74:TX:Texas:Example ISP:iTunes/12.0')
+    assert hit.user_agent == 'iTunes/12.0'
+    assert (hit.region, hit.region_name, hit.organization) == ('TX', 'Texas', 'Example ISP')
+
+    # cached
+    hit = parse('FR:France:Paris:48.85:2.35:VLC/3.0.8 LibVLC/3.0.8')
+    assert hit.user_agent == 'VLC/3.0.8 LibVLC/3.0.8' and hit.city == 'Paris'
+
+    # user agents with other numbers of ':' are kept as they are
+    hit = parse('Mozilla/5.0 (X11; rv:1.9.2.7) Gecko/20100722 Firefox/3.6.7')
+    assert hit.user_agent == 'Mozilla/5.0 (X11; rv:1.9.2.7) Gecko/20100722 Firefox/3.6.7'
+    assert hit.country_code == hit.organization == ''
+
+def test_csv_geoip_database():
+    """Test looking up IPs in a CSV file of IP ranges."""
+
+    with open('tmp.geoip.csv', 'wb') as file:
+        file.write(
+            'network,country_iso_code,country_name,city_name,latitude,longitude\n'
+            '192.0.2.0/24,FR,France,Paris,48.85,2.35\n'
+            '198.51.100.0/25,DE,Germany,Berlin,52.52,13.40\n'
+            '198.51.100.128/25,FR,France,Paris,48.85,2.35\n'
+            '2001:db8::/32,JP,Japan,Tokyo,35.68,139.69\n'
+            'invalid,XX,,,,\n'
+        )
+    try:
+        database = import_logs.GeoIpDatabase.open('tmp.geoip.csv')
+        assert len(database.locations) == 3
+
+        assert database.lookup('192.0.2.1') == ('FR', 'France', 'Paris', '48.85', '2.35', '', '', '')
+        assert database.lookup('198.51.100.127')[2] == 'Berlin'
+        assert database.lookup('198.51.100.255')[2] == 'Paris'
+        assert database.lookup('2001:db8::1')[2] == 'Tokyo'
+        assert database.lookup('192.0.3.0') is None
+        assert database.lookup('10.0.0.1') is None
+
+        hit = import_logs.Hit('a.log', None, 0, 0, '200', '/stream')
+        for ip, found in (('192.0.2.1', True), ('192.0.2.1', True), ('not an ip', False)):
+            hit.ip = ip
+            assert database.enrich(hit) == found
+        assert hit.city == 'Paris'
+
+        # the database is loaded once per process
+        assert import_logs.GeoIpDatabase.open('tmp.geoip.csv') is database
+
+        # ranges which are not in order are sorted once loaded
+        with open('tmp.geoip2.csv', 'wb') as file:
+            file.write(
+                'start_ip,end_ip,country_iso_code\n'
+                '198.51.100.0,198.51.100.255,DE\n'
+                '2001:db8::,2001:db8::ffff,JP\n'
+                '192.0.2.0,192.0.2.255,FR\n'
+                '::1,::1,XX\n'
+            )
+        database = import_logs.GeoIpDatabase.open('tmp.geoip2.csv')
+        assert list(database.ranges[import_logs.socket.AF_INET][0]) == [3221225984, 3325256704]
+        assert database.lookup('192.0.2.1')[0] == 'FR'
+        assert database.lookup('198.51.100.1')[0] == 'DE'
+        assert database.lookup('2001:db8::1')[0] == 'JP'
+        assert database.lookup('::1')[0] == 'XX'
+    finally:
+        import_logs.GeoIpDatabase.opened.clear()
+        for path in ('tmp.geoip.csv', 'tmp.geoip2.csv'):
+            if os.path.exists(path):
+                os.remove(path)
+
+def test_histogram():
+    """Test the percentiles of --timings histograms."""
+
+    histogram = import_logs.Histogram()
+    for i in xrange(1, 1001):
+        histogram.add(i / 1000000.0)
+    assert histogram.count == 1000
+    assert abs(histogram.total - 0.5005) < 1e-9
+    for percent, expected in ((50, 500), (95, 950), (99, 990)):
+        value = histogram.percentile(percent) * 1000000
+        assert expected <= value <= expected * 1.1, (percent, value)
+
+    merged = import_logs.Histogram()
+    merged.merge(histogram)
+    merged.add(0)
+    assert merged.count == 1001 and merged.percentile(50) == histogram.percentile(50)
+    assert import_logs.Histogram().percentile(99) == 0.0
+
+def test_statistics_timings():
+    """Test that the timings recorded by several threads are merged by stage."""
+
+    stats = import_logs.Statistics()
+
+    def record():
+        for i in xrange(100):
+            stats.record_timing('match', 0.001)
+        stats.record_timing('date', 0.01)
+
+    threads = [import_logs.threading.Thread(target=record) for i in xrange(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats.add_timings({'execute': import_logs.Histogram()})
+
+    timings = stats.get_timings()
+    assert sorted(timings) == ['date', 'execute', 'match']
+    assert timings['match'].count == 400 and timings['date'].count == 4
+    assert 0.001 <= timings['match'].percentile(99) <= 0.0011